@@ -0,0 +1,77 @@
+import time
+
+import torch
+
+from main import get_parser, get_config, get_opt_TPG
+from interfaces.super_resolution import TextSR
+from utils.util import str_filt
+
+
+"""
+Accuracy / PSNR / SSIM of a trained model in --parity_precision (bf16 by default)
+against fp32, on one test set, with the SR + TPG inference path of --infer.
+
+    python3 check_precision.py --arch="tsrn_tl_cascade" --mask --stu_iter=1 --tpg="CRNN" \
+        --resume="ckpt/vis_TPGSR-TSRN/" --test_data_dir="TextZoom/test/medium/" --rec="crnn"
+
+The run fails if the accuracy drops by more than --acc_tol.
+"""
+
+
+def run(config, args, precision):
+    args.precision = precision
+    mission = TextSR(config, args, get_opt_TPG())
+    model_list, tpg_list = mission.infer_models()
+    rec, aster_info = mission.infer_recognizer_init()
+    _, test_loader = mission.get_test_data(args.test_data_dir)
+
+    images_sr_all, preds_all = [], []
+    n_correct, psnr, ssim, sr_time = 0, 0., 0., 0.
+    with torch.no_grad():
+        for i, data in enumerate(test_loader):
+            if args.parity_batches > 0 and i == args.parity_batches:
+                break
+            images_hr, images_lr, label_strs = data[:3]
+            images_hr, images_lr = images_hr.to(mission.device), images_lr.to(mission.device)
+            begin = time.time()
+            images_sr = mission.infer_sr(model_list, tpg_list, images_lr)
+            sr_time += time.time() - begin
+            preds = mission.infer_recognize(rec, images_sr, aster_info)
+
+            n = len(label_strs)
+            psnr += float(mission.cal_psnr(images_sr[:, :3], images_hr[:, :3])) * n
+            ssim += float(mission.cal_ssim(images_sr[:, :3], images_hr[:, :3])) * n
+            n_correct += sum(str_filt(pred, 'lower') == str_filt(label, 'lower')
+                             for pred, label in zip(preds, label_strs))
+            images_sr_all.append(images_sr.cpu())
+            preds_all.extend(preds)
+
+    num = len(preds_all)
+    result = {'accuracy': n_correct / num, 'psnr': psnr / num, 'ssim': ssim / num, 'sr_ms': sr_time * 1000. / num}
+    return result, torch.cat(images_sr_all, 0), preds_all
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--parity_precision', type=str, default='bf16', choices=['bf16', 'fp16'])
+    parser.add_argument('--parity_batches', type=int, default=0, help='test batches compared, 0 for all')
+    parser.add_argument('--acc_tol', type=float, default=0.005, help='largest accuracy drop accepted')
+    args = parser.parse_args()
+    config = get_config(args)
+
+    results = {}
+    for precision in ['fp32', args.parity_precision]:
+        results[precision] = run(config, args, precision)
+        print('%s: %s' % (precision, ', '.join('%s %.4f' % item for item in results[precision][0].items())))
+
+    ref, images_ref, preds_ref = results['fp32']
+    cur, images_sr, preds = results[args.parity_precision]
+    diff = (images_sr - images_ref).abs()
+    same = sum(p == q for p, q in zip(preds, preds_ref))
+    print('%s vs fp32: SR max abs diff %.2e, mean abs diff %.2e, same prediction %d / %d, '
+          'accuracy %+.4f, psnr %+.4f, ssim %+.4f'
+          % (args.parity_precision, float(diff.max()), float(diff.mean()), same, len(preds),
+             cur['accuracy'] - ref['accuracy'], cur['psnr'] - ref['psnr'], cur['ssim'] - ref['ssim']))
+    if ref['accuracy'] - cur['accuracy'] > args.acc_tol:
+        raise RuntimeError('%s accuracy is %.4f below fp32 (> %.4f)'
+                           % (args.parity_precision, ref['accuracy'] - cur['accuracy'], args.acc_tol))
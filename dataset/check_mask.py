@@ -0,0 +1,117 @@
+import os
+import sys
+import argparse
+import lmdb
+import six
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+# the repo root first: run as dataset/*.py, dataset/dataset.py would hide the dataset package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset.dataset import binarize_mask, alignCollate_syn
+from dataset.degradation import build_kernel_bank, BatchDegradation
+
+
+"""
+Parity check of the tensor --mask channel (dataset.binarize_mask) against the PIL
+point lambda it replaced, on the HR/LR images of a TextZoom style LMDB or on random
+images. Masks are compared per image and for batches of same-size images.
+With --degrade the mask channel that alignCollate_syn.degrade_lr adds to the LR it
+synthesizes is compared with the PIL mask of that LR.
+
+    python3 dataset/check_mask.py --lmdb_dir=TextZoom/train1 --num=5000
+    python3 dataset/check_mask.py --degrade
+"""
+
+
+def pil_mask(img):
+    mask = img.convert('L')
+    thres = np.array(mask).mean()
+    mask = mask.point(lambda x: 0 if x > thres else 255)
+    return np.array(mask)
+
+
+def lmdb_images(lmdb_dir, num):
+    env = lmdb.open(lmdb_dir, max_readers=1, readonly=True, lock=False, readahead=False, meminit=False)
+    with env.begin(write=False) as txn:
+        num = min(num, int(txn.get(b'num-samples')))
+        for index in range(1, num + 1):
+            for key in [b'image_hr-%09d' % index, b'image_lr-%09d' % index]:
+                imgbuf = txn.get(key)
+                if imgbuf is None:
+                    continue
+                buf = six.BytesIO()
+                buf.write(imgbuf)
+                buf.seek(0)
+                yield Image.open(buf).convert('RGB')
+    env.close()
+
+
+def random_images(num, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(num):
+        h, w = rng.randint(8, 64), rng.randint(16, 256)
+        yield Image.fromarray(rng.randint(0, 256, (h, w, 3), dtype=np.uint8))
+
+
+def degraded_masks(arrays, device, degrade):
+    # LR images and mask channels of degrade_lr for HR arrays [N, H, W, 3]
+    h, w = arrays.shape[1:3]
+    collate = alignCollate_syn(imgH=h, imgW=w, down_sample_scale=2, mask=True, degrade=degrade)
+    images_hr = torch.from_numpy(arrays).permute(0, 3, 1, 2).to(device).float() / 255.
+    images_lr = collate.degrade_lr(images_hr)
+    lr = (images_lr[:, :3] * 255.).round().byte().permute(0, 2, 3, 1).cpu().numpy()
+    masks = (images_lr[:, 3] * 255.).round().byte().cpu().numpy()
+    return [Image.fromarray(image) for image in lr], masks
+
+
+def check(images, batch_size, device, degrade=None):
+    num_images, bad_images, bad_pixels = 0, 0, 0
+    groups = {}
+
+    def compare(batch):
+        nonlocal num_images, bad_images, bad_pixels
+        arrays = np.stack([np.array(img) for img in batch])
+        if degrade is not None:
+            batch, masks = degraded_masks(arrays, device, degrade)
+        else:
+            masks = binarize_mask(torch.from_numpy(arrays).permute(0, 3, 1, 2).to(device))[:, 0].cpu().numpy()
+        for img, mask in zip(batch, masks):
+            diff = int((mask != pil_mask(img)).sum())
+            num_images += 1
+            bad_images += int(diff > 0)
+            bad_pixels += diff
+
+    for img in tqdm(images):
+        group = groups.setdefault(img.size, [])
+        group.append(img)
+        if len(group) == batch_size:
+            compare(group)
+            groups[img.size] = []
+    for group in groups.values():
+        if len(group) > 0:
+            compare(group)
+    return num_images, bad_images, bad_pixels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the batched tensor mask with the PIL mask')
+    parser.add_argument('--lmdb_dir', type=str, default=None, help='random images if not given')
+    parser.add_argument('--num', type=int, default=2000, help='samples to check')
+    parser.add_argument('--batch_size', type=int, default=64, help='')
+    parser.add_argument('--device', type=str, default='cpu', help='')
+    parser.add_argument('--degrade', action='store_true', default=False,
+                        help='check the mask of the LR synthesized by dataset.degradation instead')
+    args = parser.parse_args()
+
+    degrade = None
+    if args.degrade:
+        degrade = BatchDegradation(build_kernel_bank(kernels_per_family=20), noise=(0., 10.),
+                                   jpeg_prob=0.5, seed=0)
+    images = lmdb_images(args.lmdb_dir, args.num) if args.lmdb_dir is not None else random_images(args.num)
+    num_images, bad_images, bad_pixels = check(images, args.batch_size, torch.device(args.device), degrade)
+    print('%d images, %d masks differ from PIL, %d pixels in total' % (num_images, bad_images, bad_pixels))
+    if bad_images > 0:
+        sys.exit(1)
@@ -1,4 +1,7 @@
 import os
+import sys
+import argparse
+import multiprocessing
 import lmdb  # install lmdb by "pip install lmdb"
 import cv2
 import json
@@ -13,11 +16,15 @@ import random
 import six
 from IPython import embed
 
+# the repo root first: run as dataset/*.py, dataset/dataset.py would hide the dataset package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset.lmdb_index import index_record, sample_record, write_index
 
-def rand_crop(im):
+
+def rand_crop(im, rng=random):
     w, h = im.size
     scale = 0.95
-    p1 = (random.uniform(0, w * (1 - scale)), random.uniform(0, h * (1 - scale)))
+    p1 = (rng.uniform(0, w * (1 - scale)), rng.uniform(0, h * (1 - scale)))
     p2 = (p1[0] + scale * w, p1[1] + scale * h)
     return im.crop(p1 + p2)
 
@@ -33,20 +40,19 @@ def buf2PIL(txn, key, type='RGB', degree=0):
     return im
 
 
-def PIL2buf(im):
-    name = str(int(time.time())) + '.jpg'
-    im.save(os.path.join('./', name))
-    with open(os.path.join('./', name), 'rb') as f:
-        imageBin = f.read()
-    os.remove(os.path.join('./', name))
-    return imageBin
+def PIL2buf(im, format='JPEG'):
+    buf = six.BytesIO()
+    im.save(buf, format=format)
+    return buf.getvalue()
 
 
 def checkImageIsValid(imageBin):
     if imageBin is None:
         return False
-    imageBuf = np.fromstring(imageBin, dtype=np.uint8)
+    imageBuf = np.frombuffer(imageBin, dtype=np.uint8)
     img = cv2.imdecode(imageBuf, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return False
     imgH, imgW = img.shape[0], img.shape[1]
     if imgH * imgW == 0:
         return False
@@ -181,7 +187,135 @@ def createDataset_inpainting(outputPath, imagePathList, labelList):
     print('Created dataset with %d samples' % nSamples)
 
 
-def createDataset(outputPath, imagePathList, labelList, lexiconList=None, checkValid=True):
+PROGRESS_KEY = b'build-progress'
+
+
+class LMDBWriter(object):
+    """
+    Single writer of build_lmdb: about txn_size inputs or samples per commit, each commit
+    records the progress of the build in the same transaction, and map_size doubles
+    whenever the map is full.
+    """
+    def __init__(self, outputPath, txn_size=1000, map_size=1 << 30):
+        if not os.path.exists(outputPath):
+            os.makedirs(outputPath)
+        self.env = lmdb.open(outputPath, map_size=map_size)
+        self.map_size = max(map_size, self.env.info()['map_size'])
+        self.txn_size = txn_size
+        self.pending = []
+
+    def progress(self):
+        # (inputs consumed, samples written) of an interrupted build, (0, 0) for a new one
+        with self.env.begin(write=False) as txn:
+            done = txn.get(PROGRESS_KEY)
+        if done is None:
+            return 0, 0
+        done = json.loads(done.decode())
+        return done['consumed'], done['written']
+
+    def put(self, key, value):
+        self.pending.append((key.encode() if type(key) is not bytes else key, value))
+
+    def commit(self, consumed, written):
+        self.pending.append((PROGRESS_KEY, json.dumps({'consumed': consumed, 'written': written}).encode()))
+        while True:
+            try:
+                with self.env.begin(write=True) as txn:
+                    for k, v in self.pending:
+                        txn.put(k, v)
+                break
+            except lmdb.MapFullError:
+                self.map_size *= 2
+                self.env.set_mapsize(self.map_size)
+        self.pending = []
+
+    def finish(self, nSamples):
+        with self.env.begin(write=True) as txn:
+            txn.put(b'num-samples', str(nSamples).encode())
+            txn.delete(PROGRESS_KEY)
+
+    def close(self):
+        self.env.close()
+
+
+def build_lmdb(outputPath, inputs, load_fn, workers=8, txn_size=1000, chunksize=32, map_size=1 << 30):
+    """
+    Create an LMDB from inputs with a process pool.
+    ARGS:
+        outputPath : LMDB output path, an interrupted build there is resumed (with the same inputs)
+        inputs     : list of picklable inputs, consumed in order
+        load_fn    : top-level function, load_fn(input) -> (entries, record), a list of them, or
+                     None to drop the input. entries maps key prefixes ('image', 'label', ...) to
+                     bytes, stored under '%s-%09d' % (prefix, cnt); record is its
+                     lmdb_index.index_record.
+        workers    : processes decoding / validating / encoding, 0 runs load_fn in this process
+        txn_size   : inputs (or samples, if they come first) per write transaction
+    Returns the number of samples written.
+    """
+    writer = LMDBWriter(outputPath, txn_size, map_size)
+    consumed, written = writer.progress()
+    records = []
+    if consumed > 0:
+        print('Resuming %s: %d / %d inputs done, %d samples written' % (outputPath, consumed, len(inputs), written))
+        # records of the samples already written are read back from the LMDB
+        with writer.env.begin(write=False) as txn:
+            records = [sample_record(txn, cnt) for cnt in tqdm(range(1, written + 1))]
+
+    pool = multiprocessing.Pool(workers) if workers > 0 else None
+    try:
+        results = pool.imap(load_fn, inputs[consumed:], chunksize) if pool is not None else map(load_fn, inputs[consumed:])
+        cnt = written + 1
+        committed = (consumed, written)
+        for result in tqdm(results, total=len(inputs) - consumed):
+            consumed += 1
+            if result is None:
+                result = []
+            elif not isinstance(result, list):
+                result = [result]
+            for entries, record in result:
+                for prefix, value in entries.items():
+                    writer.put('%s-%09d' % (prefix, cnt), value)
+                records.append(record)
+                cnt += 1
+            # at input boundaries only, an input is either fully written or redone on resume
+            if max(consumed - committed[0], cnt - 1 - committed[1]) >= writer.txn_size:
+                writer.commit(consumed, cnt - 1)
+                committed = (consumed, cnt - 1)
+        writer.commit(consumed, cnt - 1)
+        nSamples = cnt - 1
+        writer.finish(nSamples)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        writer.close()
+
+    write_index(outputPath, records)
+    print('Created dataset with %d samples' % nSamples)
+    return nSamples
+
+
+def load_image_sample(job):
+    """load_fn of createDataset: job is (imagePath, label, lexicon, checkValid)."""
+    imagePath, label, lexicon, checkValid = job
+    if len(label) == 0:
+        return None
+    if not os.path.exists(imagePath):
+        print('%s does not exist' % imagePath)
+        return None
+    with open(imagePath, 'rb') as f:
+        imageBin = f.read()
+    if checkValid:
+        if not checkImageIsValid(imageBin):
+            print('%s is not a valid image' % imagePath)
+            return None
+
+    entries = {'image': imageBin, 'label': label.encode()}
+    if lexicon:
+        entries['lexicon'] = ' '.join(lexicon).encode()
+    return entries, index_record(label, imageBin, decode=checkValid)
+
+
+def createDataset(outputPath, imagePathList, labelList, lexiconList=None, checkValid=True, workers=8, txn_size=1000):
     """
   Create LMDB dataset for CRNN training.
   ARGS:
@@ -190,47 +324,13 @@ def createDataset(outputPath, imagePathList, labelList, lexiconList=None, checkV
       labelList     : list of corresponding groundtruth texts
       lexiconList   : (optional) list of lexicon lists
       checkValid    : if true, check the validity of every image
+      workers       : processes reading and validating the images
+      txn_size      : inputs per write transaction
   """
     assert (len(imagePathList) == len(labelList))
-    nSamples = len(imagePathList)
-    if not os.path.exists(outputPath):
-        os.mkdir(outputPath)
-    env = lmdb.open(outputPath, map_size=1099511627776)
-    cache = {}
-    cnt = 1
-    for i in range(nSamples):
-        imagePath = imagePathList[i]
-        label = labelList[i]
-        if len(label) == 0:
-            continue
-        if not os.path.exists(imagePath):
-            print('%s does not exist' % imagePath)
-            continue
-        with open(imagePath, 'rb') as f:
-            imageBin = f.read()
-        if checkValid:
-            if not checkImageIsValid(imageBin):
-                print('%s is not a valid image' % imagePath)
-                continue
-
-        imageKey = 'image-%09d' % cnt
-        labelKey = 'label-%09d' % cnt
-        cache[imageKey] = imageBin
-
-        cache[labelKey] = label.encode()
-        if lexiconList:
-            lexiconKey = 'lexicon-%09d' % cnt
-            cache[lexiconKey] = ' '.join(lexiconList[i])
-        # embed()
-        if cnt % 1000 == 0:
-            writeCache(env, cache)
-            cache = {}
-            print('Written %d / %d' % (cnt, nSamples))
-        cnt += 1
-    nSamples = cnt - 1
-    cache['num-samples'] = str(nSamples).encode()
-    writeCache(env, cache)
-    print('Created dataset with %d samples' % nSamples)
+    jobs = [(imagePathList[i], labelList[i], lexiconList[i] if lexiconList else None, checkValid)
+            for i in range(len(imagePathList))]
+    return build_lmdb(outputPath, jobs, load_image_sample, workers=workers, txn_size=txn_size)
 
 
 def create_800k():
@@ -476,59 +576,75 @@ def create_txt():
     createDataset(lmdb_output_path, image_paths, image_labels)
 
 
-def create_from_lmdb():
-    root = '/mnt/lustre/wangwenjia/wwj_space/dataset/lmdb/str/syn800k_HR2'
-    out_path = '/mnt/lustre/wangwenjia/wwj_space/dataset/lmdb/str/syn800k_HR_crop'
-    env = lmdb.open(root, map_size=1099511627776)
-    env_out = lmdb.open(out_path, map_size=1099511627776)
-    cache_out = {}
-    txn = env.begin()
-    num_samples = int(txn.get(b'num-samples'))
-    for cnt in range(num_samples):
-        imageKey = b'image-%09d' % (cnt + 1)
-        image_HR_Key = 'image_HR-%09d' % (cnt + 1)
-        image_lr_Key = 'image_lr-%09d' % (cnt + 1)
-        image = buf2PIL(txn, imageKey)
-        out_image = rand_crop(image)
-        labelKey = b'label-%09d' % (cnt + 1)
-        label = txn.get(labelKey)
-        # embed()
-        cache_out[image_HR_Key] = PIL2buf(image)
-        cache_out[image_lr_Key] = PIL2buf(out_image)
-        cache_out[labelKey] = label
-        if cnt % 1000 == 0:
-            writeCache(env_out, cache_out)
-            cache_out = {}
-            print('Written %d / %d' % (cnt, num_samples))
-
-    cache_out['num-samples'] = str(num_samples).encode()
-    writeCache(env_out, cache_out)
-    print('Created dataset with %d samples' % num_samples)
+# source LMDB of load_crop_sample, opened once per worker
+_source_txn = {}
+
+
+def load_crop_sample(job):
+    """load_fn of create_from_lmdb: job is (source LMDB path, key)."""
+    root, cnt = job
+    if root not in _source_txn:
+        env = lmdb.open(root, readonly=True, lock=False, readahead=False, meminit=False)
+        _source_txn[root] = env.begin(write=False)
+    txn = _source_txn[root]
+    label = txn.get(b'label-%09d' % cnt)
+    if label is None:
+        return None
+    try:
+        image = buf2PIL(txn, b'image-%09d' % cnt)
+    except (IOError, TypeError):
+        return None
+    # the crop of a sample does not depend on the worker that makes it
+    out_image = rand_crop(image, random.Random(cnt))
+    image_HR, image_lr = PIL2buf(image), PIL2buf(out_image)
+    entries = {'image_hr': image_HR, 'image_lr': image_lr, 'label': label}
+    return entries, index_record(label, image_HR, image_lr, decode=False)
+
+
+def create_from_lmdb(root='/mnt/lustre/wangwenjia/wwj_space/dataset/lmdb/str/syn800k_HR2',
+                     out_path='/mnt/lustre/wangwenjia/wwj_space/dataset/lmdb/str/syn800k_HR_crop',
+                     workers=8, txn_size=1000):
+    env = lmdb.open(root, readonly=True, lock=False)
+    with env.begin(write=False) as txn:
+        num_samples = int(txn.get(b'num-samples'))
+    env.close()
+    jobs = [(root, cnt + 1) for cnt in range(num_samples)]
+    return build_lmdb(out_path, jobs, load_crop_sample, workers=workers, txn_size=txn_size)
+
+
+def read_image_list(gt_file):
+    # one "image_path label" per line, relative paths from the directory of gt_file
+    image_paths, labels = [], []
+    root = os.path.dirname(os.path.abspath(gt_file))
+    with open(gt_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if len(line) == 0:
+                continue
+            image_path, label = line.split(' ', 1)
+            image_paths.append(os.path.join(root, image_path))
+            labels.append(label)
+    return image_paths, labels
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build an LMDB (and its sidecar index) with a process pool')
+    parser.add_argument('--out', type=str, required=True, help='output LMDB, an interrupted build is resumed')
+    parser.add_argument('--gt_file', type=str, default=None, help='"image_path label" lines, written as image-/label- keys')
+    parser.add_argument('--from_lmdb', type=str, default=None, help='LMDB of image-/label- keys, written as HR + cropped LR pairs')
+    parser.add_argument('--workers', type=int, default=8, help='')
+    parser.add_argument('--txn_size', type=int, default=1000, help='samples per write transaction')
+    parser.add_argument('--no_check', action='store_true', default=False, help='skip the decode check of the images')
+    args = parser.parse_args()
+
     start_time = time.time()
-    create_from_lmdb()
+    if args.gt_file is not None:
+        image_paths, labels = read_image_list(args.gt_file)
+        createDataset(args.out, image_paths, labels, checkValid=not args.no_check,
+                      workers=args.workers, txn_size=args.txn_size)
+    elif args.from_lmdb is not None:
+        create_from_lmdb(args.from_lmdb, args.out, workers=args.workers, txn_size=args.txn_size)
+    else:
+        parser.error('one of --gt_file and --from_lmdb is needed')
     end_time = time.time()
     print('cost %d seconds' % (end_time - start_time))
-    #
-    # lmdb_output_path = '/home/wwj/0_LAB/dataset/'
-    # # gt_file = os.path.join(data_dir, 'gt.txt')
-    # # image_dir = data_dir
-    # # with open(gt_file, 'r') as f:
-    # #   lines = [line.strip('\n') for line in f.readlines()]
-    # lines=os.listdir(data_dir)
-    #
-    # imagePathList, labelList = [], []
-    # for i, line in enumerate(lines):
-    #   # splits = line.split(' ')
-    #   # image_name = splits[0]
-    #   # gt_text = splits[1]
-    #   image_name=line
-    #   gt_text=line.split('_')[0]
-    #   #print(image_name, gt_text)
-    #   imagePathList.append(os.path.join(data_dir, image_name))
-    #   labelList.append(gt_text)
-    #
-    # embed()
-    # createDataset(lmdb_output_path, imagePathList, labelList)
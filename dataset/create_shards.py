@@ -0,0 +1,138 @@
+import os
+import json
+import argparse
+import lmdb
+import six
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+"""
+Pre-decoded shard format of a TextZoom style LMDB (image_hr-/image_lr-/label- keys).
+
+out_dir/
+    shards.json          num_samples, shard_size, image sizes and the file name patterns below
+    hr-00000.npy         uint8 [n, H, W, 3], HR images already resized to (W, H)
+    lr-00000.npy         uint8 [n, H / s, W / s, 3], LR images already resized
+    text-00000.npy       uint8 [bytes], utf-8 labels of the shard concatenated
+    offset-00000.npy     int64 [n + 1], label i is text[offset[i]:offset[i + 1]]
+
+Every shard but the last holds exactly shard_size samples, so sample i lives in
+shard i // shard_size. The files are opened with np.load(mmap_mode='r') by
+dataset.memmapDataset_real, jobs on one node share them through the page cache.
+"""
+
+SHARD_META = 'shards.json'
+
+
+def buf2array(imgbuf, size):
+    buf = six.BytesIO()
+    buf.write(imgbuf)
+    buf.seek(0)
+    im = Image.open(buf).convert('RGB')
+    im = im.resize(size, Image.BICUBIC)
+    return np.asarray(im, dtype=np.uint8)
+
+
+def write_shard(out_dir, meta, shard_idx, hr_list, lr_list, label_list):
+    text = [label.encode() for label in label_list]
+    offset = np.zeros(len(text) + 1, dtype=np.int64)
+    offset[1:] = np.cumsum([len(t) for t in text])
+
+    np.save(os.path.join(out_dir, meta['hr'] % shard_idx), np.stack(hr_list, 0))
+    np.save(os.path.join(out_dir, meta['lr'] % shard_idx), np.stack(lr_list, 0))
+    np.save(os.path.join(out_dir, meta['text'] % shard_idx), np.frombuffer(b''.join(text), dtype=np.uint8))
+    np.save(os.path.join(out_dir, meta['offset'] % shard_idx), offset)
+
+
+def create_shards(lmdb_dir, out_dir, width=128, height=32, down_sample_scale=2, shard_size=20000, max_len=100):
+    """
+    Convert an LMDB with image_hr / image_lr / label keys into memory-mappable shards.
+    ARGS:
+        lmdb_dir          : source LMDB path
+        out_dir           : output directory
+        width, height     : HR size the images are resized to
+        down_sample_scale : LR images are resized to (width / scale, height / scale)
+        shard_size        : number of samples per shard
+        max_len           : samples with longer labels are dropped
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    hr_size = (width, height)
+    lr_size = (width // down_sample_scale, height // down_sample_scale)
+
+    meta = {
+        'num_samples': 0,
+        'shard_size': shard_size,
+        'num_shards': 0,
+        'hr_size': list(hr_size),
+        'lr_size': list(lr_size),
+        'hr': 'hr-%05d.npy',
+        'lr': 'lr-%05d.npy',
+        'text': 'text-%05d.npy',
+        'offset': 'offset-%05d.npy',
+        'source': os.path.abspath(lmdb_dir),
+    }
+
+    env = lmdb.open(lmdb_dir, readonly=True, lock=False, readahead=True, meminit=False)
+    txn = env.begin(write=False)
+    num_samples = int(txn.get(b'num-samples'))
+
+    hr_list, lr_list, label_list = [], [], []
+    cnt = 0
+    skipped = 0
+    for index in tqdm(range(1, num_samples + 1)):
+        label = txn.get(b'label-%09d' % index)
+        img_HR = txn.get(b'image_hr-%09d' % index)
+        img_lr = txn.get(b'image_lr-%09d' % index)
+        if label is None or img_HR is None or img_lr is None:
+            skipped += 1
+            continue
+        label = label.decode()
+        if len(label) > max_len:
+            skipped += 1
+            continue
+        try:
+            img_HR = buf2array(img_HR, hr_size)
+            img_lr = buf2array(img_lr, lr_size)
+        except IOError:
+            skipped += 1
+            continue
+        hr_list.append(img_HR)
+        lr_list.append(img_lr)
+        label_list.append(label)
+        cnt += 1
+
+        if len(label_list) == shard_size:
+            write_shard(out_dir, meta, meta['num_shards'], hr_list, lr_list, label_list)
+            meta['num_shards'] += 1
+            hr_list, lr_list, label_list = [], [], []
+
+    if len(label_list) > 0:
+        write_shard(out_dir, meta, meta['num_shards'], hr_list, lr_list, label_list)
+        meta['num_shards'] += 1
+
+    env.close()
+
+    meta['num_samples'] = cnt
+    # written last: a directory without it is an unfinished conversion
+    with open(os.path.join(out_dir, SHARD_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('Created %d shards with %d samples, skipped %d' % (meta['num_shards'], cnt, skipped))
+    return meta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a TextZoom LMDB into pre-decoded memmap shards')
+    parser.add_argument('--lmdb_dir', type=str, required=True, help='')
+    parser.add_argument('--out_dir', type=str, required=True, help='')
+    parser.add_argument('--width', type=int, default=128, help='')
+    parser.add_argument('--height', type=int, default=32, help='')
+    parser.add_argument('--down_sample_scale', type=int, default=2, help='')
+    parser.add_argument('--shard_size', type=int, default=20000, help='')
+    parser.add_argument('--max_len', type=int, default=100, help='')
+    args = parser.parse_args()
+    create_shards(args.lmdb_dir, args.out_dir, args.width, args.height,
+                  args.down_sample_scale, args.shard_size, args.max_len)
@@ -1,15 +1,32 @@
 from scipy.io import loadmat
-from IPython import embed
-from PIL import Image
 from tqdm import tqdm
 import os
+import sys
 import cv2
-import string
 import numpy
-import math
-import json
 import argparse
 
+# the repo root first: run as dataset/*.py, dataset/dataset.py would hide the dataset package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset.lmdb_index import index_record
+from dataset.create_lmdb import build_lmdb
+
+
+"""
+Word crops of SynthText (gt.mat + images) written straight into an LMDB of
+image-/label- keys, with its sidecar index, by the parallel builder of create_lmdb.py:
+
+    python3 dataset/crop_800k.py --gt_path=SynthText/gt.mat --syntxt_path=SynthText \
+        --out=LMDB/syn800k_HR2 --workers=32
+
+Workers take shard_size images each and cut all their word boxes. With --rectify the
+quadrilaterals are warped to rectangles, otherwise the bounding rectangle is cropped.
+An interrupted run resumes at the first unfinished shard.
+"""
+
+# gt.mat of the worker processes, inherited through fork or loaded on first use
+_gt = {}
+
 
 def t_split(txt):
     list1 = []
@@ -23,130 +40,118 @@ def t_split(txt):
     return list1
 
 
-def gt_box(contours):
-    list_bbox = []
-    for j in range(contours.shape[2]):
-        quad_points = numpy.zeros((4, 1, 2), dtype='float32')
-        for k in range(4):
-            quad_points[k][0][0] = contours[0][k][j]
-            quad_points[k][0][1] = contours[1][k][j]
-        list_bbox.append(quad_points)  # quad_points.astype(numpy.int32)
-    return list_bbox
-
-
-def crop_rect(list_bbox):
-    list_rect = []
-
-    for i in range(len(list_bbox)):
-        temp = list_bbox[i].reshape(4, 2)
-        temp1 = numpy.transpose(temp)
-        x_min = math.floor(temp1[0].min())
-        x_max = math.ceil(temp1[0].max())
-        y_min = math.floor(temp1[1].min())
-        y_max = math.ceil(temp1[1].max())
-
-        quad_points = numpy.zeros((4, 1, 2), dtype='int32')
-        quad_points[0][0] = [x_min, y_min]
-        quad_points[1][0] = [x_max, y_min]
-        quad_points[2][0] = [x_max, y_max]
-        quad_points[3][0] = [x_min, y_max]
-        list_rect.append(quad_points)
-    return list_rect
+def load_gt(gt_path):
+    if gt_path not in _gt:
+        m = loadmat(gt_path)
+        _gt[gt_path] = (m['imnames'][0], m['wordBB'][0], m['txt'][0])
+    return _gt[gt_path]
+
+
+# wordBoundingBox is based on four points (x1,y1),(x2,y2),(x3,y3),(x4,y4)
+# each picture has n BOXes,which is same as the numbers of the labels.
+# (the labels could be splited from the txt)
+# the labels and the wordBBs are of one-to-one correspondence
+#
+# eg.
+# m['wordBB'][0][12]=
+# array([[[144.11255, 280.32397, 425.85638, 508.72253],                    ## x1
+#         [221.60611, 421.7674 , 489.43262, 580.4785 ],                    ## x2
+#         [210.23676, 421.62714, 488.78485, 579.8429 ],                    ## x3      k
+#         [132.7432 , 280.18372, 425.20862, 508.0869 ]],                   ## x4      |
+#                                                                                     |
+#        [[203.68845, 384.30234, 359.90906, 360.9495 ],                    ## y1      |
+#         [223.97514, 385.26584, 360.70734, 361.85043],                    ## y2      *
+#         [267.40524, 405.8596 , 412.29712, 412.47342],                    ## y3
+#         [247.11855, 404.8961 , 411.49884, 411.57248]]], dtype=float32)   ## y4
+#         ##BOX1##    ##BOX2##    ##BOX3##    ##BOX4##
+#                         j----->
+# m['imnames'][0][12]=
+# array(['8/ballet_106_109.jpg'], dtype='<U20')
+#
+# m['txt'][0][12]=
+# array(['the         ', '[Description', 'V8 V12      '], dtype='<U12')
+#
+# t_split(m['txt'][0][12])=
+# ['the', '[Description', 'V8', 'V12']
+def word_quads(contours):
+    # (2, 4, n) or (2, 4) wordBB -> [n, 4, 2] corner points (x, y)
+    return contours.reshape(2, 4, -1).transpose(2, 1, 0).astype(numpy.float32)
+
+
+def crop_words(im, quads, rectify=False):
+    """
+    Crops of the quads [n, 4, 2] in im. Bounding rectangles are clipped to the image,
+    empty ones give None.
+    """
+    h, w = im.shape[:2]
+    x_min = numpy.clip(numpy.floor(quads[:, :, 0].min(1)), 0, w).astype(int)
+    x_max = numpy.clip(numpy.ceil(quads[:, :, 0].max(1)), 0, w).astype(int)
+    y_min = numpy.clip(numpy.floor(quads[:, :, 1].min(1)), 0, h).astype(int)
+    y_max = numpy.clip(numpy.ceil(quads[:, :, 1].max(1)), 0, h).astype(int)
+    empty = (x_max <= x_min) | (y_max <= y_min)
+
+    if not rectify:
+        return [None if empty[j] else im[y_min[j]:y_max[j], x_min[j]:x_max[j]] for j in range(len(quads))]
+
+    # target size: the longer of the opposite edges of every quad
+    edges = numpy.linalg.norm(quads - numpy.roll(quads, -1, axis=1), axis=2)
+    out_w = numpy.ceil(numpy.maximum(edges[:, 0], edges[:, 2])).astype(int)
+    out_h = numpy.ceil(numpy.maximum(edges[:, 1], edges[:, 3])).astype(int)
+    crops = []
+    for j in range(len(quads)):
+        if empty[j] or out_w[j] == 0 or out_h[j] == 0:
+            crops.append(None)
+            continue
+        dst = numpy.array([[0, 0], [out_w[j], 0], [out_w[j], out_h[j]], [0, out_h[j]]], dtype=numpy.float32)
+        matrix = cv2.getPerspectiveTransform(quads[j], dst)
+        crops.append(cv2.warpPerspective(im, matrix, (int(out_w[j]), int(out_h[j])),
+                                         flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE))
+    return crops
+
+
+def crop_shard(job):
+    """load_fn of build_lmdb: job is (gt_path, syntxt_path, start, end, rectify, min_h, min_w)."""
+    gt_path, syntxt_path, start, end, rectify, min_h, min_w = job
+    imnames, word_bbs, txts = load_gt(gt_path)
+    samples = []
+    for i in range(start, end):
+        im = cv2.imread(os.path.join(syntxt_path, imnames[i][0]))
+        if im is None:
+            continue
+        labels = t_split(txts[i])
+        quads = word_quads(word_bbs[i])[:len(labels)]
+        for label, crop in zip(labels, crop_words(im, quads, rectify)):
+            if crop is None or crop.shape[0] < min_h or crop.shape[1] < min_w:
+                continue
+            ok, buf = cv2.imencode('.jpg', crop)
+            if not ok:
+                continue
+            imageBin = buf.tobytes()
+            samples.append(({'image': imageBin, 'label': label.encode()},
+                            index_record(label, imageBin, decode=False)))
+    return samples
 
 
 def main(args):
-    m = loadmat(args.gt_path)
-    cwd = os.getcwd()
-    # symbol = ['~','`','!','@','$','#','%','^','&','*','(',')','-','+','=','_',
-    #           '|',',','[',']','\\',':',';','\'','"','.','?','<','>','/','{','}']
-    symbol = string.punctuation
-    count = 0
-    for i in tqdm(range(m['imnames'][0].shape[0])):
-
-        contours = m['wordBB'][0][i]  # note: cotours.shape=(2,4,len(labels))
-        if len(contours.shape) == 2:
-            contours = contours.reshape(2, 4, 1)
-        im_name = m['imnames'][0][i][0]
-        txt = m['txt'][0][i]
-
-        labels = t_split(txt)
-
-        BBox = gt_box(contours)  # the list of groundtruth boundingboxs,quadrilateral shape
-        RectBox = crop_rect(BBox)  # the list of minimum circumscribed rectangle of the BBOXs
-        count += contours.shape[2]
-        path = os.path.join(args.syntext_path, im_name)
-        im = cv2.imread(path)
-
-        for j in range(len(labels)):
-            x_min = max(RectBox[j][0][0][0], 0)
-            x_max = min(RectBox[j][1][0][0], im.shape[1])
-            y_min = max(RectBox[j][0][0][1], 0)
-            y_max = min(RectBox[j][2][0][1], im.shape[0])
-            # these 4 lines are used to ensure the box does not stretch out of the image
-
-            im1 = im[y_min:y_max, x_min:x_max]
-            label = labels[j]
-            for idx in range(len(symbol)):
-                label = label.replace(symbol[idx], '')
-
-            new_name = im_name.split('/')[0] + '_' + im_name.split('/')[1].split('.')[0] + '_' + str(
-                j) + '_' + label + '.jpg'
-            im_new_path = os.path.join(args.out_path, 'syntxt_crop', im_name.split('/')[0])
-            if not os.path.exists(im_new_path):
-                os.mkdir(im_new_path)
-            cv2.imwrite(os.path.join(im_new_path, new_name), im1)
-
-            with open('./syntxt_crop.odgt', 'a') as f1:
-                dict1 = {'im_path': str(im_new_path), 'im_name': str(new_name), 'label': str(labels[j])}
-                js = json.dumps(dict1)
-                f1.write(js + '\n')
-
-        ''' 
-        plot the bbox and rectangle of each word
-        
-        BBox1=[]
-        for i in range(len(BBox)):
-            BBox1.append(BBox[i].astype(numpy.int32))
-
-        im1=cv2.polylines(im,RectBox,isClosed=True,color=(255,255,255),thickness=1,lineType=8)
-        im2=cv2.polylines(im,BBox1,isClosed=True,color=(255,255,255),thickness=1,lineType=8)
-        '''
-
-        '''
-        wordBoundingBox is based on four points (x1,y1),(x2,y2),(x3,y3),(x4,y4)
-        each picture has n BOXes,which is same as the numbers of the labels.
-        (the labels could be splited from the txt)
-        the labels and the wordBBs are of one-to-one correspondence
-        
-        eg.
-        m['wordBB'][0][12]=
-        array([[[144.11255, 280.32397, 425.85638, 508.72253],                    ## x1  
-                [221.60611, 421.7674 , 489.43262, 580.4785 ],                    ## x2
-                [210.23676, 421.62714, 488.78485, 579.8429 ],                    ## x3      k
-                [132.7432 , 280.18372, 425.20862, 508.0869 ]],                   ## x4      |
-                                                                                            |
-               [[203.68845, 384.30234, 359.90906, 360.9495 ],                    ## y1      |
-                [223.97514, 385.26584, 360.70734, 361.85043],                    ## y2      *
-                [267.40524, 405.8596 , 412.29712, 412.47342],                    ## y3
-                [247.11855, 404.8961 , 411.49884, 411.57248]]], dtype=float32)   ## y4
-                ##BOX1##    ##BOX2##    ##BOX3##    ##BOX4##
-                                j----->
-        m['imnames'][0][12]=
-        array(['8/ballet_106_109.jpg'], dtype='<U20')
-        
-        m['txt'][0][12]=
-        array(['the         ', '[Description', 'V8 V12      '], dtype='<U12')
-        
-        t_split(m['txt'][0][12])=
-        ['the', '[Description', 'V8', 'V12']
-        '''
-    print(count)
+    imnames = load_gt(args.gt_path)[0]
+    num_images = len(imnames) if args.num_images is None else min(args.num_images, len(imnames))
+    jobs = [(args.gt_path, args.syntxt_path, start, min(start + args.shard_size, num_images),
+             args.rectify, args.min_h, args.min_w) for start in range(0, num_images, args.shard_size)]
+    print('%d images in %d shards' % (num_images, len(jobs)))
+    build_lmdb(args.out, jobs, crop_shard, workers=args.workers, txn_size=args.txn_size, chunksize=1)
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Convert images')
+    parser = argparse.ArgumentParser(description='Crop the SynthText words into an LMDB')
     parser.add_argument('--gt_path', default='./SynthText/gt.mat', type=str, help='')
     parser.add_argument('--syntxt_path', default='./SynthText', type=str, help='')
-    parser.add_argument('--out_path', default='./', type=str, help='')
+    parser.add_argument('--out', default='./syn800k_HR2', type=str, help='output LMDB')
+    parser.add_argument('--workers', default=8, type=int, help='')
+    parser.add_argument('--shard_size', default=200, type=int, help='images per worker job')
+    parser.add_argument('--txn_size', default=5000, type=int, help='')
+    parser.add_argument('--rectify', action='store_true', default=False, help='warp the word quadrilaterals to rectangles')
+    parser.add_argument('--min_h', default=64, type=int, help='smaller crops are dropped (create_800k kept h >= 64)')
+    parser.add_argument('--min_w', default=256, type=int, help='smaller crops are dropped (create_800k kept w >= 256)')
+    parser.add_argument('--num_images', default=None, type=int, help='only the first images, for a trial run')
     args = parser.parse_args()
     main(args)
@@ -3,7 +3,8 @@
 
 import random
 import torch
-from torch.utils.data import Dataset
+import torch.nn.functional as F
+from torch.utils.data import Dataset, IterableDataset
 from torch.utils.data import sampler
 import torchvision.transforms as transforms
 import lmdb
@@ -17,6 +18,10 @@ import string
 import cv2
 import os
 import re
+import json
+import glob
+import collections
+import itertools
 
 sys.path.append('../')
 from utils import str_filt
@@ -28,12 +33,21 @@ random.seed(0)
 from utils import utils_deblur
 from utils import utils_sisr as sr
 from utils import utils_image as util
+from dataset.lmdb_index import load_index
 
 scale = 0.90
-kernel = utils_deblur.fspecial('gaussian', 15, 1.)
+kernel = None
 noise_level_img = 0.
 
 
+def default_blur_kernel():
+    # Gaussian kernel of alignCollate_syn.degradation, built on first use instead of at import
+    global kernel
+    if kernel is None:
+        kernel = utils_deblur.fspecial('gaussian', 15, 1.)
+    return kernel
+
+
 def rand_crop(im):
     w, h = im.size
     p1 = (random.uniform(0, w*(1-scale)), random.uniform(0, h*(1-scale)))
@@ -57,94 +71,278 @@ def buf2PIL(txn, key, type='RGB'):
     return im
 
 
-class lmdbDataset(Dataset):
-    def __init__(self, root=None, voc_type='upper', max_len=31, test=True):
-        super(lmdbDataset, self).__init__()
-        self.env = lmdb.open(
+# read-only environments opened by this process, one per LMDB path
+_lmdb_envs = {}
+_lmdb_envs_readahead = {}
+_lmdb_envs_pid = None
+
+
+def open_lmdb(root, readahead=False):
+    global _lmdb_envs_pid
+    if _lmdb_envs_pid != os.getpid():
+        # handles inherited through fork must not be used, and lmdb refuses
+        # to reopen a path that is still registered in the process
+        for env in _lmdb_envs.values():
+            env.close()
+        _lmdb_envs.clear()
+        _lmdb_envs_readahead.clear()
+        _lmdb_envs_pid = os.getpid()
+
+    key = os.path.realpath(root)
+    if key not in _lmdb_envs:
+        env = lmdb.open(
             root,
-            max_readers=1,
+            max_readers=126,
             readonly=True,
             lock=False,
-            readahead=False,
+            readahead=readahead,
             meminit=False)
 
-        if not self.env:
+        if not env:
             print('cannot creat lmdb from %s' % (root))
             sys.exit(0)
+        _lmdb_envs[key] = env
+        _lmdb_envs_readahead[key] = readahead
+    elif readahead and not _lmdb_envs_readahead[key]:
+        # the flag is fixed when the environment is opened, the first opener wins
+        print('%s is already open without readahead in this process' % root)
+        _lmdb_envs_readahead[key] = None
+    return _lmdb_envs[key]
+
+
+class prefetchTxn(object):
+    """txn.get of the buffers read ahead by lmdbSequentialDataset, other keys from txn."""
+    def __init__(self, buffers, txn):
+        self.buffers = buffers
+        self.txn = txn
+
+    def get(self, key, default=None):
+        value = self.buffers.get(key)
+        if value is None:
+            value = self.txn.get(key, default)
+        return value
+
+
+class _SkippedSample(Exception):
+    pass
+
 
-        with self.env.begin(write=False) as txn:
+class lmdbDatasetBase(Dataset):
+    """
+    Base class of the LMDB backed datasets.
+    Every process (the main one or a DataLoader worker) opens the environment
+    on first access and keeps one read-only transaction alive, so workers never
+    use a forked handle and __getitem__ does not begin a transaction per sample.
+
+    With a sidecar index (dataset/lmdb_index.py) in root, self.meta holds its records
+    and invalid samples or labels longer than max_len are left out up front.
+    """
+    def __init__(self, root=None, voc_type='upper', max_len=100, test=False):
+        super(lmdbDatasetBase, self).__init__()
+        self.root = root
+
+        with open_lmdb(root).begin(write=False) as txn:
             nSamples = int(txn.get(b'num-samples'))
             self.nSamples = nSamples
 
-        self.max_len = max_len
         self.voc_type = voc_type
+        self.max_len = max_len
+        self.test = test
+
+        self.meta = load_index(root, nSamples)
+        # rows of meta (key - 1) of the samples used, None without an index
+        self.indices = None
+        if self.meta is not None:
+            self.indices = np.nonzero(self.meta['valid'] & (self.meta['label_len'] <= max_len))[0]
+            if len(self.indices) < nSamples:
+                print('%s: %d of %d samples are invalid or longer than %d' % (
+                    root, nSamples - len(self.indices), nSamples, max_len))
+
+        self._txn = None
+        self._pid = None
+        # set by lmdbSequentialDataset while it serves a read-ahead range
+        self.prefetch = None
+        # set while skip() looks for a readable sample
+        self._skipping = False
+
+    @property
+    def env(self):
+        return open_lmdb(self.root)
+
+    @property
+    def txn(self):
+        if self.prefetch is not None:
+            return self.prefetch
+        if self._txn is None or self._pid != os.getpid():
+            self._txn = self.env.begin(write=False)
+            self._pid = os.getpid()
+        return self._txn
+
+    def close(self):
+        if self._txn is not None and self._pid == os.getpid():
+            self._txn.abort()
+        self._txn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # transactions cannot be pickled (spawn start method), workers begin their own
+        state = self.__dict__.copy()
+        state['_txn'] = None
+        state['_pid'] = None
+        state['prefetch'] = None
+        return state
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
     def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
         return self.nSamples
 
+    def key(self, index):
+        # 1-based LMDB key of sample index
+        if self.indices is not None:
+            return int(self.indices[index]) + 1
+        return index + 1
+
+    def skip(self, index):
+        # without an index, unreadable samples and long labels are only found here:
+        # the first readable sample after index is returned instead
+        if self._skipping:
+            # a sample tried by the loop below is bad as well
+            raise _SkippedSample()
+        self._skipping = True
+        try:
+            for offset in range(1, len(self)):
+                try:
+                    return self[(index + offset) % len(self)]
+                except _SkippedSample:
+                    continue
+        finally:
+            self._skipping = False
+        raise RuntimeError('%s: none of the %d samples is readable or short enough (max_len %d)'
+                           % (self.root, len(self), self.max_len))
+
+    def sample_meta(self, index):
+        return None if self.meta is None else self.meta[self.key(index) - 1]
+
+    def image_size(self, index):
+        # (w, h) of the LR image, or of the only image of LMDBs without LR images
+        meta = self.sample_meta(index)
+        if meta is not None:
+            if meta['lr_w'] > 0:
+                return int(meta['lr_w']), int(meta['lr_h'])
+            return int(meta['hr_w']), int(meta['hr_h'])
+        key = self.key(index)
+        for name in [b'image_lr-%09d', b'image-%09d', b'image_hr-%09d']:
+            imgbuf = self.txn.get(name % key)
+            if imgbuf is not None:
+                # Image.open only parses the header
+                return Image.open(six.BytesIO(imgbuf)).size
+        return self[index][1].size
+
+
+class lmdbSequentialDataset(IterableDataset):
+    """
+    Iterates an lmdbDatasetBase in key order, for validation and test. Every range of
+    batch_size samples is read by one cursor pass per key prefix on an environment
+    opened with readahead, and the samples are then built by the dataset as usual.
+    Ranges go round-robin to the DataLoader workers, which the DataLoader also visits
+    round-robin, so batches come in the order of the map-style dataset.
+    """
+    PREFIXES = [b'label', b'image', b'image_hr', b'image_lr']
+
+    def __init__(self, dataset, batch_size):
+        super(lmdbSequentialDataset, self).__init__()
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def read_range(self, cursor, first, last):
+        buffers = {}
+        for prefix in self.PREFIXES:
+            last_key = b'%s-%09d' % (prefix, last)
+            if not cursor.set_range(b'%s-%09d' % (prefix, first)):
+                continue
+            for key, value in cursor:
+                if key > last_key:
+                    break
+                buffers[key] = value
+        return buffers
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        data = self.dataset
+        open_lmdb(data.root, readahead=True)
+        txn = data.txn
+        cursor = txn.cursor()
+        num_ranges = (len(data) + self.batch_size - 1) // self.batch_size
+        for r in range(worker_id, num_ranges, num_workers):
+            start, end = r * self.batch_size, min((r + 1) * self.batch_size, len(data))
+            buffers = self.read_range(cursor, data.key(start), data.key(end - 1))
+            data.prefetch = prefetchTxn(buffers, txn)
+            try:
+                for index in range(start, end):
+                    yield data[index]
+            finally:
+                data.prefetch = None
+
+
+class lmdbDataset(lmdbDatasetBase):
+    def __init__(self, root=None, voc_type='upper', max_len=31, test=True):
+        super(lmdbDataset, self).__init__(root, voc_type, max_len, test)
+
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index += 1
-        txn = self.env.begin(write=False)
+        key = self.key(index)
+        txn = self.txn
 
-        label_key = b'label-%09d' % index
+        label_key = b'label-%09d' % key
         word = str(txn.get(label_key).decode())
+        if len(word) > self.max_len:
+            return self.skip(index)
 
         try:
-            img = buf2PIL(txn, b'image_hr-%09d' % index, 'RGB')
+            img = buf2PIL(txn, b'image_hr-%09d' % key, 'RGB')
         except TypeError:
-            img = buf2PIL(txn, b'image-%09d' % index, 'RGB')
-        except IOError or len(label) > self.max_len:
-            return self[index + 1]
+            img = buf2PIL(txn, b'image-%09d' % key, 'RGB')
+        except IOError:
+            return self.skip(index)
 
         label_str = str_filt(word, self.voc_type)
         return img, label_str
 
 
-class lmdbDataset_real(Dataset):
+class lmdbDataset_real(lmdbDatasetBase):
     def __init__(self, root=None, voc_type='upper', max_len=100, test=False):
-        super(lmdbDataset_real, self).__init__()
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False)
-
-        if not self.env:
-            print('cannot creat lmdb from %s' % (root))
-            sys.exit(0)
-
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get(b'num-samples'))
-            self.nSamples = nSamples
-
+        super(lmdbDataset_real, self).__init__(root, voc_type, max_len, test)
         print("We have ", self.nSamples, "samples...")
 
-        self.voc_type = voc_type
-        self.max_len = max_len
-        self.test = test
-
-    def __len__(self):
-        return self.nSamples
-
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index += 1
-        txn = self.env.begin(write=False)
-        label_key = b'label-%09d' % index
+        key = self.key(index)
+        txn = self.txn
+        label_key = b'label-%09d' % key
         word = str(txn.get(label_key).decode())
-        img_HR_key = b'image_hr-%09d' % index  # 128*32
-        img_lr_key = b'image_lr-%09d' % index  # 64*16
+        if len(word) > self.max_len:
+            return self.skip(index)
+        img_HR_key = b'image_hr-%09d' % key  # 128*32
+        img_lr_key = b'image_lr-%09d' % key  # 64*16
         try:
             img_HR = buf2PIL(txn, img_HR_key, 'RGB')
             img_lr = buf2PIL(txn, img_lr_key, 'RGB')
 
             # print("img_HR:", img_HR.size, img_lr.size())
 
-        except IOError or len(word) > self.max_len:
-            return self[index + 1]
+        except IOError:
+            return self.skip(index)
         label_str = str_filt(word, self.voc_type)
         return img_HR, img_lr, label_str
 
@@ -271,6 +469,11 @@ class lmdbDataset_realSVT(Dataset):
     def __len__(self):
         return self.nSamples
 
+    def image_size(self, index):
+        # (w, h) from the image header, without decoding
+        anno = self.anno_list[index]
+        return Image.open(os.path.join(self.image_dir, anno.split(".")[0] + ".jpg")).size
+
     def __getitem__(self, index):
 
         idx = index % self.nSamples
@@ -383,6 +586,11 @@ class lmdbDataset_realIIIT(Dataset):
     def __len__(self):
         return self.nSamples
 
+    def image_size(self, index):
+        # (w, h) from the image header, without decoding
+        anno = self.anno_list[index]
+        return Image.open(os.path.join(self.image_dir, anno.split(".")[0] + ".jpg")).size
+
     def __getitem__(self, index):
 
         idx = index % self.nSamples
@@ -434,6 +642,9 @@ class lmdbDataset_realBadSet(Dataset):
     def __len__(self):
         return self.nSamples
 
+    def image_size(self, index):
+        return Image.open(os.path.join(self.image_dir, self.imlist[index])).size
+
     def __getitem__(self, index):
 
         idx = index % self.nSamples
@@ -458,50 +669,30 @@ class lmdbDataset_realBadSet(Dataset):
         return img_HR, img_lr, label_str, image_path
 
 
-class lmdbDataset_realIC15(Dataset):
+class lmdbDataset_realIC15(lmdbDatasetBase):
     def __init__(self, root=None, voc_type='upper', max_len=100, test=False):
-        super(lmdbDataset_realIC15, self).__init__()
-
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False)
-
-        if not self.env:
-            print('cannot creat lmdb from %s' % (root))
-            sys.exit(0)
-
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get(b'num-samples'))
-            self.nSamples = nSamples
-        self.voc_type = voc_type
-        self.max_len = max_len
-        self.test = test
+        super(lmdbDataset_realIC15, self).__init__(root, voc_type, max_len, test)
 
         # print("ROOT:", root)
 
-    def __len__(self):
-        return self.nSamples
-
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index += 1
-        txn = self.env.begin(write=False)
-        label_key = b'label-%09d' % index
+        key = self.key(index)
+        txn = self.txn
+        label_key = b'label-%09d' % key
         word = str(txn.get(label_key).decode())
-        img_key = b'image-%09d' % index  # 128*32
-        # img_lr_key = b'image_lr-%09d' % index  # 64*16
+        if len(word) > self.max_len:
+            return self.skip(index)
+        img_key = b'image-%09d' % key  # 128*32
+        # img_lr_key = b'image_lr-%09d' % key  # 64*16
         try:
             img_HR = buf2PIL(txn, img_key, 'RGB')
 
             img_lr = img_HR
             # print("img:", img_HR.size, word)
             # img_lr = buf2PIL(txn, img_lr_key, 'RGB')
-        except IOError or len(word) > self.max_len:
-            return self[index + 1]
+        except IOError:
+            return self.skip(index)
         label_str = str_filt(word, self.voc_type)
         return img_HR, img_lr, label_str, str(img_key)
 
@@ -534,6 +725,12 @@ class lmdbDataset_realCOCOText(Dataset):
     def __len__(self):
         return self.nSamples
 
+    def image_size(self, index):
+        gt_anno = self.gtlist[index].replace("\n", "")
+        if len(gt_anno.split(",")) < 2:
+            return self[index][1].size
+        return Image.open(os.path.join(self.image_dir, gt_anno.split(",")[0] + ".jpg")).size
+
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
         # index += 1
@@ -555,7 +752,7 @@ class lmdbDataset_realCOCOText(Dataset):
         return img_HR, img_lr, label_str, impath
 
 
-class lmdbDatasetWithW2V_real(Dataset):
+class lmdbDatasetWithW2V_real(lmdbDatasetBase):
     def __init__(
                      self,
                      root=None,
@@ -564,44 +761,25 @@ class lmdbDatasetWithW2V_real(Dataset):
                      test=False,
                      w2v_lexicons="cc.en.300.bin"
                  ):
-        super(lmdbDatasetWithW2V_real, self).__init__()
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False)
-
-        if not self.env:
-            print('cannot creat lmdb from %s' % (root))
-            sys.exit(0)
-
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get(b'num-samples'))
-            self.nSamples = nSamples
-        self.voc_type = voc_type
-        self.max_len = max_len
-        self.test = test
+        super(lmdbDatasetWithW2V_real, self).__init__(root, voc_type, max_len, test)
 
         # self.w2v_lexicon = FastText(w2v_lexicons)
 
-    def __len__(self):
-        return self.nSamples
-
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index += 1
-        txn = self.env.begin(write=False)
-        label_key = b'label-%09d' % index
+        key = self.key(index)
+        txn = self.txn
+        label_key = b'label-%09d' % key
         word = str(txn.get(label_key).decode())
-        img_HR_key = b'image_hr-%09d' % index  # 128*32
-        img_lr_key = b'image_lr-%09d' % index  # 64*16
+        if len(word) > self.max_len:
+            return self.skip(index)
+        img_HR_key = b'image_hr-%09d' % key  # 128*32
+        img_lr_key = b'image_lr-%09d' % key  # 64*16
         try:
             img_HR = buf2PIL(txn, img_HR_key, 'RGB')
             img_lr = buf2PIL(txn, img_lr_key, 'RGB')
-        except IOError or len(word) > self.max_len:
-            return self[index + 1]
+        except IOError:
+            return self.skip(index)
         label_str = str_filt(word, self.voc_type)
 
         # print("HR, LR:", img_HR.size, img_lr.size)
@@ -611,6 +789,93 @@ class lmdbDatasetWithW2V_real(Dataset):
         return img_HR, img_lr, label_str, w2v
 
 
+SHARD_META = 'shards.json'
+
+
+def is_shard_dir(root):
+    return os.path.isfile(os.path.join(root, SHARD_META))
+
+
+class memmapDataset_real(Dataset):
+    """
+    TextZoom pairs stored as pre-decoded uint8 shards (see dataset/create_shards.py).
+    Images are read with np.load(mmap_mode='r'), nothing is decoded. With
+    to_pil=False the samples are returned as read-only HxWx3 array views.
+    """
+    def __init__(self, root=None, voc_type='upper', max_len=100, test=False, to_pil=True):
+        super(memmapDataset_real, self).__init__()
+        with open(os.path.join(root, SHARD_META), 'r') as f:
+            meta = json.load(f)
+
+        self.root = root
+        self.shard_size = meta['shard_size']
+        self.nSamples = meta['num_samples']
+        self.hr_size = tuple(meta['hr_size'])
+        self.lr_size = tuple(meta['lr_size'])
+
+        def load(key):
+            return [np.load(os.path.join(root, meta[key] % i), mmap_mode='r') for i in range(meta['num_shards'])]
+
+        self.hr_shards = load('hr')
+        self.lr_shards = load('lr')
+        self.text_shards = load('text')
+        self.offset_shards = load('offset')
+
+        print("We have ", self.nSamples, "samples...")
+
+        self.voc_type = voc_type
+        self.max_len = max_len
+        self.test = test
+        self.to_pil = to_pil
+
+    def __len__(self):
+        return self.nSamples
+
+    def get_label(self, index):
+        shard, idx = divmod(index, self.shard_size)
+        offset = self.offset_shards[shard]
+        return self.text_shards[shard][offset[idx]:offset[idx + 1]].tobytes().decode()
+
+    def __getitem__(self, index):
+        assert index < len(self), 'index range error'
+        shard, idx = divmod(index, self.shard_size)
+        img_HR = self.hr_shards[shard][idx]
+        img_lr = self.lr_shards[shard][idx]
+        if self.to_pil:
+            img_HR = Image.fromarray(img_HR)
+            img_lr = Image.fromarray(img_lr)
+        label_str = str_filt(self.get_label(index), self.voc_type)
+        return img_HR, img_lr, label_str
+
+
+
+def binarize_mask(images):
+    """
+    The --mask channel of a batch with tensor ops, on whatever device images live:
+    the PIL 'L' grayscale of every image, 0 where it is above the image mean and 255 elsewhere.
+    Same result as img.convert('L').point(lambda x: 0 if x > mean else 255).
+    images: uint8 valued [N, 3, H, W] or [3, H, W], returns uint8 [N, 1, H, W] or [1, H, W]
+    """
+    single = images.dim() == 3
+    if single:
+        images = images.unsqueeze(0)
+    rgb = images.to(torch.int32)
+    # ITU-R 601-2 luma in the fixed point arithmetic of PIL
+    gray = (rgb[:, 0] * 19595 + rgb[:, 1] * 38470 + rgb[:, 2] * 7471 + 0x8000) >> 16
+    # x > sum / n  <=>  x * n > sum, exact in integers
+    num_pixels = gray.shape[-2] * gray.shape[-1]
+    total = gray.sum((1, 2), keepdim=True, dtype=torch.int64)
+    mask = (gray.to(torch.int64) * num_pixels <= total).to(torch.uint8).mul_(255).unsqueeze(1)
+    return mask[0] if single else mask
+
+
+def get_mask_tensor(img):
+    # float [1, H, W] mask of a PIL image, as ToTensor gives it
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    mask = binarize_mask(torch.from_numpy(np.array(img)).permute(2, 0, 1))
+    return mask.float().div_(255.)
+
 
 class resizeNormalize(object):
     def __init__(self, size, mask=False, interpolation=Image.BICUBIC):
@@ -623,11 +888,7 @@ class resizeNormalize(object):
         img = img.resize(self.size, self.interpolation)
         img_tensor = self.toTensor(img)
         if self.mask:
-            mask = img.convert('L')
-            thres = np.array(mask).mean()
-            mask = mask.point(lambda x: 0 if x > thres else 255)
-            mask = self.toTensor(mask)
-            img_tensor = torch.cat((img_tensor, mask), 0)
+            img_tensor = torch.cat((img_tensor, get_mask_tensor(img)), 0)
 
         return img_tensor
 
@@ -643,11 +904,7 @@ class Normalize(object):
         # img = img.resize(self.size, self.interpolation)
         img_tensor = self.toTensor(img)
         if self.mask:
-            mask = img.convert('L')
-            thres = np.array(mask).mean()
-            mask = mask.point(lambda x: 0 if x > thres else 255)
-            mask = self.toTensor(mask)
-            img_tensor = torch.cat((img_tensor, mask), 0)
+            img_tensor = torch.cat((img_tensor, get_mask_tensor(img)), 0)
 
         return img_tensor
 
@@ -677,11 +934,7 @@ class resizeNormalizeRandomCrop(object):
             img_tensor = self.toTensor(img)
 
         if self.mask:
-            mask = img.convert('L')
-            thres = np.array(mask).mean()
-            mask = mask.point(lambda x: 0 if x > thres else 255)
-            mask = self.toTensor(mask)
-            img_tensor = torch.cat((img_tensor, mask), 0)
+            img_tensor = torch.cat((img_tensor, get_mask_tensor(img)), 0)
 
         return img_tensor
 
@@ -723,18 +976,15 @@ class resizeNormalizeKeepRatio(object):
                 pass
 
         if self.mask:
-            mask = img.convert('L')
-            thres = np.array(mask).mean()
-            mask = mask.point(lambda x: 0 if x > thres else 255)
+            mask = get_mask_tensor(img)
             if re_w > self.size[0]:
                 # img = img.resize(self.size, self.interpolation)
 
-                re_mask_cpy = np.ones((mask.size[1], mask.size[0]))
+                re_mask_cpy = np.ones((mask.shape[1], mask.shape[2]))
 
-                mask = self.toTensor(mask)
                 img_tensor = torch.cat((img_tensor, mask), 0).float()
             else:
-                mask = np.array(mask)
+                mask = (mask[0] * 255).byte().numpy()
                 mask = cv2.resize(mask, (re_w, re_h), cv2.INTER_NEAREST)
                 shift_w = int((self.size[0] - mask.shape[1]) / 2)
 
@@ -763,49 +1013,85 @@ class resizeNormalizeKeepRatio(object):
         return img_tensor, torch.tensor(cv2.resize(re_mask_cpy, (self.size[0] * 2, self.size[1] * 2), cv2.INTER_NEAREST)).float()
 
 
-class lmdbDataset_mix(Dataset):
-    def __init__(self, root=None, voc_type='upper', max_len=100, test=False):
-        super(lmdbDataset_mix, self).__init__()
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False)
+class resizeNormalizeBatch(object):
+    """
+    resizeNormalize for a whole batch: decoded uint8 HxWx3 images (PIL images or arrays) in,
+    a [N, C, H, W] float tensor out. Images of the same size are stacked into a preallocated
+    uint8 buffer and resized together with one bicubic F.interpolate (antialiased like PIL
+    when shrinking); images already at the target size are only copied. Sizes with fewer
+    than min_group images are resized one by one with PIL, which is faster for them.
+    """
+    def __init__(self, size, mask=False, min_group=4, max_buffers=8):
+        self.size = size
+        self.mask = mask
+        self.min_group = min_group
+        # input shape -> uint8 [n, h, w, 3], grown when a larger group arrives. Least recently
+        # used first, only max_buffers shapes are kept: real LR sizes hardly repeat
+        self.buffers = collections.OrderedDict()
+        self.max_buffers = max_buffers
+
+    def buffer(self, shape, n):
+        buf = self.buffers.pop(shape, None)
+        if buf is None or buf.shape[0] < n:
+            buf = np.empty((n,) + shape, dtype=np.uint8)
+        self.buffers[shape] = buf
+        while len(self.buffers) > self.max_buffers:
+            self.buffers.popitem(last=False)
+        return buf[:n]
+
+    def __call__(self, images):
+        w, h = self.size
+        arrays = [np.asarray(image) for image in images]
+        groups = collections.defaultdict(list)
+        for i, array in enumerate(arrays):
+            groups[array.shape].append(i)
+
+        batch = torch.empty((len(arrays), 3, h, w))
+        for shape, indices in groups.items():
+            if shape[:2] != (h, w) and len(indices) < self.min_group:
+                buf = self.buffer((h, w, 3), len(indices))
+                for k, i in enumerate(indices):
+                    buf[k] = np.asarray(Image.fromarray(arrays[i]).resize(self.size, Image.BICUBIC))
+                shape = buf.shape[1:]
+            else:
+                buf = self.buffer(shape, len(indices))
+                np.stack([arrays[i] for i in indices], out=buf)
+            group = torch.from_numpy(buf).permute(0, 3, 1, 2).float()
+            if shape[:2] != (h, w):
+                # back to the uint8 grid a PIL resize would give
+                group = F.interpolate(group, (h, w), mode='bicubic', align_corners=False, antialias=True)
+                group = group.round_().clamp_(0, 255)
+            batch[torch.tensor(indices)] = group
 
-        if not self.env:
-            print('cannot creat lmdb from %s' % (root))
-            sys.exit(0)
+        if self.mask:
+            batch = torch.cat((batch, binarize_mask(batch).float()), 1)
+        return batch.div_(255.)
 
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get(b'num-samples'))
-            self.nSamples = nSamples
-        self.voc_type = voc_type
-        self.max_len = max_len
-        self.test = test
 
-    def __len__(self):
-        return self.nSamples
+class lmdbDataset_mix(lmdbDatasetBase):
+    def __init__(self, root=None, voc_type='upper', max_len=100, test=False, lr_prob=0.5):
+        super(lmdbDataset_mix, self).__init__(root, voc_type, max_len, test)
+        # training: probability of the real LR image, the HR one is returned otherwise
+        self.lr_prob = lr_prob
 
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index += 1
-        txn = self.env.begin(write=False)
-        label_key = b'label-%09d' % index
+        key = self.key(index)
+        txn = self.txn
+        label_key = b'label-%09d' % key
         word = str(txn.get(label_key).decode())
         if self.test:
             try:
-                img_HR = buf2PIL(txn, b'image_hr-%09d' % index, 'RGB')
-                img_lr = buf2PIL(txn, b'image_lr-%09d' % index, 'RGB')
+                img_HR = buf2PIL(txn, b'image_hr-%09d' % key, 'RGB')
+                img_lr = buf2PIL(txn, b'image_lr-%09d' % key, 'RGB')
             except:
-                img_HR = buf2PIL(txn, b'image-%09d' % index, 'RGB')
+                img_HR = buf2PIL(txn, b'image-%09d' % key, 'RGB')
                 img_lr = img_HR
 
         else:
-            img_HR = buf2PIL(txn, b'image_hr-%09d' % index, 'RGB')
-            if random.uniform(0, 1) < 0.5:
-                img_lr = buf2PIL(txn, b'image_lr-%09d' % index, 'RGB')
+            img_HR = buf2PIL(txn, b'image_hr-%09d' % key, 'RGB')
+            if random.uniform(0, 1) < self.lr_prob:
+                img_lr = buf2PIL(txn, b'image_lr-%09d' % key, 'RGB')
             else:
                 img_lr = img_HR
 
@@ -813,30 +1099,9 @@ class lmdbDataset_mix(Dataset):
         return img_HR, img_lr, label_str
 
 
-class lmdbDatasetWithMask_real(Dataset):
+class lmdbDatasetWithMask_real(lmdbDatasetBase):
     def __init__(self, root=None, voc_type='upper', max_len=100, test=False):
-        super(lmdbDatasetWithMask_real, self).__init__()
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False)
-
-        if not self.env:
-            print('cannot creat lmdb from %s' % (root))
-            sys.exit(0)
-
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get(b'num-samples'))
-            self.nSamples = nSamples
-        self.voc_type = voc_type
-        self.max_len = max_len
-        self.test = test
-
-    def __len__(self):
-        return self.nSamples
+        super(lmdbDatasetWithMask_real, self).__init__(root, voc_type, max_len, test)
 
     def get_mask(self, image):
 
@@ -853,17 +1118,19 @@ class lmdbDatasetWithMask_real(Dataset):
 
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index += 1
-        txn = self.env.begin(write=False)
-        label_key = b'label-%09d' % index
+        key = self.key(index)
+        txn = self.txn
+        label_key = b'label-%09d' % key
         word = str(txn.get(label_key).decode())
-        img_HR_key = b'image_hr-%09d' % index  # 128*32
-        img_lr_key = b'image_lr-%09d' % index  # 64*16
+        if len(word) > self.max_len:
+            return self.skip(index)
+        img_HR_key = b'image_hr-%09d' % key  # 128*32
+        img_lr_key = b'image_lr-%09d' % key  # 64*16
         try:
             img_HR = buf2PIL(txn, img_HR_key, 'RGB')
             img_lr = buf2PIL(txn, img_lr_key, 'RGB')
-        except IOError or len(word) > self.max_len:
-            return self[index + 1]
+        except IOError:
+            return self.skip(index)
         label_str = str_filt(word, self.voc_type)
 
         weighted_mask = self.get_mask(img_HR)
@@ -872,6 +1139,86 @@ class lmdbDatasetWithMask_real(Dataset):
 
 
 
+class weightedMixSampler(sampler.Sampler):
+    """
+    Epochs of num_samples indices into a ConcatDataset of the given source sizes, source i
+    getting a weights[i] share of them. Sources are drawn without replacement and only
+    repeated once exhausted. The draw of an epoch depends only on (seed, epoch); the epoch
+    advances by one per iteration unless set with set_epoch. With num_replicas > 1 every
+    replica draws the same epoch and takes every num_replicas-th index from rank on.
+    """
+    def __init__(self, sizes, weights=None, num_samples=None, seed=0, num_replicas=1, rank=0):
+        self.sizes = [int(size) for size in sizes]
+        weights = np.array(self.sizes if weights is None or len(weights) == 0 else weights, dtype=np.float64)
+        assert len(weights) == len(self.sizes), 'one weight per source'
+        self.weights = weights / weights.sum()
+        self.num_samples = int(num_samples) if num_samples else sum(self.sizes)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)[:-1]]).astype(np.int64)
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        # largest remainder rounding of the per-source counts
+        exact = self.weights * self.num_samples
+        self.counts = np.floor(exact).astype(np.int64)
+        for i in np.argsort(self.counts - exact)[:self.num_samples - self.counts.sum()]:
+            self.counts[i] += 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 1000003 + self.epoch)
+        self.epoch += 1
+        picks = []
+        for size, count, offset in zip(self.sizes, self.counts, self.offsets):
+            if count == 0 or size == 0:
+                continue
+            rounds = [torch.randperm(size, generator=generator) for _ in range((count + size - 1) // size)]
+            picks.append(torch.cat(rounds)[:count] + int(offset))
+        picks = torch.cat(picks)
+        picks = picks[torch.randperm(len(picks), generator=generator)]
+        if self.num_replicas > 1:
+            picks = picks[:len(self) * self.num_replicas][self.rank::self.num_replicas]
+        return iter(picks.tolist())
+
+    def __len__(self):
+        return self.num_samples // self.num_replicas
+
+
+class skipSampler(sampler.Sampler):
+    """
+    Wraps a sampler or batch sampler, its next iteration leaves out the first skip_batches(n)
+    batches, for --resume_train in the middle of an epoch. batch_size: indices per batch,
+    1 for a batch sampler. The length stays that of the full epoch.
+    """
+    def __init__(self, sampler, batch_size=1):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.skip = 0
+
+    def skip_batches(self, num_batches):
+        self.skip = num_batches * self.batch_size
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        return itertools.islice(iter(self.sampler), skip, None)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def seed_worker(worker_id):
+    # the DataLoader seeds torch and random of every worker, numpy would keep the forked state
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
 class randomSequentialSampler(sampler.Sampler):
 
     def __init__(self, data_source, batch_size):
@@ -898,6 +1245,63 @@ class randomSequentialSampler(sampler.Sampler):
         return self.num_samples
 
 
+def image_sizes(data_source):
+    """(w, h) of every sample, read from the image headers where the dataset supports it."""
+    if isinstance(data_source, ConcatDataset):
+        return [size for d in data_source.datasets for size in image_sizes(d)]
+    if hasattr(data_source, 'image_size'):
+        return [data_source.image_size(i) for i in range(len(data_source))]
+    return [data_source[i][1].size for i in range(len(data_source))]
+
+
+class bucketBatchSampler(sampler.Sampler):
+    """
+    Batches of samples with (nearly) the same LR size, for --random_reso.
+    Heights and aspect ratios are binned on a log scale with steps of (1 + tol),
+    tol=0 groups equal sizes only. sizes: (w, h) per sample, see image_sizes.
+    The batches are shuffled from (seed, epoch), not the global RNG, so that every replica
+    draws the same ones and a resumed run the ones of the run it continues. With
+    num_replicas > 1 they are split between the replicas.
+    """
+    def __init__(self, sizes, batch_size, tol=0.1, shuffle=False, num_replicas=1, rank=0, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        buckets = collections.OrderedDict()
+        for index, (w, h) in enumerate(sizes):
+            if tol > 0:
+                key = (int(round(np.log(h) / np.log1p(tol))), int(round(np.log(float(w) / h) / np.log1p(tol))))
+            else:
+                key = (h, w)
+            buckets.setdefault(key, []).append(index)
+        self.buckets = list(buckets.values())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 1000003 + self.epoch)
+        self.epoch += 1
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = [bucket[i] for i in torch.randperm(len(bucket), generator=generator).tolist()]
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            batches = batches[:len(self) * self.num_replicas][self.rank::self.num_replicas]
+        return iter(batches)
+
+    def __len__(self):
+        num_batches = sum((len(bucket) + self.batch_size - 1) // self.batch_size for bucket in self.buckets)
+        return num_batches // self.num_replicas
+
+
 class alignCollate_syn(object):
     def __init__(self, imgH=64,
                  imgW=256,
@@ -906,7 +1310,8 @@ class alignCollate_syn(object):
                  min_ratio=1,
                  mask=False,
                  alphabet=53,
-                 train=True
+                 train=True,
+                 degrade=None
                  ):
         self.imgH = imgH
         self.imgW = imgW
@@ -928,8 +1333,44 @@ class alignCollate_syn(object):
 
         self.transform = resizeNormalize((imgW, imgH), self.mask)
         self.transform2 = resizeNormalize((imgW // self.down_sample_scale, imgH // self.down_sample_scale), self.mask)
+        self.transform_batch = resizeNormalizeBatch((imgW, imgH), self.mask)
+        self.transform2_batch = resizeNormalizeBatch((imgW // self.down_sample_scale, imgH // self.down_sample_scale),
+                                                     self.mask)
+        # byte -> label id, -1 for characters outside d2a
+        self.a2d_table = np.full(256, -1, dtype=np.int64)
+        for ch, idx in self.a2d.items():
+            self.a2d_table[ord(ch)] = idx
 
         self.train = train
+        # dataset.degradation.BatchDegradation, synthesizes the LR from the HR if given
+        self.degrade = degrade
+
+    def degrade_lr(self, images_hr):
+        # LR of collated HR images [N, C, H, W], with its own mask channel
+        size = (self.imgH // self.down_sample_scale, self.imgW // self.down_sample_scale)
+        images_lr = self.degrade(images_hr[:, :3, :, :], size)
+        if self.mask:
+            # the 8 bit levels of the LR, as the PIL mask of the decoded image sees them
+            images_lr = torch.cat((images_lr, binarize_mask((images_lr * 255.).round()).float() / 255.), 1)
+        return images_lr
+
+    def label_ids(self, word):
+        # [self.a2d[ch] for ch in word if ch in self.a2d] as an array
+        ids = self.a2d_table[np.frombuffer(word.encode(), dtype=np.uint8)]
+        return ids[ids >= 0]
+
+    def label_onehot(self, label_ids, max_len):
+        """
+        One-hot text labels [N, alsize, 1, max_len] of N id arrays, filled by a single scatter.
+        """
+        lengths = torch.tensor([len(ids) for ids in label_ids])
+        ids = torch.from_numpy(np.concatenate(label_ids)).long()
+        starts = torch.cumsum(lengths, 0) - lengths
+        positions = torch.arange(len(ids)) - torch.repeat_interleave(starts, lengths)
+        rows = torch.repeat_interleave(torch.arange(len(label_ids)), lengths) * max_len + positions
+        label_rebatches = torch.zeros((len(label_ids), max_len, self.alsize))
+        label_rebatches.view(-1).scatter_(0, rows * self.alsize + ids, 1.)
+        return label_rebatches.unsqueeze(1).permute(0, 3, 1, 2)
 
     def degradation(self, img_L):
         # degradation process, blur + bicubic downsampling + Gaussian noise
@@ -937,7 +1378,7 @@ class alignCollate_syn(object):
         # img_L = util.modcrop(img_L, sf)
         img_L = np.array(img_L)
         # print("img_L_before:", img_L.shape, np.unique(img_L))
-        img_L = sr.srmd_degradation(img_L, kernel)
+        img_L = sr.srmd_degradation(img_L, default_blur_kernel())
 
         noise_level_img = 0.
         if not self.train:
@@ -952,6 +1393,10 @@ class alignCollate_syn(object):
     def __call__(self, batch):
         images, _, label_strs, identity = zip(*batch)
 
+        if self.degrade is not None:
+            images_hr = self.transform_batch(images)
+            return images_hr, self.degrade_lr(images_hr), label_strs, identity
+
         # [self.degradation(image) for image in images]
         # images_hr = images
         '''
@@ -1032,7 +1477,7 @@ class alignCollate_syn_random_reso(object):
         # img_L = util.modcrop(img_L, sf)
         img_L = np.array(img_L)
         # print("img_L_before:", img_L.shape, np.unique(img_L))
-        img_L = sr.srmd_degradation(img_L, kernel)
+        img_L = sr.srmd_degradation(img_L, default_blur_kernel())
 
         noise_level_img = 0.
         if not self.train:
@@ -1089,6 +1534,25 @@ class alignCollate_syn_random_reso(object):
         return images_hr, images_lr, label_strs, identity
 
 
+class alignCollate_syn_bucket(alignCollate_syn_random_reso):
+    """
+    alignCollate_syn_random_reso for the batches of bucketBatchSampler: the images are
+    resized to the mean size of the batch and stacked, LR [N, C, h, w] and HR [N, C, 2h, 2w].
+    """
+    def __call__(self, batch):
+        images, _, label_strs, identity = zip(*batch)
+        images = [image.convert('RGB') for image in images]
+
+        w, h = np.round(np.mean([image.size for image in images], 0)).astype(int)
+        images_lr = [image if image.size == (w, h) else image.resize((w, h), Image.BICUBIC) for image in images]
+        images_hr = [image.resize((w * 2, h * 2), Image.BICUBIC) for image in images]
+
+        images_hr = torch.stack([self.transform(image) for image in images_hr], 0)
+        images_lr = torch.stack([self.transform2(image) for image in images_lr], 0)
+
+        return images_hr, images_lr, label_strs, identity
+
+
 class alignCollate_syn_withcrop(object):
     def __init__(self, imgH=64,
                  imgW=256,
@@ -1137,38 +1601,45 @@ class alignCollate_syn_withcrop(object):
 
 
 class alignCollate_real(alignCollate_syn):
+    batched = True
+
     def __call__(self, batch):
         images_HR, images_lr, label_strs, _ = zip(*batch)
-        imgH = self.imgH
-        imgW = self.imgW
-        transform = resizeNormalize((imgW, imgH), self.mask)
-        transform2 = resizeNormalize((imgW // self.down_sample_scale, imgH // self.down_sample_scale), self.mask)
-        images_HR = [transform(image) for image in images_HR]
-        images_HR = torch.cat([t.unsqueeze(0) for t in images_HR], 0)
-
-        images_lr = [transform2(image) for image in images_lr]
-        images_lr = torch.cat([t.unsqueeze(0) for t in images_lr], 0)
+        images_HR = self.transform_batch(images_HR)
+        images_lr = self.transform2_batch(images_lr)
 
         return images_HR, images_lr, label_strs, _
 
 
-class alignCollate_realWTL(alignCollate_syn):
+class alignCollate_mix(alignCollate_syn):
+    """
+    For lmdbDataset_mix, which hands out the HR image itself as LR for about half of the samples.
+    The LR of those samples is the resized HR, or is synthesized by self.degrade if given.
+    """
+    batched = True
+
     def __call__(self, batch):
         images_HR, images_lr, label_strs = zip(*batch)
-        imgH = self.imgH
-        imgW = self.imgW
-        # transform = resizeNormalize((imgW, imgH), self.mask)
-        # transform2 = resizeNormalize((imgW // self.down_sample_scale, imgH // self.down_sample_scale), self.mask)
-        images_HR = [self.transform(image) for image in images_HR]
-        images_HR = torch.cat([t.unsqueeze(0) for t in images_HR], 0)
+        syn = [i for i in range(len(batch)) if images_lr[i] is images_HR[i]]
+        images_HR = self.transform_batch(images_HR)
+        images_lr = self.transform2_batch(images_lr)
+        if self.degrade is not None and len(syn) > 0:
+            syn = torch.tensor(syn)
+            images_lr[syn] = self.degrade_lr(images_HR[syn])
 
-        images_lr = [self.transform2(image) for image in images_lr]
-        images_lr = torch.cat([t.unsqueeze(0) for t in images_lr], 0)
+        return images_HR, images_lr, label_strs
 
-        max_len = 0
 
-        label_batches = []
+class alignCollate_realWTL(alignCollate_syn):
+    batched = True
 
+    def __call__(self, batch):
+        images_HR, images_lr, label_strs = zip(*batch)
+        images_HR = self.transform_batch(images_HR)
+        images_lr = self.transform2_batch(images_lr)
+
+        max_len = 0
+        label_ids = []
         for word in label_strs:
             word = word.lower()
             # Complement
@@ -1178,52 +1649,17 @@ class alignCollate_realWTL(alignCollate_syn):
                 word[2] = "e"
                 word = "".join(word)
 
-            if len(word) <= 1:
-                pass
-            elif len(word) < 26 and len(word) > 1:
-                inter_com = 26 - len(word)
-                # padding = int(inter_com / (len(word) - 1))
-                # new_word = word[0]
-                # for i in range(len(word) - 1):
-                #    new_word += "-" * padding + word[i+1]
-
-                # word = new_word
-                pass
-            else:
-                word = word[:26]
+            word = word[:26]
+            max_len = max(max_len, len(word))
+            label_ids.append(self.label_ids(word))
 
-            label_list = [self.a2d[ch] for ch in word if ch in self.a2d]
-
-            # shifting:
-            # if len(label_list) > 2:
-                #     if label_list[-1] > 0 and label_list[-1] < self.alsize - 1:
-            #     label_list[-1] = 0
-
-            word_len = len(word)
-            if word_len > max_len:
-                max_len = word_len
-            # print("label_list:", word, label_list)
-            labels = torch.tensor(label_list)[:, None].long()
-            label_vecs = torch.zeros((labels.shape[0], self.alsize))
-            # print("labels:", labels)
-            if labels.shape[0] > 0:
-                label_batches.append(label_vecs.scatter_(-1, labels, 1))
-            else:
-                label_batches.append(label_vecs)
-        label_rebatches = torch.zeros((len(label_strs), max_len, self.alsize))
-
-        for idx in range(len(label_strs)):
-            label_rebatches[idx][:label_batches[idx].shape[0]] = label_batches[idx]
-
-        label_rebatches = label_rebatches.unsqueeze(1).float().permute(0, 3, 1, 2)
-        # noise = (torch.rand(label_rebatches.shape) - 0.5) * 0.2
-
-        # label_rebatches#  += noise
+        label_rebatches = self.label_onehot(label_ids, max_len)
 
         return images_HR, images_lr, label_strs, label_rebatches
 
 
 class alignCollate_realWTLAMask(alignCollate_syn):
+    batched = True
 
     def get_mask(self, image):
         img_hr = np.transpose(image.data.numpy() * 255, (1, 2, 0))
@@ -1238,89 +1674,28 @@ class alignCollate_realWTLAMask(alignCollate_syn):
 
     def __call__(self, batch):
         images_HR, images_lr, label_strs = zip(*batch)
-        imgH = self.imgH
-        imgW = self.imgW
-        # transform = resizeNormalize((imgW, imgH), self.mask)
-        # transform2 = resizeNormalize((imgW // self.down_sample_scale, imgH // self.down_sample_scale), self.mask)
-        images_HR = [self.transform(image) for image in images_HR]
-        images_HR = torch.cat([t.unsqueeze(0) for t in images_HR], 0)
-
-        images_lr = [self.transform2(image) for image in images_lr]
-        images_lr = torch.cat([t.unsqueeze(0) for t in images_lr], 0)
+        images_HR = self.transform_batch(images_HR)
+        images_lr = self.transform2_batch(images_lr)
 
         # weighted_masks = [self.get_mask(image_HR) for image_HR in images_HR]
         # weighted_masks = torch.cat([t.unsqueeze(0) for t in weighted_masks], 0)
 
-        # print("weighted_masks:", weighted_masks.shape, np.unique(weighted_masks))
-        max_len = 0
-
-        label_batches = []
-        weighted_masks = []
+        max_len = 1
+        label_ids = []
         weighted_tics = []
-
         for word in label_strs:
-            word = word.lower()
-            # Complement
-
-            if len(word) > 4:
-                # word = [ch for ch in word]
-                # word[2] = "e"
-                # word = "".join(word)
-                pass
-            if len(word) <= 1:
-                pass
-            elif len(word) < 15 and len(word) > 1:
-                # inter_com = 26 - len(word)
-                # padding = int(inter_com / (len(word) - 1))
-                # new_word = word[0]
-                # for i in range(len(word) - 1):
-                #     new_word += "-" * padding + word[i+1]
-
-                # word = new_word
-                pass
-            else:
-                word = word[:15]
-
-            label_list = [self.a2d[ch] for ch in word if ch in self.a2d]
-
-            if len(label_list) <= 0:
-                # blank label
-                weighted_masks.append(0)
-            else:
-                weighted_masks.extend(label_list)
-
-            word_len = len(word)
-            if word_len > max_len:
-                max_len = word_len
-            # print("label_list:", word, label_list)
-            labels = torch.tensor(label_list)[:, None].long()
-
-            # print("labels:", labels)
-
-            if labels.shape[0] > 0:
-                label_vecs = torch.zeros((labels.shape[0], self.alsize))
-                # print(label_vecs.scatter_(-1, labels, 1))
-                label_batches.append(label_vecs.scatter_(-1, labels, 1))
-                weighted_tics.append(1)
-            else:
-                label_vecs = torch.zeros((1, self.alsize))
-                # Assign a blank label
-                label_vecs[0, 0] = 1.
-                label_batches.append(label_vecs)
-                weighted_tics.append(0)
-        label_rebatches = torch.zeros((len(label_strs), max_len, self.alsize))
-
-        for idx in range(len(label_strs)):
-            label_rebatches[idx][:label_batches[idx].shape[0]] = label_batches[idx]
-
-        label_rebatches = label_rebatches.unsqueeze(1).float().permute(0, 3, 1, 2)
-        # noise = (torch.rand(label_rebatches.shape) - 0.5) * 0.2
-
-        # label_rebatches += noise
+            word = word.lower()[:15]
+            max_len = max(max_len, len(word))
+            ids = self.label_ids(word)
+            weighted_tics.append(int(len(ids) > 0))
+            # a word without known characters gets one blank label
+            label_ids.append(ids if len(ids) > 0 else np.zeros(1, dtype=np.int64))
 
-        # print("images_HR:", images_HR.shape, images_lr.shape)
+        label_rebatches = self.label_onehot(label_ids, max_len)
+        # the label ids of the whole batch, one-hot positions of label_rebatches
+        weighted_masks = torch.from_numpy(np.concatenate(label_ids)).long()
 
-        return images_HR, images_lr, label_strs, label_rebatches, torch.tensor(weighted_masks).long(), torch.tensor(weighted_tics)
+        return images_HR, images_lr, label_strs, label_rebatches, weighted_masks, torch.tensor(weighted_tics)
 
 
 import random
@@ -1505,16 +1880,19 @@ class ConcatDataset(Dataset):
         assert len(datasets) > 0, 'datasets should not be an empty iterable'
         self.datasets = list(datasets)
         self.cumulative_sizes = self.cumsum(self.datasets)
+        # O(1) lookup: dataset of every global index and the first global index of every dataset
+        self.dataset_ids = np.repeat(np.arange(len(self.datasets), dtype=np.int32 if len(self.datasets) > 255 else np.uint8),
+                                     [len(d) for d in self.datasets])
+        self.offsets = [0] + self.cumulative_sizes[:-1]
 
     def __len__(self):
         return self.cumulative_sizes[-1]
 
     def __getitem__(self, idx):
-        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
-        if dataset_idx == 0:
-            sample_idx = idx
-        else:
-            sample_idx = idx - self.cumulative_sizes[dataset_idx - 1]
+        if idx < 0:
+            idx += len(self)
+        dataset_idx = int(self.dataset_ids[idx])
+        sample_idx = idx - self.offsets[dataset_idx]
         return self.datasets[dataset_idx][sample_idx]
 
     @property
@@ -1524,6 +1902,109 @@ class ConcatDataset(Dataset):
         return self.cumulative_sizes
 
 
+IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp']
+
+
+class inferDataset(Dataset):
+    """
+    Unlabeled LR crops for batch inference, from
+        an LMDB (image_lr-%09d keys of TextZoom, or image-%09d of create_lmdb.py),
+        a directory of images, or a glob pattern.
+    Returns (img_lr, name, label), label is '' when the source has none.
+    """
+    def __init__(self, root):
+        super(inferDataset, self).__init__()
+        self.root = root
+        self.lmdb_data = None
+        self.path_list = []
+
+        if os.path.isdir(root) and os.path.isfile(os.path.join(root, 'data.mdb')):
+            self.lmdb_data = lmdbDatasetBase(root)
+            txn = self.lmdb_data.txn
+            self.img_key = 'image_lr-%09d' if txn.get(b'image_lr-%09d' % 1) is not None else 'image-%09d'
+            self.nSamples = len(self.lmdb_data)
+        else:
+            if os.path.isdir(root):
+                path_list = [os.path.join(root, name) for name in os.listdir(root)]
+            else:
+                path_list = glob.glob(root)
+            self.path_list = sorted([path for path in path_list
+                                     if os.path.splitext(path)[1].lower() in IMG_EXTENSIONS])
+            self.nSamples = len(self.path_list)
+        print("Collect", self.nSamples, "images from", root)
+
+    def __len__(self):
+        return self.nSamples
+
+    def __getitem__(self, index):
+        label = ''
+        if self.lmdb_data is not None:
+            # the sidecar index may leave samples out, key maps to the LMDB record
+            key = self.lmdb_data.key(index)
+            name = '%09d' % key
+        else:
+            name = self.path_list[index]
+        try:
+            if self.lmdb_data is not None:
+                txn = self.lmdb_data.txn
+                img_lr = buf2PIL(txn, (self.img_key % key).encode(), 'RGB')
+                label = txn.get(b'label-%09d' % key)
+                label = label.decode() if label is not None else ''
+            else:
+                img_lr = Image.open(name).convert('RGB')
+        except (IOError, TypeError):
+            print("Cannot read", name, "from", self.root)
+            img_lr = None
+        return img_lr, name, label
+
+
+class alignCollate_infer(object):
+    """
+    Resizes the LR crops of inferDataset to the LR input size of training.
+    Unreadable samples are dropped from the batch.
+    """
+    def __init__(self, imgH=32, imgW=128, down_sample_scale=2, mask=False):
+        self.transform2 = resizeNormalize((imgW // down_sample_scale, imgH // down_sample_scale), mask)
+
+    def __call__(self, batch):
+        batch = [sample for sample in batch if sample[0] is not None]
+        if len(batch) == 0:
+            return None, [], []
+        images_lr, names, labels = zip(*batch)
+        images_lr = torch.stack([self.transform2(image) for image in images_lr], 0)
+        return images_lr, list(names), list(labels)
+
+
+class indexedDataset(Dataset):
+    """
+    Returns (sample, index), used with alignCollate_withIndex when a batch has to
+    know which samples it holds (e.g. for the teacher prior cache).
+    """
+    def __init__(self, dataset):
+        super(indexedDataset, self).__init__()
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset[index], index
+
+
+class alignCollate_withIndex(object):
+    """
+    Collates the samples of an indexedDataset with the wrapped collate and
+    appends the LongTensor of sample indices to its outputs.
+    """
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __call__(self, batch):
+        samples, indices = zip(*batch)
+        collated = self.collate(list(samples))
+        return tuple(collated) + (torch.tensor(indices).long(),)
+
+
 if __name__ == '__main__':
     # embed(header='dataset.py')
 
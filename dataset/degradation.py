@@ -0,0 +1,198 @@
+import os
+import json
+import random
+import collections
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision.io import encode_jpeg, decode_jpeg
+
+from utils import utils_sisr as sr
+from utils import utils_deblur
+
+
+"""
+Batched synthesis of LR images from HR images for --syn / --mixed training.
+
+Every image of a batch gets its own blur kernel, drawn from a bank built once,
+and all images are blurred by a single grouped conv2d. The batch is then bicubic
+downsampled, Gaussian noise of a random level is added and, optionally, a random
+part of the batch is JPEG compressed. Everything but the JPEG step runs on the
+device of the input. Parameters come from TRAIN.DEGRADATION of the YAML config.
+
+The kernel bank is stored in one .npy file (TRAIN.DEGRADATION.bank) next to a .json
+with the parameters it was generated with. It is built on the first run, memory-mapped
+afterwards, and rebuilt only when the parameters change.
+"""
+
+KERNEL_FAMILIES = ['isotropic', 'anisotropic', 'motion']
+
+
+def build_kernel_bank(kernel_size=15, kernels_per_family=200, families=KERNEL_FAMILIES, sigma=(0.2, 2.0), seed=0):
+    """
+    float32 [len(families) * kernels_per_family, kernel_size, kernel_size], every kernel sums to 1.
+    sigma is the std range of the Gaussian kernels, in HR pixels.
+    """
+    rng = np.random.RandomState(seed)
+    kernels = []
+    for family in families:
+        for _ in range(kernels_per_family):
+            if family == 'isotropic':
+                s = rng.uniform(sigma[0], sigma[1])
+                k = sr.anisotropic_Gaussian(ksize=kernel_size, theta=0., l1=s ** 2, l2=s ** 2)
+            elif family == 'anisotropic':
+                s1, s2 = rng.uniform(sigma[0], sigma[1], 2)
+                k = sr.anisotropic_Gaussian(ksize=kernel_size, theta=rng.uniform(0, np.pi),
+                                            l1=max(s1, s2) ** 2, l2=min(s1, s2) ** 2)
+            elif family == 'motion':
+                # blurkernel_synthesis draws from the global generators
+                np_state, py_state = np.random.get_state(), random.getstate()
+                np.random.seed(rng.randint(2 ** 31))
+                random.seed(rng.randint(2 ** 31))
+                k = utils_deblur.blurkernel_synthesis(h=kernel_size)
+                np.random.set_state(np_state)
+                random.setstate(py_state)
+            else:
+                raise ValueError('unknown kernel family %s' % family)
+            kernels.append(k / np.sum(k))
+    return np.stack(kernels, 0).astype(np.float32)
+
+
+class KernelBank(object):
+    """
+    Blur kernels [K, k, k] (an array or a memmap) looked up by index. Tensor copies of the
+    bank are kept per (device, dtype), the least recently used one is dropped beyond cache_size.
+    """
+    def __init__(self, kernels, families=None, cache_size=4):
+        self.kernels = kernels
+        # family -> [start, end) rows of kernels
+        self.families = families
+        self.cache_size = cache_size
+        self.copies = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.kernels)
+
+    def __getstate__(self):
+        # DataLoader workers make their own tensor copies
+        state = self.__dict__.copy()
+        state['copies'] = collections.OrderedDict()
+        return state
+
+    def tensor(self, device=torch.device('cpu'), dtype=torch.float32):
+        key = (str(device), dtype)
+        if key in self.copies:
+            self.copies.move_to_end(key)
+        else:
+            self.copies[key] = torch.from_numpy(np.array(self.kernels, dtype=np.float32)).to(device, dtype)
+            if len(self.copies) > self.cache_size:
+                self.copies.popitem(last=False)
+        return self.copies[key]
+
+    def get(self, indices, device=torch.device('cpu'), dtype=torch.float32):
+        bank = self.tensor(device, dtype)
+        return bank.index_select(0, torch.as_tensor(indices).to(bank.device))
+
+
+def open_kernel_bank(path, kernel_size=15, kernels_per_family=200, families=KERNEL_FAMILIES,
+                     sigma=(0.2, 2.0), seed=0):
+    """
+    The KernelBank stored at path (.npy), generated and saved first if missing or made
+    with other parameters.
+    """
+    meta_path = os.path.splitext(path)[0] + '.json'
+    key = {'kernel_size': int(kernel_size), 'kernels_per_family': int(kernels_per_family),
+           'families': list(families), 'sigma': [float(s) for s in sigma], 'seed': int(seed)}
+    meta = None
+    if os.path.isfile(meta_path) and os.path.isfile(path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    if meta is None or meta.get('key') != key:
+        print('Building the degradation kernel bank %s' % path)
+        kernels = build_kernel_bank(kernel_size, kernels_per_family, families, sigma, seed)
+        dir_name = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, kernels)
+        os.replace(tmp_path, path)
+        # written after the data file, a bank without it is simply rebuilt
+        with open(meta_path, 'w') as f:
+            json.dump({'key': key}, f, indent=2)
+    kernels = np.load(path, mmap_mode='r')
+    ranges = {family: [i * kernels_per_family, (i + 1) * kernels_per_family] for i, family in enumerate(families)}
+    return KernelBank(kernels, ranges)
+
+
+class BatchDegradation(object):
+    def __init__(self, kernels, blur_prob=1., noise=(0., 0.), jpeg_prob=0., jpeg_quality=(30, 95), seed=None):
+        """
+        ARGS:
+            kernels      : KernelBank, or [K, k, k] blur kernels (see build_kernel_bank)
+            blur_prob    : probability that an image is blurred
+            noise        : range of the Gaussian noise std, in 0-255 levels
+            jpeg_prob    : probability that an image is JPEG compressed
+            jpeg_quality : range of the JPEG quality
+            seed         : if given every call draws the same degradations, for validation,
+                           otherwise the generator is seeded from torch.initial_seed() of the
+                           process using it, which differs per DataLoader worker and epoch
+        """
+        self.kernels = kernels if isinstance(kernels, KernelBank) else KernelBank(np.asarray(kernels))
+        self.blur_prob = blur_prob
+        self.noise = noise
+        self.jpeg_prob = jpeg_prob
+        self.jpeg_quality = jpeg_quality
+        self.seed = seed
+        self.generator = torch.Generator()
+        # pid the generator was seeded in, the object is copied into the DataLoader workers
+        self.seeded_pid = None
+
+    def uniform(self, n, low, high):
+        return torch.rand(n, generator=self.generator) * (high - low) + low
+
+    def blur(self, images):
+        n, c, h, w = images.shape
+        picks = torch.randint(len(self.kernels), (n,), generator=self.generator)
+        # conv2d correlates, flip to convolve like ndimage.convolve
+        weight = self.kernels.get(picks, images.device, images.dtype).flip(-1, -2)
+        k = weight.shape[-1]
+        weight = weight.repeat_interleave(c, 0).unsqueeze(1)
+        # wrap around borders as srmd_degradation does
+        padded = F.pad(images.reshape(1, n * c, h, w), [k // 2] * 4, mode='circular')
+        blurred = F.conv2d(padded, weight, groups=n * c).view(n, c, h, w)
+        if self.blur_prob < 1.:
+            keep = (torch.rand(n, generator=self.generator) >= self.blur_prob).to(images.device)
+            blurred = torch.where(keep.view(-1, 1, 1, 1), images, blurred)
+        return blurred
+
+    def jpeg(self, images):
+        picks = torch.nonzero(torch.rand(len(images), generator=self.generator) < self.jpeg_prob).view(-1)
+        if len(picks) == 0:
+            return images
+        qualities = self.uniform(len(picks), self.jpeg_quality[0], self.jpeg_quality[1] + 1).long().clamp_(1, 100)
+        images = images.clone()
+        for i, quality in zip(picks.tolist(), qualities.tolist()):
+            image = (images[i] * 255.).round().byte().cpu()
+            images[i] = decode_jpeg(encode_jpeg(image, quality=quality)).to(images.device, images.dtype) / 255.
+        return images
+
+    def __call__(self, images, size):
+        """
+        images: HR RGB [N, 3, H, W] in [0, 1], size: (h, w) of the LR
+        returns LR [N, 3, h, w] in [0, 1], quantized to 8 bit like a decoded image
+        """
+        if self.seed is not None:
+            self.generator.manual_seed(self.seed)
+        elif self.seeded_pid != os.getpid():
+            self.generator.manual_seed(torch.initial_seed())
+            self.seeded_pid = os.getpid()
+        images = self.blur(images)
+        images = F.interpolate(images, size, mode='bicubic', align_corners=False, antialias=True)
+        if self.noise[1] > 0:
+            levels = self.uniform(len(images), self.noise[0], self.noise[1]).to(images.device) / 255.
+            noise = torch.randn(images.shape, generator=self.generator).to(images.device)
+            images = images + noise * levels.view(-1, 1, 1, 1)
+        images = images.clamp(0., 1.)
+        if self.jpeg_prob > 0:
+            images = self.jpeg(images)
+        return (images * 255.).round() / 255.
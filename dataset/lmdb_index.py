@@ -0,0 +1,161 @@
+import os
+import argparse
+import hashlib
+import lmdb
+import six
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+"""
+Sidecar index of an LMDB (label-/image_hr-/image_lr- or label-/image- keys): one
+record per sample, stored as a NumPy structured array in root/index.npy.
+
+    hr_w, hr_h     size of image_hr- (or image-)
+    lr_w, lr_h     size of image_lr-, 0 for LMDBs without LR images
+    label_len      length of the raw label
+    hr_bytes       encoded size of the HR image
+    lr_bytes       encoded size of the LR image
+    valid          label present and every image decodes
+    hash           64 bit blake2b of the label and image bytes
+
+Row i describes the sample of key i + 1. dataset/create_lmdb.py writes it with the
+LMDB, existing LMDBs are indexed with
+
+    python3 dataset/lmdb_index.py --lmdb_dir TextZoom/train1 TextZoom/train2
+"""
+
+INDEX_FILE = 'index.npy'
+
+INDEX_DTYPE = np.dtype([
+    ('hr_w', '<i4'), ('hr_h', '<i4'),
+    ('lr_w', '<i4'), ('lr_h', '<i4'),
+    ('label_len', '<i4'),
+    ('hr_bytes', '<i4'), ('lr_bytes', '<i4'),
+    ('valid', '?'),
+    ('hash', '<u8'),
+])
+
+
+def index_path(root):
+    return os.path.join(root, INDEX_FILE)
+
+
+def image_info(imgbuf, decode=True):
+    """(w, h, ok) of an encoded image, decoded fully if decode else from the header only."""
+    if imgbuf is None:
+        return 0, 0, False
+    try:
+        im = Image.open(six.BytesIO(imgbuf))
+        if decode:
+            im.load()
+        return im.size[0], im.size[1], True
+    except (IOError, SyntaxError, ValueError):
+        return 0, 0, False
+
+
+def index_record(label, hr_buf, lr_buf=None, decode=True):
+    """
+    One INDEX_DTYPE record. label: bytes or str (None if missing),
+    hr_buf / lr_buf: encoded images, lr_buf None for LMDBs without LR images.
+    """
+    if isinstance(label, str):
+        label = label.encode()
+    hr_w, hr_h, hr_ok = image_info(hr_buf, decode)
+    lr_w, lr_h, lr_ok = image_info(lr_buf, decode) if lr_buf is not None else (0, 0, True)
+
+    digest = hashlib.blake2b(digest_size=8)
+    for buf in [label, hr_buf, lr_buf]:
+        digest.update(b'' if buf is None else buf)
+
+    record = np.zeros((), dtype=INDEX_DTYPE)
+    record['hr_w'], record['hr_h'] = hr_w, hr_h
+    record['lr_w'], record['lr_h'] = lr_w, lr_h
+    record['label_len'] = len(label.decode()) if label is not None else 0
+    record['hr_bytes'] = len(hr_buf) if hr_buf is not None else 0
+    record['lr_bytes'] = len(lr_buf) if lr_buf is not None else 0
+    record['valid'] = label is not None and hr_ok and lr_ok
+    record['hash'] = np.frombuffer(digest.digest(), dtype='<u8')[0]
+    return record
+
+
+def sample_record(txn, key, decode=True):
+    # key: 1-based, like the label-/image- keys
+    label = txn.get(b'label-%09d' % key)
+    hr_buf = txn.get(b'image_hr-%09d' % key)
+    if hr_buf is None:
+        hr_buf = txn.get(b'image-%09d' % key)
+    lr_buf = txn.get(b'image_lr-%09d' % key)
+    return index_record(label, hr_buf, lr_buf, decode)
+
+
+def build_index(root, decode=True):
+    """INDEX_DTYPE array of every sample of the LMDB at root."""
+    env = lmdb.open(root, max_readers=1, readonly=True, lock=False, readahead=True, meminit=False)
+    with env.begin(write=False) as txn:
+        num_samples = int(txn.get(b'num-samples'))
+        index = np.zeros(num_samples, dtype=INDEX_DTYPE)
+        for i in tqdm(range(num_samples)):
+            index[i] = sample_record(txn, i + 1, decode)
+    env.close()
+    return index
+
+
+def write_index(root, index):
+    # written aside and renamed, readers never see a partial file
+    tmp_path = index_path(root) + '.tmp.npy'
+    np.save(tmp_path, np.asarray(index, dtype=INDEX_DTYPE))
+    os.replace(tmp_path, index_path(root))
+
+
+def load_index(root, num_samples=None):
+    """
+    The index of the LMDB at root, memory-mapped, or None if there is none or it is
+    stale (another sample count, or older than the LMDB data file).
+    """
+    path = index_path(root)
+    if not os.path.isfile(path):
+        return None
+    data_path = os.path.join(root, 'data.mdb')
+    if os.path.isfile(data_path) and os.path.getmtime(path) < os.path.getmtime(data_path):
+        print('%s is older than the LMDB, ignored' % path)
+        return None
+    index = np.load(path, mmap_mode='r')
+    if index.dtype != INDEX_DTYPE or (num_samples is not None and len(index) != num_samples):
+        print('%s does not match the LMDB, ignored' % path)
+        return None
+    return index
+
+
+def summary(index):
+    valid = index['valid']
+    label_len = index['label_len'][valid]
+    print('samples: %d, valid: %d' % (len(index), int(valid.sum())))
+    if valid.any():
+        print('label length: mean %.2f, max %d' % (label_len.mean(), label_len.max()))
+        for name in ['hr', 'lr']:
+            w, h = index[name + '_w'][valid], index[name + '_h'][valid]
+            if w.max() > 0:
+                print('%s size: w %d-%d (mean %.1f), h %d-%d (mean %.1f), %.1f KB per image'
+                      % (name.upper(), w.min(), w.max(), w.mean(), h.min(), h.max(), h.mean(),
+                         index[name + '_bytes'][valid].mean() / 1024.))
+        print('duplicates: %d' % (len(index) - len(np.unique(index['hash']))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the sidecar metadata index of LMDB datasets')
+    parser.add_argument('--lmdb_dir', type=str, nargs='+', required=True, help='')
+    parser.add_argument('--no_decode', action='store_true', default=False,
+                        help='read image sizes from the headers only, valid then only means the header parses')
+    parser.add_argument('--force', action='store_true', default=False, help='rebuild existing indexes')
+    args = parser.parse_args()
+
+    for root in args.lmdb_dir:
+        index = None if args.force else load_index(root)
+        if index is None:
+            print('indexing %s' % root)
+            index = build_index(root, decode=not args.no_decode)
+            write_index(root, index)
+        print('%s:' % index_path(root))
+        summary(index)
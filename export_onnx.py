@@ -0,0 +1,63 @@
+import time
+
+import torch
+
+from main import get_parser, get_config, get_opt_TPG
+from interfaces.super_resolution import TextSR
+from utils.onnx_runtime import export_cascade, ORTCascade, parity_check
+
+
+"""
+Export the TPGSR inference graph (TPG -> softmax -> SR model, over --stu_iter stages
+for tsrn_tl_cascade) to ONNX and check it against PyTorch with ONNX Runtime.
+
+    python3 export_onnx.py --arch="tsrn_tl_cascade" --mask --stu_iter=1 --tpg="CRNN" \
+        --resume="ckpt/vis_TPGSR-TSRN/" --onnx_out=tpgsr.onnx
+
+Batch and width are dynamic. The exported file is used with --onnx=tpgsr.onnx
+in main.py (--infer, --demo) and server.py.
+"""
+
+
+def benchmark(fn, images_lr, repeat):
+    with torch.no_grad():
+        fn(images_lr)
+        begin = time.time()
+        for _ in range(repeat):
+            fn(images_lr)
+    return (time.time() - begin) * 1000. / repeat
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--onnx_out', type=str, default='tpgsr.onnx', help='path of the exported model')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--parity_tol', type=float, default=1e-3, help='largest max abs difference accepted')
+    parser.add_argument('--bench_repeat', type=int, default=20, help='timed runs per backend, 0 skips the timing')
+    args = parser.parse_args()
+    config = get_config(args)
+
+    mission = TextSR(config, args, get_opt_TPG())
+    cascade = mission.infer_cascade().cpu()
+    cascade.eval()
+
+    cfg = config.TRAIN
+    channels = 4 if args.mask else 3
+    height, width = cfg.height // cfg.down_sample_scale, cfg.width // cfg.down_sample_scale
+    export_cascade(cascade, args.onnx_out, torch.rand(2, channels, height, width), opset=args.opset)
+    print('exported %s (stu_iter=%d) to %s' % (args.arch, cascade.stu_iter, args.onnx_out))
+
+    ort_cascade = ORTCascade(args.onnx_out)
+    shapes = [(1, channels, height, width), (8, channels, height, width), (3, channels, height, width * 2)]
+    worst = 0.
+    for shape, max_diff, mean_diff in parity_check(cascade, ort_cascade, shapes):
+        print('parity %s: max abs diff %.2e, mean abs diff %.2e' % (shape, max_diff, mean_diff))
+        worst = max(worst, max_diff)
+    if worst > args.parity_tol:
+        raise RuntimeError('ONNX Runtime output differs from PyTorch by %.2e > %.2e' % (worst, args.parity_tol))
+
+    if args.bench_repeat > 0:
+        images_lr = torch.rand(args.batch_size, channels, height, width)
+        torch_ms = benchmark(cascade, images_lr, args.bench_repeat)
+        ort_ms = benchmark(ort_cascade, images_lr, args.bench_repeat)
+        print('batch %d on cpu: pytorch %.2f ms, onnxruntime %.2f ms' % (args.batch_size, torch_ms, ort_ms))
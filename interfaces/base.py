@@ -1,6 +1,7 @@
 import torch
 import sys
 import os
+import contextlib
 from tqdm import tqdm
 import math
 import torch.nn as nn
@@ -26,13 +27,15 @@ from dataset import lmdbDataset, \
     lmdbDatasetWithW2V_real, alignCollatec2f_real, lmdbDataset_realIC15, \
     alignCollate_realWTL, alignCollate_realWTL_withcrop, alignCollate_realWTLAMask, \
 lmdbDatasetWithMask_real, lmdbDataset_realIC15TextSR, lmdbDataset_realCOCOText, lmdbDataset_realSVT, \
-lmdbDataset_realBadSet, alignCollate_syn_random_reso, lmdbDataset_realIIIT, lmdbDataset_realForTest
+lmdbDataset_realBadSet, alignCollate_syn_random_reso, lmdbDataset_realIIIT, lmdbDataset_realForTest, \
+alignCollate_mix, alignCollate_syn_bucket
+from dataset.degradation import build_kernel_bank, open_kernel_bank, KernelBank, BatchDegradation
 from loss import gradient_loss, percptual_loss, image_loss, semantic_loss
 
 from utils.labelmaps import get_vocabulary, labels2strs
 
 sys.path.append('../')
-from utils import util, ssim_psnr, utils_moran, utils_crnn
+from utils import util, ssim_psnr, utils_moran, utils_crnn, precision, distributed, checkpoint
 import dataset.dataset as dataset
 
 
@@ -60,12 +63,14 @@ class TextBase(object):
         }
 
         if self.args.random_reso:
-            align_type = "random"
+            # --bucket: batches of near-equal LR sizes as tensors instead of per-image lists
+            align_type = "bucket" if self.args.bucket else "random"
         else:
             align_type = "fixed"
 
         align_types = {
             "random": alignCollate_syn_random_reso,
+            "bucket": alignCollate_syn_bucket,
             "fixed": alignCollate_syn
         }
 
@@ -108,7 +113,7 @@ class TextBase(object):
             
 
         elif self.args.mixed:
-            self.align_collate = alignCollate_real
+            self.align_collate = alignCollate_mix
             self.load_dataset = lmdbDataset_mix
 
         elif self.args.ic15sr:
@@ -216,6 +221,10 @@ class TextBase(object):
         self.resume = args.resume if args.resume is not None else config.TRAIN.resume
         self.batch_size = args.batch_size if args.batch_size is not None else self.config.TRAIN.batch_size
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if distributed.is_distributed():
+            # one device per process: its GPU with NCCL, the CPU with gloo
+            self.device = torch.device('cuda', distributed.local_rank()) \
+                if torch.distributed.get_backend() == 'nccl' else torch.device('cpu')
         alpha_dict = {
             'digit': string.digits,
             'lower': string.digits + string.ascii_lowercase,
@@ -234,25 +243,103 @@ class TextBase(object):
         self.converter_moran = utils_moran.strLabelConverterForAttention(alphabet_moran, ':')
         self.converter_crnn = utils_crnn.strLabelConverter(string.digits + string.ascii_lowercase)
 
+        # teacher prior cache: the train loader then also yields the sample indices
+        self.prior_cache_dir = self.args.prior_cache
+        if self.prior_cache_dir is not None and (self.args.syn or self.args.mixed or self.args.random_reso):
+            print('Teacher prior cache disabled: HR images are not fixed with --syn, --mixed or --random_reso')
+            self.prior_cache_dir = None
+
+    def open_dataset(self, load_dataset, root, batched=False, **kwargs):
+        # a directory of pre-decoded shards (dataset/create_shards.py) stands in for its TextZoom LMDB
+        if load_dataset is lmdbDataset_real and dataset.is_shard_dir(root):
+            load_dataset = dataset.memmapDataset_real
+            # batched collates take the uint8 arrays as they are
+            kwargs['to_pil'] = not batched
+        return load_dataset(root=root, **kwargs)
+
+    def degradation_kwargs(self, train):
+        # --degrade: synthesize the LR of --syn / --mixed samples with TRAIN.DEGRADATION
+        if not self.args.degrade or self.args.random_reso or not (self.args.syn or (self.args.mixed and train)):
+            return {}
+        cfg = self.config.TRAIN.DEGRADATION
+        if getattr(self, 'kernel_bank', None) is None:
+            if cfg.get('bank') is not None:
+                self.kernel_bank = open_kernel_bank(cfg.bank, cfg.kernel_size, cfg.kernels_per_family, cfg.families,
+                                                    cfg.sigma, cfg.seed)
+            else:
+                self.kernel_bank = KernelBank(build_kernel_bank(cfg.kernel_size, cfg.kernels_per_family,
+                                                                cfg.families, cfg.sigma, cfg.seed))
+            print('Degradation kernel bank: %d kernels of %s' % (len(self.kernel_bank), ', '.join(cfg.families)))
+        degrade = BatchDegradation(self.kernel_bank, blur_prob=cfg.blur_prob, noise=cfg.noise,
+                                   jpeg_prob=cfg.jpeg_prob, jpeg_quality=cfg.jpeg_quality,
+                                   seed=None if train else cfg.seed)
+        return {'degrade': degrade}
+
+    def bucket_loader_kwargs(self, data, shuffle):
+        # --random_reso --bucket: batches come from the sizes of the samples, see dataset.bucketBatchSampler
+        if not (self.args.random_reso and self.args.bucket):
+            return None
+        sizes = dataset.image_sizes(data)
+        batch_sampler = dataset.bucketBatchSampler(sizes, self.batch_size, tol=self.args.bucket_tol, shuffle=shuffle,
+                                                   num_replicas=distributed.get_world_size(),
+                                                   rank=distributed.get_rank(),
+                                                   seed=self.config.TRAIN.get('manualSeed', 0))
+        print('%d samples in %d size buckets, %d batches' % (len(sizes), len(batch_sampler.buckets), len(batch_sampler)))
+        return {'batch_sampler': batch_sampler}
+
     def get_train_data(self):
         cfg = self.config.TRAIN
+        mix_cfg = cfg.get('MIX')
         if isinstance(cfg.train_data_dir, list):
             dataset_list = []
+            mix_kwargs = {}
+            if mix_cfg is not None and self.load_dataset is lmdbDataset_mix:
+                mix_kwargs['lr_prob'] = mix_cfg.get('lr_prob', 0.5)
             for data_dir_ in cfg.train_data_dir:
                 dataset_list.append(
-                    self.load_dataset(root=data_dir_,
+                    self.open_dataset(self.load_dataset,
+                                      root=data_dir_,
+                                      batched=getattr(self.align_collate, 'batched', False),
                                       voc_type=cfg.voc_type,
-                                      max_len=cfg.max_len))
+                                      max_len=cfg.max_len,
+                                      **mix_kwargs))
             train_dataset = dataset.ConcatDataset(dataset_list)
         else:
             raise TypeError('check trainRoot')
 
+        collate_fn = self.align_collate(imgH=cfg.height, imgW=cfg.width, down_sample_scale=cfg.down_sample_scale,
+                                        mask=self.mask, train=True, **self.degradation_kwargs(train=True))
+        if self.prior_cache_dir is not None:
+            train_dataset = dataset.indexedDataset(train_dataset)
+            collate_fn = dataset.alignCollate_withIndex(collate_fn)
+
+        loader_kwargs = self.bucket_loader_kwargs(train_dataset, shuffle=True)
+        if loader_kwargs is None and mix_cfg is not None and (mix_cfg.get('weights') or mix_cfg.get('epoch_size')):
+            # TRAIN.MIX: per-source shares of every epoch, see dataset.weightedMixSampler
+            mix_sampler = dataset.weightedMixSampler([len(d) for d in dataset_list], mix_cfg.get('weights'),
+                                                     mix_cfg.get('epoch_size'), mix_cfg.get('seed', 0),
+                                                     num_replicas=distributed.get_world_size(),
+                                                     rank=distributed.get_rank())
+            for data_dir_, count in zip(cfg.train_data_dir, mix_sampler.counts):
+                print('%s: %d samples per epoch' % (data_dir_, count))
+            loader_kwargs = {'batch_size': self.batch_size, 'sampler': mix_sampler, 'drop_last': True,
+                             'generator': torch.Generator().manual_seed(mix_cfg.get('seed', 0))}
+        if loader_kwargs is None:
+            # epochs shuffled from (manualSeed, epoch), so that --resume_train can read the rest of one.
+            # --distributed: every process trains on its share of each epoch, --batch_size is per process
+            epoch_sampler = torch.utils.data.DistributedSampler(train_dataset, num_replicas=distributed.get_world_size(),
+                                                                rank=distributed.get_rank(), shuffle=True,
+                                                                seed=cfg.get('manualSeed', 0), drop_last=True)
+            loader_kwargs = {'batch_size': self.batch_size, 'sampler': epoch_sampler, 'drop_last': True}
+        if 'batch_sampler' in loader_kwargs:
+            self.train_sampler = loader_kwargs['batch_sampler'] = dataset.skipSampler(loader_kwargs['batch_sampler'])
+        else:
+            self.train_sampler = loader_kwargs['sampler'] = dataset.skipSampler(loader_kwargs['sampler'], self.batch_size)
         train_loader = torch.utils.data.DataLoader(
-            train_dataset, batch_size=self.batch_size,
-            shuffle=True, num_workers=int(cfg.workers),
-            collate_fn=self.align_collate(imgH=cfg.height, imgW=cfg.width, down_sample_scale=cfg.down_sample_scale,
-                                          mask=self.mask, train=True),
-            drop_last=True)
+            train_dataset, num_workers=int(cfg.workers),
+            collate_fn=collate_fn,
+            worker_init_fn=dataset.seed_worker,
+            **loader_kwargs)
         return train_dataset, train_loader
 
     def get_val_data(self):
@@ -271,23 +358,33 @@ class TextBase(object):
         self.args.test_data_dir
 
         if self.args.go_test:
-            test_dataset = self.load_dataset_val(root=dir_,
+            test_dataset = self.open_dataset(self.load_dataset_val,
+                                             root=dir_,
+                                             batched=getattr(self.align_collate_val, 'batched', False),
                                              voc_type=cfg.voc_type,
                                              max_len=cfg.max_len,
                                              test=True,
                                              )
         else:
-            test_dataset = self.load_dataset_val(root=dir_,  #load_dataset
+            test_dataset = self.open_dataset(self.load_dataset_val,
+                                             root=dir_,  #load_dataset
+                                             batched=getattr(self.align_collate_val, 'batched', False),
                                              voc_type=cfg.voc_type,
                                              max_len=cfg.max_len,
                                              test=True,
                                              )
+        loader_kwargs = self.bucket_loader_kwargs(test_dataset, shuffle=False)
+        if loader_kwargs is None and self.args.sequential_val and isinstance(test_dataset, dataset.lmdbDatasetBase):
+            # cursor scans in key order instead of one random read per sample, same batches
+            test_dataset = dataset.lmdbSequentialDataset(test_dataset, self.batch_size)
+            loader_kwargs = {'batch_size': self.batch_size}
+        if loader_kwargs is None:
+            loader_kwargs = {'batch_size': self.batch_size, 'shuffle': False, 'drop_last': False}
         test_loader = torch.utils.data.DataLoader(
-            test_dataset, batch_size=self.batch_size,
-            shuffle=False, num_workers=int(cfg.workers),
+            test_dataset, num_workers=int(cfg.workers),
             collate_fn=self.align_collate_val(imgH=cfg.height, imgW=cfg.width, down_sample_scale=cfg.down_sample_scale,
-                                          mask=self.mask, train=False),
-            drop_last=False)
+                                          mask=self.mask, train=False, **self.degradation_kwargs(train=False)),
+            **loader_kwargs)
         return test_dataset, test_loader
 
     def generator_init(self, iter=-1):
@@ -369,7 +466,7 @@ class TextBase(object):
         else:
             raise ValueError
 
-        with torch.cuda.device(0):
+        with torch.cuda.device(self.device) if self.device.type == 'cuda' else contextlib.nullcontext():
             # input = torch.randn(1, 3, 16, 64).to(self.device)
             # tp_in = torch.randn(1, 37, 1, 25).to(self.device)
             # net = models.densenet161()
@@ -387,7 +484,7 @@ class TextBase(object):
                     image_crit[k] = image_crit[k].to(self.device)
             else:
                 image_crit.to(self.device)
-            if cfg.ngpu > 1:
+            if cfg.ngpu > 1 and not distributed.is_distributed():
 
                 print("multi_gpu", self.device)
 
@@ -400,29 +497,46 @@ class TextBase(object):
                     image_crit = torch.nn.DataParallel(image_crit, device_ids=range(cfg.ngpu))
 
             if self.resume is not '':
-                print('loading pre-trained model from %s ' % self.resume)
-                if self.config.TRAIN.ngpu == 1:
+                resume_path = self.resume
+                if os.path.isdir(self.resume):
                     # if is dir, we need to initialize the model list
-                    if os.path.isdir(self.resume):
-                        model.load_state_dict(
-                            torch.load(
-                                os.path.join(self.resume, "model_best_" + str(iter) + ".pth")
-                            )['state_dict_G']
-                            )
-                    else:
-                        model.load_state_dict(torch.load(self.resume)['state_dict_G'])
-                else:
-
-                    if os.path.isdir(self.resume):
-                        model.load_state_dict(
-                            {'module.' + k: v for k, v in torch.load(
-                                os.path.join(self.resume, "model_best_" + str(iter) + ".pth")
-                            )['state_dict_G'].items()}
-                            )
-                    else:
-                        model.load_state_dict(
-                        {'module.' + k: v for k, v in torch.load(self.resume)['state_dict_G'].items()})
-        return {'model': model, 'crit': image_crit}
+                    resume_path = os.path.join(self.resume_dir(), self.resume_file(iter))
+                print('loading pre-trained model from %s ' % resume_path)
+                state_dict = torch.load(resume_path, map_location='cpu')['state_dict_G']
+                if isinstance(model, torch.nn.DataParallel):
+                    state_dict = {'module.' + k: v for k, v in state_dict.items()}
+                model.load_state_dict(state_dict)
+            # --sr_share: the stages of the cascade call the same generator
+            model = self.ddp(model, reused=self.args.sr_share and self.args.stu_iter > 1)
+        return {'model': self.autocast(model), 'crit': self.autocast(image_crit)}
+
+    def resume_dir(self):
+        # --resume_train: the group of the last complete periodic save, weights and train state together
+        if self.args.resume_train:
+            return checkpoint.resume_group(self.resume)
+        return self.resume if os.path.isdir(self.resume) else "/".join(self.resume.split("/")[:-1])
+
+    def resume_file(self, iter):
+        # --resume_train continues from the last periodic save, otherwise the best model is loaded
+        if not self.args.resume_train:
+            return "model_best_" + str(iter) + ".pth"
+        if os.path.isfile(os.path.join(self.resume_dir(), "checkpoint_" + str(iter) + ".pth")):
+            return "checkpoint_" + str(iter) + ".pth"
+        return "checkpoint.pth"
+
+    def ddp(self, model, reused=False):
+        # --distributed: DistributedDataParallel, the gradients are all-reduced in backward.
+        # reused: the forward runs more than once before each backward, which DDP only supports with a static graph
+        if isinstance(model, list):
+            return [self.ddp(m, reused) for m in model]
+        if not distributed.is_distributed() or not any(p.requires_grad for p in model.parameters()):
+            return model
+        device_ids = [self.device.index] if self.device.type == 'cuda' else None
+        return torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids, static_graph=reused)
+
+    def autocast(self, module):
+        # --precision bf16 / fp16: forward under autocast, outputs in fp32 (see utils/precision.py)
+        return precision.autocast_module(module, self.args.precision, self.device.type)
 
     def optimizer_init(self, model, recognizer=None):
         cfg = self.config.TRAIN
@@ -543,46 +657,52 @@ class TextBase(object):
                     torchvision.utils.save_image(vis_im, os.path.join(out_root, im_name), padding=0)
         return visualized
 
-    def save_checkpoint(self, netG_list, epoch, iters, best_acc_dict, best_model_info, is_best, converge_list, recognizer=None):
+    def save_checkpoint(self, netG_list, epoch, iters, best_acc_dict, best_model_info, is_best, converge_list, recognizer=None,
+                        train_state=None):
         ckpt_path = os.path.join('ckpt', self.vis_dir)
-        if not os.path.exists(ckpt_path):
-            os.mkdir(ckpt_path)
+        if getattr(self, 'checkpoint_writer', None) is None:
+            ckpt_cfg = self.config.TRAIN.get('CHECKPOINT', {})
+            self.checkpoint_writer = checkpoint.CheckpointWriter(ckpt_path, keep_last=ckpt_cfg.get('keep_last', 3),
+                                                                 keep_best=ckpt_cfg.get('keep_best', 2),
+                                                                 background=ckpt_cfg.get('background', True))
 
         print("Into saving checkpoints...")
+        recognizer = distributed.unwrap(recognizer)
 
+        # one group of files, written in the background by the CheckpointWriter
+        files = OrderedDict()
         for i in range(len(netG_list)):
-            netG = netG_list[i]
+            netG = distributed.unwrap(netG_list[i])
             save_dict = {
-                'state_dict_G': netG.module.state_dict(),
+                'state_dict_G': netG.state_dict(),
                 'info': {'arch': self.args.arch, 'iters': iters, 'epochs': epoch, 'batch_size': self.batch_size,
                          'voc_type': self.voc_type, 'up_scale_factor': self.scale_factor},
                 'best_history_res': best_acc_dict,
                 'best_model_info': best_model_info,
-                'param_num': sum([param.nelement() for param in netG.module.parameters()]),
+                'param_num': sum([param.nelement() for param in netG.parameters()]),
                 'converge': converge_list,
             }
 
             if is_best:
-                torch.save(save_dict, os.path.join(ckpt_path, 'model_best_' + str(i) + '.pth'))
+                files['model_best_' + str(i) + '.pth'] = save_dict
+            else:
+                files['checkpoint.pth' if len(netG_list) == 1 else 'checkpoint_' + str(i) + '.pth'] = save_dict
+
+        suffix = '_best' if is_best else ''
+        if not recognizer is None:
+            if type(recognizer) == list:
+                for i in range(len(recognizer)):
+                    files['recognizer' + suffix + '_' + str(i) + '.pth'] = recognizer[i].state_dict()
             else:
-                torch.save(save_dict, os.path.join(ckpt_path, 'checkpoint.pth'))
+                files['recognizer' + suffix + '.pth'] = recognizer.state_dict()
+        if train_state is not None:
+            # optimizer, position and RNGs for --resume_train, see TextSR.train
+            files['train_state.pth'] = train_state
 
+        score = None
         if is_best:
-            # torch.save(save_dict, os.path.join(ckpt_path, 'model_best.pth'))
-            if not recognizer is None:
-                if type(recognizer) == list:
-                    for i in range(len(recognizer)):
-                        torch.save(recognizer[i].state_dict(), os.path.join(ckpt_path, 'recognizer_best_' + str(i) + '.pth'))
-                else:
-                    torch.save(recognizer.state_dict(), os.path.join(ckpt_path, 'recognizer_best.pth'))
-        else:
-            # torch.save(save_dict, os.path.join(ckpt_path, 'checkpoint.pth'))
-            if not recognizer is None:
-                if type(recognizer) == list:
-                    for i in range(len(recognizer)):
-                        torch.save(recognizer[i].state_dict(), os.path.join(ckpt_path, 'recognizer_' + str(i) + '.pth'))
-                else:
-                    torch.save(recognizer.state_dict(), os.path.join(ckpt_path, 'recognizer.pth'))
+            score = sum(v for k, v in best_model_info['accuracy'].items() if k != 'epoch')
+        self.checkpoint_writer.save(files, kind='best' if is_best else 'last', step=iters, score=score)
 
     def MORAN_init(self):
         cfg = self.config.TRAIN
@@ -599,17 +719,19 @@ class TextBase(object):
         MORAN.load_state_dict(MORAN_state_dict_rename)
 
         MORAN = MORAN.to(self.device)
-        MORAN = torch.nn.DataParallel(MORAN, device_ids=range(cfg.ngpu))
+        if not distributed.is_distributed():
+            MORAN = torch.nn.DataParallel(MORAN, device_ids=range(cfg.ngpu))
         for p in MORAN.parameters():
             p.requires_grad = False
         MORAN.eval()
-        return MORAN
+        return self.autocast(MORAN)
 
     def parse_moran_data(self, imgs_input):
 
         in_width = self.config.TRAIN.width if self.config.TRAIN.width != 128 else 100
 
-        if self.args.random_reso:
+        if isinstance(imgs_input, (list, tuple)):
+            # --random_reso without --bucket: images of different sizes
             batch_size = len(imgs_input)
             new_input = []
             for img in imgs_input:
@@ -657,7 +779,7 @@ class TextBase(object):
         # model #.eval()
         # model.eval()
 
-        return model, aster_info
+        return self.autocast(model), aster_info
 
     def CRNNRes18_init(self, recognizer_path=None, opt=None):
         model = crnn.CRNN_ResNet18(32, 1, 37, 256)
@@ -676,7 +798,7 @@ class TextBase(object):
 
         # model #.eval()
         # model.eval()
-        return model, aster_info
+        return self.autocast(model), aster_info
 
     def TPG_init(self, recognizer_path=None, opt=None):
         model = crnn.Model(opt)
@@ -715,7 +837,7 @@ class TextBase(object):
         except Exception:
             model = stat_dict
 
-        return model, aster_info
+        return self.autocast(model), aster_info
 
     def parse_SEED_data(self, inputs):
         input_dict = {}
@@ -729,7 +851,8 @@ class TextBase(object):
 
         in_width = self.config.TRAIN.width if self.config.TRAIN.width != 128 else 100
 
-        if self.args.random_reso:
+        if isinstance(imgs_input, (list, tuple)):
+            # --random_reso without --bucket: images of different sizes
             batch_size = len(imgs_input)
             new_input = []
             for img in imgs_input:
@@ -800,14 +923,15 @@ class TextBase(object):
 
         model = model.to(self.device)
 
-        return model, aster_info
+        return self.autocast(model), aster_info
 
 
     def parse_crnn_data(self, imgs_input):
 
         in_width = self.config.TRAIN.width if self.config.TRAIN.width != 128 else 100
 
-        if self.args.random_reso:
+        if isinstance(imgs_input, (list, tuple)):
+            # --random_reso without --bucket: images of different sizes
             batch_size = len(imgs_input)
             new_input = []
             for img in imgs_input:
@@ -828,25 +952,29 @@ class TextBase(object):
         tensor = 0.299 * R + 0.587 * G + 0.114 * B
         return tensor
 
-    def Aster_init(self):
+    def Aster_init(self, inference=False):
+        # inference: predictions only, the loss against the dummy targets of parse_aster_data is skipped
         cfg = self.config.TRAIN
         aster_info = AsterInfo(cfg.voc_type)
         aster = recognizer.RecognizerBuilder(arch='ResNet_ASTER', rec_num_classes=aster_info.rec_num_classes,
                                              sDim=512, attDim=512, max_len_labels=aster_info.max_len,
-                                             eos=aster_info.char2id[aster_info.EOS], STN_ON=True)
+                                             eos=aster_info.char2id[aster_info.EOS], STN_ON=True,
+                                             beam_width=self.args.beam_width, inference=inference)
         aster.load_state_dict(torch.load(self.config.TRAIN.VAL.rec_pretrained)['state_dict'])
         print('load pred_trained aster model from %s' % self.config.TRAIN.VAL.rec_pretrained)
         aster = aster.to(self.device)
-        aster = torch.nn.DataParallel(aster, device_ids=range(cfg.ngpu))
+        if not distributed.is_distributed():
+            aster = torch.nn.DataParallel(aster, device_ids=range(cfg.ngpu))
         aster.eval()
-        return aster, aster_info
+        return self.autocast(aster), aster_info
 
     def parse_aster_data(self, imgs_input):
         cfg = self.config.TRAIN
         aster_info = AsterInfo(cfg.voc_type)
         input_dict = {}
 
-        if self.args.random_reso:
+        if isinstance(imgs_input, (list, tuple)):
+            # --random_reso without --bucket: images of different sizes
             batch_size = len(imgs_input)
             new_input = []
             for img in imgs_input:
@@ -23,7 +23,12 @@ from interfaces import base
 from utils.meters import AverageMeter
 from utils.metrics import get_string_aster, get_string_crnn, Accuracy
 from utils.util import str_filt
-from utils import utils_moran
+from utils import utils_moran, precision, distributed, checkpoint
+from utils.prior_cache import TeacherPriorCache, model_hash
+from utils.step_timer import StepTimer
+from utils.onnx_runtime import ORTCascade
+from dataset import alignCollate_withIndex, inferDataset, alignCollate_infer, get_mask_tensor
+from model.tpgsr_cascade import TPGSRCascade
 
 from model import gumbel_softmax
 from loss.semantic_loss import SemanticLoss
@@ -32,6 +37,8 @@ from tensorboardX import SummaryWriter
 
 from ptflops import get_model_complexity_info
 import string
+import json
+import csv
 
 vis = False
 
@@ -48,29 +55,79 @@ ABLATION_SET = ["tsrn_tl_cascade", "srcnn_tl", "srresnet_tl", "rdn_tl", "vdsr_tl
 
 class TextSR(base.TextBase):
 
-    def cal_conf(self, images_lr, rec_model):
-        SR_confidence = []
-        for image_lr in images_lr:
-            img_np = image_lr[:, :3, :, :].data.cpu().numpy()[0] * 255
-            # print("img_np:", img_np.shape)
-            img_np = np.transpose((img_np * 255).astype(np.uint8), (1, 2, 0))
-            img_np_L = cv2.cvtColor(img_np, cv2.COLOR_RGB2GRAY)
-            l_var = cv2.Laplacian(img_np_L, cv2.CV_64F).var()
-            # print("img_up:", np.unique(img_np), img_np.shape)
+    def prior_cache_init(self, aster, train_dataset):
+        cfg = self.config.TRAIN
+        extra = {'height': cfg.height, 'width': cfg.width, 'tpg': self.args.tpg}
+        return TeacherPriorCache(self.prior_cache_dir, aster, cfg.train_data_dir, len(train_dataset), extra=extra)
+
+    def teacher_prior(self, aster, images_hr, indices=None):
+        # softmax(aster(HR)) as [T, B, C], read from the prior cache when every sample of the batch is in it
+        if self.prior_cache is not None and indices is not None:
+            label_vecs_hr = self.prior_cache.get(indices)
+            if label_vecs_hr is not None:
+                return label_vecs_hr.to(self.device).permute(1, 0, 2)
 
-            aster_dict_hr = self.parse_crnn_data(image_lr[:, :3, :, :])
-            label_vecs_lr = rec_model(aster_dict_hr)
-            label_vecs_lr = torch.nn.functional.softmax(label_vecs_lr, -1)
-            # [26, 1, 37] - > [1, 26, 37]
-            SR_conf = label_vecs_lr.permute(1, 0, 2).data.cpu().numpy()
+        aster_dict_hr = self.parse_crnn_data(images_hr[:, :3, :, :])
+        label_vecs_logits_hr = aster(aster_dict_hr).detach()
+        label_vecs_hr = torch.nn.functional.softmax(label_vecs_logits_hr, -1)
 
-            conf_idx = np.argmax(SR_conf[0, :, :], axis=-1)
-            picked_score = SR_conf[0, np.arange(SR_conf.shape[1]), conf_idx]
+        if self.prior_cache is not None and indices is not None:
+            self.prior_cache.put(indices, label_vecs_hr.permute(1, 0, 2))
+        return label_vecs_hr
 
-            SR_conf = np.sum(picked_score * (conf_idx > 0)) / float(np.sum(conf_idx > 0) + 1e-10)
-            SR_confidence.append(SR_conf)
+    def precompute_prior(self, aster, train_dataset):
+        cfg = self.config.TRAIN
+        loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=self.batch_size,
+            shuffle=False, num_workers=int(cfg.workers),
+            collate_fn=alignCollate_withIndex(
+                self.align_collate(imgH=cfg.height, imgW=cfg.width, down_sample_scale=cfg.down_sample_scale,
+                                   mask=self.mask, train=False)),
+            drop_last=False)
+        print('Precomputing teacher priors of %d samples...' % len(train_dataset))
+        with torch.no_grad():
+            for data in tqdm(loader):
+                # train_dataset is the indexedDataset of get_train_data, indices come last
+                images_hr, indices = data[0], data[-1]
+                if self.prior_cache.filled is not None and self.prior_cache.filled[indices.numpy()].all():
+                    continue
+                self.teacher_prior(aster, images_hr.to(self.device), indices)
+        self.prior_cache.flush()
 
-        return SR_confidence
+    def cal_conf(self, images_lr, rec_model):
+        # mean probability of the non-blank argmax symbols of rec_model, per LR image, in one recognizer pass
+        label_vecs_lr = rec_model(self.parse_crnn_data(images_lr))
+        label_vecs_lr = torch.nn.functional.softmax(label_vecs_lr, -1)
+        # [26, B, 37] - > [B, 26, 37]
+        picked_score, conf_idx = label_vecs_lr.permute(1, 0, 2).max(-1)
+        non_blank = (conf_idx > 0).float()
+        SR_confidence = (picked_score * non_blank).sum(1) / (non_blank.sum(1) + 1e-10)
+        return SR_confidence.tolist()
+
+    def reso_sr(self, images_lr, keep, sr_fn, images_in=None):
+        """
+        --random_reso: sr_fn(images_lr) or, given images_in, sr_fn(images_lr, images_in) for the
+        images not kept as LR (keep[i] False). images_lr is a list of [1, C, h, w] or, with --bucket,
+        one [N, C, h, w] tensor whose images go through sr_fn as one batch.
+        Returns the per-image list of outputs, the LR image where kept.
+        """
+        def select(images, picks):
+            return torch.cat([images[i].view(1, *images[i].shape[-3:]) for i in picks], 0)
+
+        def run(picks):
+            if images_in is None:
+                return sr_fn(select(images_lr, picks))
+            return sr_fn(select(images_lr, picks), select(images_in, picks))
+
+        if not torch.is_tensor(images_lr):
+            return [select(images_lr, [i]) if keep[i] else run([i]) for i in range(len(images_lr))]
+        images_out = list(images_lr.split(1, 0))
+        picks = [i for i in range(len(keep)) if not keep[i]]
+        if len(picks) > 0:
+            images_sr = run(picks)
+            for k, i in enumerate(picks):
+                images_out[i] = images_sr[k:k + 1]
+        return images_out
 
     def train(self):
 
@@ -93,14 +150,19 @@ class TextSR(base.TextBase):
                 model_sep = self.generator_init(i+1)['model']
                 model_list.append(model_sep)
 
-        tensorboard_dir = os.path.join("tensorboard", self.vis_dir)
-        if not os.path.isdir(tensorboard_dir):
-            os.makedirs(tensorboard_dir)
-        else:
-            print("Directory exist, remove events...")
-            os.popen("rm " + tensorboard_dir + "/*")
+        # --distributed: rank 0 validates, saves and logs
+        is_main = distributed.is_main_process()
+        if is_main:
+            tensorboard_dir = os.path.join("tensorboard", self.vis_dir)
+            if not os.path.isdir(tensorboard_dir):
+                os.makedirs(tensorboard_dir)
+            else:
+                print("Directory exist, remove events...")
+                os.popen("rm " + tensorboard_dir + "/*")
 
-        self.results_recorder = SummaryWriter(tensorboard_dir)
+            self.results_recorder = SummaryWriter(tensorboard_dir)
+        else:
+            self.results_recorder = distributed.NullWriter()
 
         aster, aster_info = TP_Generator_dict[self.args.tpg](recognizer_path=None, opt=tpg_opt)
 
@@ -116,7 +178,7 @@ class TextSR(base.TextBase):
                     }
 
         elif self.args.test_model == "ASTER":
-            aster_real, aster_real_info = self.Aster_init()
+            aster_real, aster_real_info = self.Aster_init(inference=True)
             aster_info = aster_real_info
             test_bible["ASTER"] = {
                 'model': aster_real,
@@ -135,10 +197,20 @@ class TextSR(base.TextBase):
             }
 
 
+        # The LR / HR images of a val set and the test recognizer are fixed for the whole run,
+        # their predictions are kept per (val set, recognizer weights) and only SR is recognized again
+        rec_cache_dict = {}
+        rec_hash = None
+        if not (self.args.syn or self.args.random_reso):
+            rec_hash = model_hash(test_bible[self.args.test_model]['model'])
+
         # print("self.args.arch:", self.args.arch)
 
+        # --resume_train: the student TPGs of the last periodic save, otherwise the best ones
+        rec_name = "recognizer" if self.args.resume_train else "recognizer_best"
+        resume_dir = self.resume_dir()
         if self.args.arch in ["tsrn_tl_wmask", "tsrn_tl"]:
-            recognizer_path = os.path.join("/".join(self.resume.split("/")[:-1]), "recognizer_best.pth")
+            recognizer_path = os.path.join(resume_dir, rec_name + ".pth")
             if os.path.isfile(recognizer_path):
                 aster_student, aster_stu_info = self.CRNN_init(recognizer_path=recognizer_path)
             else:
@@ -149,7 +221,7 @@ class TextSR(base.TextBase):
             stu_iter = self.args.stu_iter
 
             for i in range(stu_iter):
-                recognizer_path = os.path.join("/".join(self.resume.split("/")[:-1]), "recognizer_best_" + str(i) + ".pth")
+                recognizer_path = os.path.join(resume_dir, rec_name + "_" + str(i) + ".pth")
                 # print("recognizer_path:", recognizer_path)
                 if os.path.isfile(recognizer_path):
                     aster_student_, aster_stu_info = TP_Generator_dict[self.args.tpg](recognizer_path=recognizer_path, opt=tpg_opt) #
@@ -162,13 +234,38 @@ class TextSR(base.TextBase):
                 aster_student_.train()
                 aster_student.append(aster_student_)
 
+        if self.args.arch in ["tsrn_tl_wmask", "tsrn_tl"] + ABLATION_SET:
+            # --tpg_share: every stage of the cascade calls the first student TPG
+            aster_student = self.ddp(aster_student, reused=self.args.tpg_share and self.args.stu_iter > 1)
         aster.eval()
+
+        self.prior_cache = None
+        if self.prior_cache_dir is not None:
+            if self.args.arch in ["tsrn_tl", "tsrn_tl_wmask"] + ABLATION_SET:
+                if is_main:
+                    self.prior_cache = self.prior_cache_init(aster, train_dataset)
+                    if self.args.prior_precompute and not self.prior_cache.complete():
+                        self.precompute_prior(aster, train_dataset)
+                if distributed.is_distributed():
+                    # the processes would overwrite each other's filled flags, they share a cache completed by rank 0
+                    torch.distributed.barrier()
+                    if not is_main:
+                        self.prior_cache = self.prior_cache_init(aster, train_dataset)
+                    if not self.prior_cache.complete():
+                        print('Teacher prior cache disabled: --distributed needs a complete cache, see --prior_precompute')
+                        self.prior_cache = None
+            else:
+                print('Teacher prior cache ignored: %s does not use a teacher TPG' % self.args.arch)
+
         # Recognizer needs to be fixed:
         # aster
         if self.args.arch in ["tsrn_tl_wmask", "tsrn_tl"] + ABLATION_SET:
             optimizer_G = self.optimizer_init(model_list, recognizer=aster_student)
         else:
             optimizer_G = self.optimizer_init(model_list)
+        # --precision fp16 scales the loss, for fp32 / bf16 the scaler is a pass-through
+        scaler = precision.grad_scaler(self.args.precision, self.device.type)
+        self.autocast(sem_loss)
         # for p in aster.parameters():
         #     p.requires_grad = False
 
@@ -186,14 +283,50 @@ class TextSR(base.TextBase):
         converge_list = []
         lr = cfg.lr
 
+        # --resume_train: continue after the last batch of the periodic save in --resume
+        start_epoch, start_batch, resume_rng = 0, 0, None
+        if self.args.resume_train:
+            print('resuming from %s' % resume_dir)
+            train_state = torch.load(os.path.join(resume_dir, 'train_state.pth'), map_location='cpu', weights_only=False)
+            optimizer_G.load_state_dict(train_state['optimizer_G'])
+            if train_state['scaler']:
+                # empty unless the run was --precision fp16
+                scaler.load_state_dict(train_state['scaler'])
+            best_history_acc, best_model_acc = train_state['best_history_acc'], train_state['best_model_acc']
+            best_model_psnr, best_model_ssim = train_state['best_model_psnr'], train_state['best_model_ssim']
+            best_acc, converge_list = train_state['best_acc'], train_state['converge_list']
+            start_epoch, start_batch = train_state['epoch'], train_state['batch']
+            if start_batch >= len(train_loader):
+                start_epoch, start_batch = start_epoch + 1, 0
+            resume_rng = train_state['rng']
+            print('resuming training at epoch %d, batch %d (iteration %d)'
+                  % (start_epoch, start_batch, len(train_loader) * start_epoch + start_batch))
+
         for model in model_list:
             model.train()
 
-        for epoch in range(cfg.epochs):
+        # --step_timing: time of the phases of the steps, reported every displayInterval iterations
+        step_timer = StepTimer(self.args.step_timing, self.device)
+        timing_path = os.path.join('ckpt', self.vis_dir, 'step_timing.json')
+
+        for epoch in range(start_epoch, cfg.epochs):
+            self.train_sampler.set_epoch(epoch)
+            first_batch = start_batch if epoch == start_epoch else 0
+            # the batches of the epoch before first_batch have been trained on before --resume_train
+            self.train_sampler.skip_batches(first_batch)
+            train_iter = iter(train_loader)
+            if resume_rng is not None:
+                # restored once the loader has drawn its seed, the RNGs continue as they were at the save
+                checkpoint.set_rng_state(resume_rng)
+                resume_rng = None
 
-            for j, data in (enumerate(train_loader)):
+            for j, data in enumerate(train_iter, first_batch):
 
+                step_timer.lap('data')
                 iters = len(train_loader) * epoch + j + 1
+                indices = None
+                if self.prior_cache_dir is not None:
+                    data, indices = data[:-1], data[-1]
                 if not self.args.go_test:
                     for model in model_list:
                         for p in model.parameters():
@@ -225,16 +358,19 @@ class TextSR(base.TextBase):
                     else:
                         images_lr = images_lr.to(self.device)
                     images_hr = images_hr.to(self.device)
+                    step_timer.lap('h2d')
 
                     loss_ssim = 0.
 
                     if self.args.arch == "tsrn":
                         image_sr = model(images_lr)
+                        step_timer.lap('sr')
                         loss_img = loss_im = image_crit(image_sr, images_hr).mean() * 100
                         loss_recog_distill = torch.zeros(1)
                     elif self.args.arch == "sem_tsrn":
                         # print("keys:", image_crit.keys())
                         image_sr, all_pred_vecs = model(images_lr, word_vec)
+                        step_timer.lap('sr')
 
                         # print("shape:", image_sr.shape, image_masks.unsqueeze(1).shape)
 
@@ -250,6 +386,7 @@ class TextSR(base.TextBase):
                     elif self.args.arch == "tsrn_c2f":
                         
                         image_sr, image_coar = model(images_lr)
+                        step_timer.lap('sr')
 
                         loss_img = image_crit(image_sr, images_hr).mean() * 100
                         loss_coar = image_crit(image_coar, image_coar_gt).mean() * 100
@@ -261,10 +398,10 @@ class TextSR(base.TextBase):
                         aster_dict_lr = self.parse_crnn_data(images_lr[:, :3, :, :])
                         label_vecs_logits = aster_student(aster_dict_lr)
                         label_vecs = torch.nn.functional.softmax(label_vecs_logits, -1)
+                        step_timer.lap('tpg')
 
-                        aster_dict_hr = self.parse_crnn_data(images_hr[:, :3, :, :])
-                        label_vecs_logits_hr = aster(aster_dict_hr).detach()
-                        label_vecs_hr = torch.nn.functional.softmax(label_vecs_logits_hr, -1)
+                        label_vecs_hr = self.teacher_prior(aster, images_hr, indices)
+                        step_timer.lap('teacher')
 
                         # label_vecs[label_vecs > 0.5] = 1.
                         # print("label_vecs:", np.unique(label_vecs.data.cpu().numpy()))
@@ -286,6 +423,7 @@ class TextSR(base.TextBase):
                         ###############################################
 
                         image_sr = model(images_lr, label_vecs_final)
+                        step_timer.lap('sr')
 
                         loss_img = image_crit(image_sr, images_hr, grad_mask=weighted_mask).mean() * 100
                         # loss_recog_distill# = torch.abs(label_vecs - label_vecs_hr).mean() * 100
@@ -294,9 +432,8 @@ class TextSR(base.TextBase):
 
                     elif self.args.arch in ABLATION_SET:
 
-                        aster_dict_hr = self.parse_crnn_data(images_hr[:, :3, :, :])
-                        label_vecs_logits_hr = aster(aster_dict_hr).detach()
-                        label_vecs_hr = torch.nn.functional.softmax(label_vecs_logits_hr, -1)
+                        label_vecs_hr = self.teacher_prior(aster, images_hr, indices)
+                        step_timer.lap('teacher')
 
                         cascade_images = images_lr
 
@@ -317,6 +454,7 @@ class TextSR(base.TextBase):
 
                             label_vecs_logits = stu_model(aster_dict_lr)
                             label_vecs = torch.nn.functional.softmax(label_vecs_logits, -1)
+                            step_timer.lap('tpg')
 
                             label_vecs_final = label_vecs.permute(1, 0, 2).unsqueeze(1).permute(0, 3, 1, 2)
 
@@ -380,8 +518,10 @@ class TextSR(base.TextBase):
                             drop_vec = drop_vec.to(device)
                             # print("drop_vex:", drop_vec.shape, drop_vec)
                             label_vecs_final = label_vecs_final * drop_vec.view(-1, 1, 1, 1)
+                            step_timer.lap('loss')
 
                             cascade_images = model_list[pick](images_lr, label_vecs_final)
+                            step_timer.lap('sr')
                             loss_img_each = image_crit(cascade_images, images_hr).mean() * 100
                             loss_img += loss_img_each
                             
@@ -391,6 +531,7 @@ class TextSR(base.TextBase):
                                 loss_img += loss_ssim
                             #loss_img += loss_img_each # * (1 + 0.5 * i)
                             #loss_img += loss_ssim  # * (1 + 0.5 * i)
+                            step_timer.lap('loss')
 
                             if iters % 5 == 0 and i == self.args.stu_iter - 1:
 
@@ -402,6 +543,7 @@ class TextSR(base.TextBase):
 
                                 self.results_recorder.add_scalar('loss/SSIM', float(loss_ssim) * 100,
                                                                  global_step=iters)
+                                step_timer.lap('other')
 
                         loss_im = loss_img + loss_recog_distill
 
@@ -413,15 +555,24 @@ class TextSR(base.TextBase):
                             channel_num = 4
 
                         image_sr = model(images_lr[:, :channel_num, ...])
+                        step_timer.lap('sr')
                         loss_img = loss_im = image_crit(image_sr, images_hr[:, :channel_num, ...]).mean() * 100
                         loss_recog_distill = torch.zeros(1)
                     
+                    step_timer.lap('loss')
+
                     optimizer_G.zero_grad()
-                    loss_im.backward()
+                    scaler.scale(loss_im).backward()
+                    step_timer.lap('backward')
 
+                    # clip the true gradients
+                    scaler.unscale_(optimizer_G)
                     for model in model_list:
                         torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                    optimizer_G.step()
+                    step_timer.lap('clip')
+                    scaler.step(optimizer_G)
+                    scaler.update()
+                    step_timer.lap('step')
                     if iters % 5 == 0:
 
                         self.results_recorder.add_scalar('loss/total', float(loss_im.data) * 100,
@@ -446,8 +597,12 @@ class TextSR(base.TextBase):
                                       float(loss_ssim),
                                       float(loss_recog_distill.data),
                                       lr))
+                    step_timer.lap('other')
+                    step_timer.step(images_hr.shape[0])
+                    if is_main and iters % cfg.displayInterval == 0:
+                        step_timer.export(self.results_recorder, iters, timing_path)
 
-                if iters % cfg.VAL.valInterval == 0 or self.args.go_test:
+                if is_main and (iters % cfg.VAL.valInterval == 0 or self.args.go_test):
                     print('======================================================')
                     current_acc_dict = {}
                     for k, val_loader in enumerate(val_loader_list):
@@ -474,13 +629,20 @@ class TextSR(base.TextBase):
                         # Tuned TPG for recognition:
                         # test_bible[self.args.test_model]['model'] = aster#aster_student[-1]
 
+                        rec_cache = None
+                        if rec_hash is not None:
+                            rec_cache = rec_cache_dict.setdefault(
+                                (self.config.TRAIN.VAL.val_data_dir[k], rec_hash), {})
+
+                        # the bare models: a DDP forward on rank 0 alone would wait for the others
                         metrics_dict = self.eval(
-                            model_list,
+                            distributed.unwrap(model_list),
                             val_loader,
                             image_crit,
                             iters,
-                            [test_bible[self.args.test_model], aster_student, aster], #
-                            aster_info
+                            [test_bible[self.args.test_model], distributed.unwrap(aster_student), aster], #
+                            aster_info,
+                            rec_cache=rec_cache
                         )
 
                         for key in metrics_dict:
@@ -520,9 +682,8 @@ class TextSR(base.TextBase):
 
                         # if self.args.go_test:
                         #     break
-                    if self.args.go_test:
-                        break
-                    if sum(current_acc_dict.values()) > best_acc:
+                    step_timer.lap('val')
+                    if not self.args.go_test and sum(current_acc_dict.values()) > best_acc:
                         best_acc = sum(current_acc_dict.values())
                         best_model_acc = current_acc_dict
                         best_model_acc['epoch'] = epoch
@@ -531,13 +692,41 @@ class TextSR(base.TextBase):
                         best_model_info = {'accuracy': best_model_acc, 'psnr': best_model_psnr, 'ssim': best_model_ssim}
                         print('saving best model')
                         self.save_checkpoint(model_list, epoch, iters, best_history_acc, best_model_info, True, converge_list, recognizer=aster_student)
+                        step_timer.lap('checkpoint')
+
+                if self.args.go_test or iters % cfg.VAL.valInterval == 0:
+                    if distributed.is_distributed():
+                        # every rank waits for the validation of rank 0 and leaves it in the same iteration
+                        torch.distributed.barrier()
+                        step_timer.lap('val')
+                    if self.args.go_test:
+                        break
 
-                if iters % cfg.saveInterval == 0:
+                if is_main and iters % cfg.saveInterval == 0:
                     best_model_info = {'accuracy': best_model_acc, 'psnr': best_model_psnr, 'ssim': best_model_ssim}
-                    self.save_checkpoint(model_list, epoch, iters, best_history_acc, best_model_info, False, converge_list, recognizer=aster_student)
+                    train_state = {
+                        'epoch': epoch, 'batch': j + 1,
+                        'optimizer_G': optimizer_G.state_dict(), 'scaler': scaler.state_dict(),
+                        'best_history_acc': best_history_acc, 'best_model_acc': best_model_acc,
+                        'best_model_psnr': best_model_psnr, 'best_model_ssim': best_model_ssim,
+                        'best_acc': best_acc, 'converge_list': converge_list,
+                        'rng': checkpoint.rng_state(),
+                    }
+                    self.save_checkpoint(model_list, epoch, iters, best_history_acc, best_model_info, False, converge_list,
+                                         recognizer=aster_student, train_state=train_state)
+                    step_timer.lap('checkpoint')
+            if self.prior_cache is not None:
+                self.prior_cache.flush()
+                print('Teacher prior cache: %d hits, %d misses' % (self.prior_cache.hits, self.prior_cache.misses))
             if self.args.go_test:
                 break
-    def eval(self, model_list, val_loader, image_crit, index, aster, aster_info):
+        if getattr(self, 'checkpoint_writer', None) is not None:
+            self.checkpoint_writer.close()
+        if is_main:
+            step_timer.write_json(timing_path)
+        self.results_recorder.close()
+
+    def eval(self, model_list, val_loader, image_crit, index, aster, aster_info, rec_cache=None):
 
         n_correct = 0
         n_correct_lr = 0
@@ -595,7 +784,7 @@ class TextSR(base.TextBase):
                     images_hr, images_lr, label_strs, label_vecs_gt = data
                 else:
                     images_hr, images_lr, label_strs = data
-            if self.args.random_reso:
+            if self.args.random_reso and not torch.is_tensor(images_lr):
                 val_batch_size = len(images_lr)
                 images_lr = [image_lr.to(self.device) for image_lr in images_lr]
                 images_hr = [image_hr.to(self.device) for image_hr in images_hr]
@@ -623,24 +812,11 @@ class TextSR(base.TextBase):
 
             if self.args.arch == "tsrn":
                 if self.args.random_reso:
-                    images_sr = []
-                    for i in range(len(images_lr)):
-                        image_lr = images_lr[i]
-                        if len(image_lr.shape) < 4:
-                            image_lr = image_lr.unsqueeze(0)
-                        if SR_confidence[i] > 0.9 and image_lr.shape[-2] > 16:
-
-                            SR_stat.append("LR")
-
-                            image_sr = image_lr
-                            go_LR += 1
-                        else:
-
-                            SR_stat.append("SR")
-
-                            image_sr = model_list[0](image_lr)
-                            go_SR += 1
-                        images_sr.append(image_sr)
+                    keep = [SR_confidence[i] > 0.9 and images_lr[i].shape[-2] > 16 for i in range(val_batch_size)]
+                    SR_stat = ["LR" if k else "SR" for k in keep]
+                    go_LR += sum(keep)
+                    go_SR += len(keep) - sum(keep)
+                    images_sr = self.reso_sr(images_lr, keep, model_list[0])
                     SR_tick = True
                 else:
                     images_sr = model_list[0](images_lr)
@@ -683,52 +859,33 @@ class TextSR(base.TextBase):
                     label_vecs_hr = torch.nn.functional.softmax(label_vecs_hr, -1)
 
                 if self.args.random_reso:
+                    keep = [SR_confidence[j] > 0.85 and images_lr[j].shape[-2] > 16 for j in range(val_batch_size)]  # SR_confidence > 0.9 or
+                    SR_stat = ["LR" if k else "SR" for k in keep]
+                    go_LR += sum(keep)
+                    go_SR += len(keep) - sum(keep)
 
                     for i in range(self.args.stu_iter):
-                        new_cascade_images = []
                         # if i > 0:
                         #     SR_confidence = self.cal_conf(cascade_images, aster[1][i])
+                        if self.args.tpg_share:
+                            tpg_pick = 0
+                        else:
+                            tpg_pick = i
 
-                        for j in range(len(cascade_images)):
-                            # print("cascade_images:", len(cascade_images), j)
-                            cascade_image = cascade_images[j]
-                            if len(cascade_image.shape) < 4:
-                                cascade_image = cascade_image.unsqueeze(0)
-
-                            if len(images_lr[j].shape) < 4:
-                                image_lr = images_lr[j].unsqueeze(0)
-                            else:
-                                image_lr = images_lr[j]
-
-                            if SR_confidence[j] > 0.85 and image_lr.shape[-2] > 16:  # SR_confidence > 0.9 or
-                                if i == self.args.stu_iter - 1:
-                                    go_LR += 1
-                                    SR_stat.append("LR")
-                                new_cascade_images.append(image_lr)
-                            else:
-                                if i == self.args.stu_iter - 1:
-                                    go_SR += 1
-                                    SR_stat.append("SR")
-                                if self.args.tpg_share:
-                                    tpg_pick = 0
-                                else:
-                                    tpg_pick = i
-
-                                stu_model = aster[1][tpg_pick]
-                                aster_dict_lr = self.parse_crnn_data(cascade_image[:, :3, :, :])
-                                label_vecs_logits = stu_model(aster_dict_lr)
+                        if self.args.sr_share:
+                            pick = 0
+                        else:
+                            pick = i
 
-                                label_vecs = torch.nn.functional.softmax(label_vecs_logits, -1)
-                                label_vecs_final = label_vecs.permute(1, 0, 2).unsqueeze(1).permute(0, 3, 1, 2)
+                        def cascade_sr(image_lr, cascade_image):
+                            aster_dict_lr = self.parse_crnn_data(cascade_image[:, :3, :, :])
+                            label_vecs_logits = aster[1][tpg_pick](aster_dict_lr)
 
-                                if self.args.sr_share:
-                                    pick = 0
-                                else:
-                                    pick = i
+                            label_vecs = torch.nn.functional.softmax(label_vecs_logits, -1)
+                            label_vecs_final = label_vecs.permute(1, 0, 2).unsqueeze(1).permute(0, 3, 1, 2)
+                            return model_list[pick](image_lr, label_vecs_final)
 
-                                cascade_image = model_list[pick](image_lr, label_vecs_final)
-                                new_cascade_images.append(cascade_image)
-                        cascade_images = new_cascade_images
+                        cascade_images = self.reso_sr(images_lr, keep, cascade_sr, cascade_images)
                         images_sr.append(cascade_images)
                 else:
                     # Get char mask
@@ -774,30 +931,31 @@ class TextSR(base.TextBase):
                     channel_num = 4
 
                 if self.args.random_reso:
-                    images_sr = []
-                    for i in range(len(images_lr)):
-                        image_lr = images_lr[i]
-                        if len(image_lr.shape) < 4:
-                            image_lr = image_lr.unsqueeze(0)
-                        if SR_confidence[i] > 0.9 or image_lr.shape[-2] > 32:
-                            image_sr = image_lr[:, :channel_num, ...]
-                            SR_stat.append("LR")
-                            go_LR += 1
-                        else:
-                            image_sr = model_list[0](image_lr[:, :channel_num, ...])
-                            SR_stat.append("SR")
-                            go_SR += 1
-                        images_sr.append(image_sr)
+                    keep = [SR_confidence[i] > 0.9 or images_lr[i].shape[-2] > 32 for i in range(val_batch_size)]
+                    SR_stat = ["LR" if k else "SR" for k in keep]
+                    go_LR += sum(keep)
+                    go_SR += len(keep) - sum(keep)
+                    if torch.is_tensor(images_lr):
+                        images_in = images_lr[:, :channel_num, ...]
+                    else:
+                        images_in = [image_lr[..., :channel_num, :, :] for image_lr in images_lr]
+                    images_sr = self.reso_sr(images_in, keep, model_list[0])
                     SR_tick = True
                 else:
                     images_sr = model_list[0](images_lr[:, :channel_num, ...])
 
-            aster_dict_lr = aster[0]["data_in_fn"](images_lr) # [:, :3, ...]
-            aster_dict_hr = aster[0]["data_in_fn"](images_hr) # [:, :3, ...]
+            # LR and HR predictions of this batch from an earlier validation, see TextSR.train
+            rec_cached = rec_cache is not None and iter_i in rec_cache
+
+            if not rec_cached:
+                aster_dict_lr = aster[0]["data_in_fn"](images_lr) # [:, :3, ...]
+                aster_dict_hr = aster[0]["data_in_fn"](images_hr) # [:, :3, ...]
 
             # if not self.args.random_reso:
 
-            if self.args.test_model == "MORAN":
+            if rec_cached:
+                pass
+            elif self.args.test_model == "MORAN":
                 # aster_output_sr = aster[0]["model"](*aster_dict_sr)
                 # LR
                 aster_output_lr = aster[0]["model"](
@@ -1018,7 +1176,9 @@ class TextSR(base.TextBase):
             # predict_result_lr = aster[0]["string_process"](outputs_lr)
             # predict_result_hr = aster[0]["string_process"](outputs_hr)
 
-            if self.args.test_model == "CRNN":
+            if rec_cached:
+                predict_result_lr, predict_result_hr = rec_cache[iter_i]
+            elif self.args.test_model == "CRNN":
                 predict_result_lr = aster[0]["string_process"](aster_output_lr)
                 predict_result_hr = aster[0]["string_process"](aster_output_hr)
             elif self.args.test_model == "ASTER":
@@ -1088,6 +1248,8 @@ class TextSR(base.TextBase):
                     # print("out_str:", out_str)
                     predict_result_hr.append(out_str)
 
+            if rec_cache is not None and not rec_cached:
+                rec_cache[iter_i] = (predict_result_lr, predict_result_hr)
 
             # print("标签",label_strs)
             # pred_rec_lr = aster_output_lr['output']['pred_rec']
@@ -1356,7 +1518,7 @@ class TextSR(base.TextBase):
             moran = self.MORAN_init()
             moran.eval()
         elif self.args.rec == 'aster':
-            aster, aster_info = self.Aster_init()
+            aster, aster_info = self.Aster_init(inference=True)
             aster.eval()
         elif self.args.rec == 'crnn':
             crnn = self.CRNN_init()
@@ -1435,31 +1597,35 @@ class TextSR(base.TextBase):
     def demo(self):
         mask_ = self.args.mask
 
+        # the exported cascade takes LR crops
+        cfg = self.config.TRAIN
+        demo_size = (cfg.width // cfg.down_sample_scale, cfg.height // cfg.down_sample_scale) \
+            if self.args.onnx is not None else (256, 32)
+
         def transform_(path):
             img = Image.open(path)
-            img = img.resize((256, 32), Image.BICUBIC)
+            img = img.resize(demo_size, Image.BICUBIC)
             img_tensor = transforms.ToTensor()(img)
             if mask_:
-                mask = img.convert('L')
-                thres = np.array(mask).mean()
-                mask = mask.point(lambda x: 0 if x > thres else 255)
-                mask = transforms.ToTensor()(mask)
-                img_tensor = torch.cat((img_tensor, mask), 0)
+                img_tensor = torch.cat((img_tensor, get_mask_tensor(img)), 0)
             img_tensor = img_tensor.unsqueeze(0)
             return img_tensor
 
-        model_dict = self.generator_init()
-        model, image_crit = model_dict['model'], model_dict['crit']
+        if self.args.onnx is not None:
+            model = ORTCascade(self.args.onnx)
+        else:
+            model_dict = self.generator_init()
+            model, image_crit = model_dict['model'], model_dict['crit']
         if self.args.rec == 'moran':
             moran = self.MORAN_init()
             moran.eval()
         elif self.args.rec == 'aster':
-            aster, aster_info = self.Aster_init()
+            aster, aster_info = self.Aster_init(inference=True)
             aster.eval()
         elif self.args.rec == 'crnn':
             crnn = self.CRNN_init()
             crnn.eval()
-        if self.args.arch != 'bicubic':
+        if self.args.arch != 'bicubic' and self.args.onnx is None:
             for p in model.parameters():
                 p.requires_grad = False
             model.eval()
@@ -1522,6 +1688,159 @@ class TextSR(base.TextBase):
         fps = sum_images / (time_end - time_begin)
         print('fps=', fps)
 
+    def infer_models(self):
+        # SR model(s) and TPG(s) from --resume, loaded the way train() does
+        if self.args.onnx is not None:
+            # the exported cascade replaces both, see infer_sr
+            return [ORTCascade(self.args.onnx)], []
+        TP_Generator_dict = {
+            "CRNN": self.CRNN_init,
+            "OPT": self.TPG_init
+        }
+        model_list = [self.generator_init(0)['model']]
+        if not self.args.sr_share:
+            for i in range(self.args.stu_iter - 1):
+                model_list.append(self.generator_init(i + 1)['model'])
+
+        tpg_list = []
+        resume_dir = self.resume if os.path.isdir(self.resume) else "/".join(self.resume.split("/")[:-1])
+        if self.args.arch in ["tsrn_tl", "tsrn_tl_wmask"]:
+            recognizer_path = os.path.join(resume_dir, "recognizer_best.pth")
+            tpg_list.append(self.CRNN_init(recognizer_path=recognizer_path if os.path.isfile(recognizer_path) else None)[0])
+        elif self.args.arch in ABLATION_SET:
+            for i in range(self.args.stu_iter):
+                recognizer_path = os.path.join(resume_dir, "recognizer_best_" + str(i) + ".pth")
+                tpg, _ = TP_Generator_dict[self.args.tpg](
+                    recognizer_path=recognizer_path if os.path.isfile(recognizer_path) else None, opt=self.opt_TPG)
+                if type(tpg) == list:
+                    tpg = tpg[i]
+                tpg_list.append(tpg)
+
+        for model in model_list + tpg_list:
+            model.eval()
+            for p in model.parameters():
+                p.requires_grad = False
+        return model_list, tpg_list
+
+    def infer_cascade(self):
+        # the SR + TPG inference graph of infer_sr as a single module, for export_onnx.py
+        if self.args.arch not in ["tsrn_tl", "tsrn_tl_wmask"] + ABLATION_SET:
+            raise ValueError('arch %s has no TPG cascade to export' % self.args.arch)
+        model_list, tpg_list = self.infer_models()
+        cfg = self.config.TRAIN
+        stu_iter = self.args.stu_iter if self.args.arch in ABLATION_SET else 1
+        return TPGSRCascade(model_list, tpg_list, stu_iter=stu_iter,
+                            sr_share=self.args.sr_share, tpg_share=self.args.tpg_share,
+                            in_width=cfg.width if cfg.width != 128 else 100)
+
+    def infer_sr(self, model_list, tpg_list, images_lr):
+        if self.args.onnx is not None:
+            return model_list[0](images_lr)
+        elif self.args.arch in ["tsrn_tl", "tsrn_tl_wmask"]:
+            label_vecs = torch.nn.functional.softmax(tpg_list[0](self.parse_crnn_data(images_lr[:, :3, :, :])), -1)
+            label_vecs = label_vecs.permute(1, 0, 2).unsqueeze(1).permute(0, 3, 1, 2)
+            return model_list[0](images_lr, label_vecs)
+        elif self.args.arch in ABLATION_SET:
+            cascade_images = images_lr
+            for i in range(self.args.stu_iter):
+                tpg_pick = 0 if self.args.tpg_share else i
+                pick = 0 if self.args.sr_share else i
+                label_vecs = torch.nn.functional.softmax(
+                    tpg_list[tpg_pick](self.parse_crnn_data(cascade_images[:, :3, :, :])), -1)
+                label_vecs = label_vecs.permute(1, 0, 2).unsqueeze(1).permute(0, 3, 1, 2)
+                cascade_images = model_list[pick](images_lr, label_vecs)
+            return cascade_images
+        else:
+            channel_num = 3 if self.args.arch in ["srcnn", "rdn", "vdsr"] else 4
+            return model_list[0](images_lr[:, :channel_num, ...])
+
+    def infer_recognizer_init(self):
+        aster_info = None
+        if self.args.rec == 'moran':
+            rec = self.MORAN_init()
+        elif self.args.rec == 'aster':
+            rec, aster_info = self.Aster_init(inference=True)
+        else:
+            rec, aster_info = self.CRNN_init()
+        rec.eval()
+        return rec, aster_info
+
+    def infer_recognize(self, rec, images, aster_info=None):
+        if self.args.rec == 'moran':
+            moran_input = self.parse_moran_data(images[:, :3, :, :])
+            moran_output = rec(moran_input[0], moran_input[1], moran_input[2], moran_input[3], test=True, debug=True)
+            preds, preds_reverse = moran_output[0]
+            _, preds = preds.max(1)
+            sim_preds = self.converter_moran.decode(preds.data, moran_input[1].data)
+            if type(sim_preds) != list:
+                sim_preds = [sim_preds]
+            return [pred.split('$')[0] for pred in sim_preds]
+        elif self.args.rec == 'aster':
+            aster_dict = self.parse_aster_data(images[:, :3, :, :])
+            aster_output = rec(aster_dict)
+            pred_str, _ = get_string_aster(aster_output['output']['pred_rec'], aster_dict['rec_targets'], dataset=aster_info)
+            return pred_str
+        else:
+            return get_string_crnn(rec(self.parse_crnn_data(images[:, :3, :, :])))
+
+    def infer(self):
+        """
+        Batched SR + recognition of unlabeled LR crops (--infer_src: LMDB, directory or glob).
+        Images are decoded by the DataLoader workers, results are appended to --infer_out
+        (.jsonl or .csv) batch by batch, SR images are written to --infer_save_sr if given.
+        """
+        cfg = self.config.TRAIN
+        workers = self.args.infer_workers if self.args.infer_workers is not None else int(cfg.workers)
+        infer_dataset = inferDataset(self.args.infer_src)
+        infer_loader = torch.utils.data.DataLoader(
+            infer_dataset, batch_size=self.batch_size,
+            shuffle=False, num_workers=workers,
+            collate_fn=alignCollate_infer(imgH=cfg.height, imgW=cfg.width,
+                                          down_sample_scale=cfg.down_sample_scale, mask=self.mask),
+            drop_last=False)
+
+        model_list, tpg_list = self.infer_models()
+        rec, aster_info = self.infer_recognizer_init()
+
+        if self.args.infer_save_sr is not None and not os.path.isdir(self.args.infer_save_sr):
+            os.makedirs(self.args.infer_save_sr)
+
+        out_csv = self.args.infer_out.endswith('.csv')
+        out_file = open(self.args.infer_out, 'w')
+        if out_csv:
+            writer = csv.writer(out_file)
+            writer.writerow(['name', 'label', 'pred'])
+
+        sum_images = 0
+        time_begin = time.time()
+        with torch.no_grad():
+            for images_lr, names, labels in tqdm(infer_loader):
+                if images_lr is None:
+                    continue
+                images_lr = images_lr.to(self.device)
+                images_sr = self.infer_sr(model_list, tpg_list, images_lr)
+                preds = self.infer_recognize(rec, images_sr, aster_info)
+
+                for k in range(len(names)):
+                    if out_csv:
+                        writer.writerow([names[k], labels[k], preds[k]])
+                    else:
+                        out_file.write(json.dumps({'name': names[k], 'label': labels[k], 'pred': preds[k]}) + '\n')
+                out_file.flush()
+
+                if self.args.infer_save_sr is not None:
+                    images = (images_sr[:, :3, :, :].clamp(0, 1) * 255).round().byte()
+                    images = images.permute(0, 2, 3, 1).cpu().numpy()
+                    for k in range(len(names)):
+                        save_name = os.path.splitext(os.path.basename(names[k]))[0] + '.png'
+                        Image.fromarray(images[k]).save(os.path.join(self.args.infer_save_sr, save_name))
+                sum_images += len(names)
+        out_file.close()
+
+        time_end = time.time()
+        print('Inferred %d images, fps=%.2f, results in %s'
+              % (sum_images, sum_images / (time_end - time_begin), self.args.infer_out))
+
 
 if __name__ == '__main__':
     embed()
@@ -5,20 +5,25 @@ import os
 from IPython import embed
 from easydict import EasyDict
 from interfaces.super_resolution import TextSR
+from utils import distributed
 
 
 def main(config, args, opt_TPG):
+    if args.distributed or args.nproc > 1:
+        distributed.init_distributed(args.dist_backend, args.dist_timeout)
     Mission = TextSR(config, args, opt_TPG)
 
     if args.test:
         Mission.test()
     elif args.demo:
         Mission.demo()
+    elif args.infer:
+        Mission.infer()
     else:
         Mission.train()
 
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--arch', default='tsrn_tl_wmask', choices=['tsrn', 'bicubic', 'srcnn', 'vdsr', 'srres', 'esrgan', 'rdn',
                                                            'edsr', 'lapsrn', 'tsrn_tl_wmask', 'tsrn_tl_cascade', 'srcnn_tl', 'srresnet_tl', 'rdn_tl', 'vdsr_tl'])
@@ -47,16 +52,41 @@ if __name__ == '__main__':
     parser.add_argument('--use_distill', action='store_true', default=False)
     parser.add_argument('--ssim_loss', action='store_true', default=False)
     parser.add_argument('--random_reso', action='store_true', default=False)
+    parser.add_argument('--bucket', action='store_true', default=False, help='--random_reso: batch samples of near-equal size together')
+    parser.add_argument('--bucket_tol', type=float, default=0.1, help='relative height / aspect ratio step of the --bucket size bins, 0 for equal sizes only')
+    parser.add_argument('--sequential_val', action='store_true', default=False, help='read LMDB val / test sets with sequential cursor scans')
+    parser.add_argument('--degrade', action='store_true', default=False, help='synthesize the LR of --syn / --mixed samples with TRAIN.DEGRADATION')
     parser.add_argument('--tpg', type=str, default="CRNN", choices=['CRNN', 'OPT'])
     parser.add_argument('--config', type=str, default='super_resolution.yaml')
-    args = parser.parse_args()
+    parser.add_argument('--infer', action='store_true', default=False, help='batched SR + recognition of unlabeled crops')
+    parser.add_argument('--infer_src', type=str, default='./demo', help='LMDB, image directory or glob of LR crops')
+    parser.add_argument('--infer_out', type=str, default='infer_results.jsonl', help='.jsonl or .csv result file')
+    parser.add_argument('--infer_save_sr', type=str, default=None, help='directory to save the SR images in')
+    parser.add_argument('--infer_workers', type=int, default=None, help='decoding workers, TRAIN.workers by default')
+    parser.add_argument('--onnx', type=str, default=None, help='exported SR + TPG cascade (export_onnx.py) run with ONNX Runtime in --infer / --demo')
+    parser.add_argument('--beam_width', type=int, default=5, help='beam width of the ASTER decoder, 1 is greedy decoding')
+    parser.add_argument('--prior_cache', type=str, default=None, help='directory caching the teacher TPG priors of the HR training images')
+    parser.add_argument('--prior_precompute', action='store_true', default=False, help='fill the teacher prior cache before training')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='autocast the SR models, TPGs, recognizers and losses, RNNs stay in fp32')
+    parser.add_argument('--step_timing', action='store_true', default=False,
+                        help='time the phases of the training steps, to tensorboard and ckpt/<vis_dir>/step_timing.json')
+    parser.add_argument('--resume_train', action='store_true', default=False,
+                        help='continue the training saved in the --resume checkpoint dir: weights, optimizer, iteration, RNGs, best results')
+    parser.add_argument('--distributed', action='store_true', default=False, help='DDP training, one process per GPU / CPU share, started with torchrun')
+    parser.add_argument('--nproc', type=int, default=1, help='spawn this many --distributed processes on this node instead of torchrun')
+    parser.add_argument('--dist_backend', type=str, default=None, choices=['nccl', 'gloo'], help='nccl with CUDA, gloo otherwise by default')
+    parser.add_argument('--dist_timeout', type=int, default=60, help='minutes the processes wait for each other, e.g. during validation on rank 0')
+    return parser
+
+
+def get_config(args):
     config_path = os.path.join('config', args.config)
     config = yaml.load(open(config_path, 'r'), Loader=yaml.Loader)
-    config = EasyDict(config)
-
+    return EasyDict(config)
 
-    parser_TPG = argparse.ArgumentParser()
 
+def get_opt_TPG():
     opt = {
         "Transformation": 'None',
         "FeatureExtraction": 'ResNet',
@@ -73,4 +103,14 @@ if __name__ == '__main__':
     opt["num_class"] = len(opt['character'])
 
     opt = EasyDict(opt)
-    main(config, args, opt_TPG=opt)
+    return opt
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    config = get_config(args)
+    opt = get_opt_TPG()
+    if args.nproc > 1:
+        distributed.launch(main, args.nproc, (config, args, opt))
+    else:
+        main(config, args, opt_TPG=opt)
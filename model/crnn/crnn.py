@@ -16,7 +16,9 @@ class BidirectionalLSTM(nn.Module):
             self.rnn.flatten_parameters()
             setattr(self, '_flattened', True)
 
-        recurrent, _ = self.rnn(input)
+        # fp32 under --precision bf16 / fp16
+        with torch.autocast(input.device.type, enabled=False):
+            recurrent, _ = self.rnn(input.float())
         T, b, h = recurrent.size()
         t_rec = recurrent.view(T * b, h)
 
@@ -74,8 +74,8 @@ class Model(nn.Module):
 
         """ Feature extraction stage """
         visual_feature = self.FeatureExtraction(input)
-        visual_feature = self.AdaptiveAvgPool(visual_feature.permute(0, 3, 1, 2))  # [b, c, h, w] -> [b, w, c, h]
-        visual_feature = visual_feature.squeeze(3)
+        # same as self.AdaptiveAvgPool + squeeze(3), which cannot be exported to ONNX with a dynamic batch
+        visual_feature = visual_feature.permute(0, 3, 1, 2).mean(3)  # [b, c, h, w] -> [b, w, c, h] -> [b, w, c]
 
         """ Sequence modeling stage """
         if self.stages['Seq'] == 'BiLSTM':
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 
 
@@ -14,6 +15,8 @@ class BidirectionalLSTM(nn.Module):
         output : contextual feature [batch_size x T x output_size]
         """
         self.rnn.flatten_parameters()
-        recurrent, _ = self.rnn(input)  # batch_size x T x input_size -> batch_size x T x (2*hidden_size)
+        # fp32 under --precision bf16 / fp16
+        with torch.autocast(input.device.type, enabled=False):
+            recurrent, _ = self.rnn(input.float())  # batch_size x T x input_size -> batch_size x T x (2*hidden_size)
         output = self.linear(recurrent)  # batch_size x T x output_size
         return output
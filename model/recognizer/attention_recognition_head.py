@@ -27,14 +27,14 @@ class AttentionRecognitionHead(nn.Module):
     x, targets, lengths = x
     batch_size = x.size(0)
     # Decoder
-    state = torch.zeros(1, batch_size, self.sDim).cuda()
+    state = torch.zeros(1, batch_size, self.sDim, device=x.device)
     outputs = []
 
     for i in range(max(lengths)):
       if i == 0:
-        y_prev = torch.zeros((batch_size)).fill_(self.num_classes).cuda() # the last one is used as the <BOS>.
+        y_prev = torch.zeros((batch_size), device=x.device).fill_(self.num_classes) # the last one is used as the <BOS>.
       else:
-        y_prev = targets[:,i-1].cuda()
+        y_prev = targets[:,i-1].to(x.device)
 
       output, state = self.decoder(x, state, y_prev)
       outputs.append(output)
@@ -46,12 +46,12 @@ class AttentionRecognitionHead(nn.Module):
     x, _, _ = x
     batch_size = x.size(0)
     # Decoder
-    state = torch.zeros(1, batch_size, self.sDim)
+    state = torch.zeros(1, batch_size, self.sDim, device=x.device)
 
     predicted_ids, predicted_scores = [], []
     for i in range(self.max_len_labels):
       if i == 0:
-        y_prev = torch.zeros((batch_size)).fill_(self.num_classes)
+        y_prev = torch.zeros((batch_size), device=x.device).fill_(self.num_classes)
       else:
         y_prev = predicted
 
@@ -65,122 +65,104 @@ class AttentionRecognitionHead(nn.Module):
     # return predicted_ids.squeeze(), predicted_scores.squeeze()
     return predicted_ids, predicted_scores
 
-  def beam_search(self, x, beam_width, eos):
+  def greedy_search(self, x, eos):
+    """
+    Beam search with beam_width 1: argmax decoding that stops once every sample has emitted <EOS>.
+    returns: ids [b x max_len_labels], padded with eos, and the probability of every emitted id.
+    """
+    batch_size = x.size(0)
+    state = torch.zeros(1, batch_size, self.sDim, device=x.device)
+    y_prev = torch.zeros((batch_size), device=x.device).fill_(self.num_classes)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=x.device)
 
-    def _inflate(tensor, times, dim):
-      repeat_dims = [1] * tensor.dim()
-      repeat_dims[dim] = times
-      return tensor.repeat(*repeat_dims)
+    predicted_ids = torch.full((batch_size, self.max_len_labels), eos, dtype=torch.long, device=x.device)
+    predicted_scores = torch.ones(batch_size, self.max_len_labels, device=x.device)
+    for i in range(self.max_len_labels):
+      output, state = self.decoder(x, state, y_prev)
+      score, predicted = F.softmax(output, dim=1).max(1)
+      predicted = predicted.masked_fill(finished, eos)
+      predicted_ids[:, i] = predicted
+      predicted_scores[:, i] = score.masked_fill(finished, 1.)
+      finished = finished | predicted.eq(eos)
+      if bool(finished.all()):
+        break
+      y_prev = predicted
+    return predicted_ids, predicted_scores
+
+  def beam_search(self, x, beam_width, eos):
+    """
+    Batched beam search on the device of x, beam_width 1 falls back to greedy_search.
+    A beam that emits <EOS> becomes a finished hypothesis and is not expanded any more.
+    A sample is done once its best finished hypothesis scores at least as high as its best
+    live beam (log-probabilities only decrease), and decoding stops when every sample is done.
+    returns: the best sequence [b x max_len_labels], padded with eos, and per-step scores of ones.
+    """
+    if beam_width == 1:
+      return self.greedy_search(x, eos)
 
     # https://github.com/IBM/pytorch-seq2seq/blob/fede87655ddce6c94b38886089e05321dc9802af/seq2seq/models/TopKDecoder.py
     batch_size, l, d = x.size()
-    # inflated_encoder_feats = _inflate(encoder_feats, beam_width, 0) # ABC --> AABBCC -/-> ABCABC
-    inflated_encoder_feats = x.unsqueeze(1).permute((1,0,2,3)).repeat((beam_width,1,1,1)).permute((1,0,2,3)).contiguous().view(-1, l, d)
+    device = x.device
+    num_beams = batch_size * beam_width
+    # ABC --> AAABBBCCC
+    inflated_encoder_feats = x.unsqueeze(1).expand(batch_size, beam_width, l, d).contiguous().view(-1, l, d)
 
-    # Initialize the decoder
-    state = torch.zeros(1, batch_size * beam_width, self.sDim).cuda()
-    pos_index = (torch.Tensor(range(batch_size)) * beam_width).long().view(-1, 1).cuda()
+    state = torch.zeros(1, num_beams, self.sDim, device=device)
+    pos_index = (torch.arange(batch_size, device=device) * beam_width).view(-1, 1)
 
-    # Initialize the scores
-    sequence_scores = torch.Tensor(batch_size * beam_width, 1).cuda()
-    sequence_scores.fill_(-float('Inf'))
-    sequence_scores.index_fill_(0, torch.Tensor([i * beam_width for i in range(0, batch_size)]).long().cuda(), 0.0)
-    # sequence_scores.fill_(0.0)
+    # only the first beam of every sample is alive at the first step
+    sequence_scores = torch.full((batch_size, beam_width), -float('inf'), device=device)
+    sequence_scores[:, 0] = 0.
+    y_prev = torch.full((num_beams,), self.num_classes, dtype=torch.long, device=device)
 
-    # Initialize the input vector
-    y_prev = torch.zeros((batch_size * beam_width)).fill_(self.num_classes).cuda()
+    # best finished hypothesis of every sample: score, last step and beam
+    best_scores = torch.full((batch_size,), -float('inf'), device=device)
+    best_steps = torch.zeros(batch_size, dtype=torch.long, device=device)
+    best_beams = torch.zeros(batch_size, dtype=torch.long, device=device)
 
-    # Store decisions for backtracking
-    stored_scores          = list()
-    stored_predecessors    = list()
-    stored_emitted_symbols = list()
+    # [b x k] per step: emitted symbol and beam it extends
+    stored_symbols = []
+    stored_predecessors = []
 
     for i in range(self.max_len_labels):
       output, state = self.decoder(inflated_encoder_feats, state, y_prev)
-      log_softmax_output = F.log_softmax(output, dim=1)
-
-      sequence_scores = _inflate(sequence_scores, self.num_classes, 1)
-      sequence_scores += log_softmax_output
-      scores, candidates = sequence_scores.view(batch_size, -1).topk(beam_width, dim=1)
-
-      # Reshape input = (bk, 1) and sequence_scores = (bk, 1)
-      y_prev = (candidates % self.num_classes).view(batch_size * beam_width)
-      sequence_scores = scores.view(batch_size * beam_width, 1)
+      log_softmax_output = F.log_softmax(output, dim=1).view(batch_size, beam_width, -1)
 
-      # Update fields for next timestep
-      predecessors = (candidates / self.num_classes + pos_index.expand_as(candidates)).view(batch_size * beam_width, 1)
-      state = state.index_select(1, predecessors.squeeze())
+      candidate_scores = (sequence_scores.unsqueeze(2) + log_softmax_output).view(batch_size, -1)
+      scores, candidates = candidate_scores.topk(beam_width, dim=1)
+      symbols = candidates % self.num_classes
+      predecessors = candidates // self.num_classes
 
-      # Update sequence socres and erase scores for <eos> symbol so that they aren't expanded
-      stored_scores.append(sequence_scores.clone())
-      eos_indices = y_prev.view(-1, 1).eq(eos)
-      if eos_indices.nonzero().dim() > 0:
-        sequence_scores.masked_fill_(eos_indices, -float('inf'))
-
-      # Cache results for backtracking
+      state = state.index_select(1, (predecessors + pos_index).view(-1))
+      y_prev = symbols.view(-1)
+      stored_symbols.append(symbols)
       stored_predecessors.append(predecessors)
-      stored_emitted_symbols.append(y_prev)
-
-    # Do backtracking to return the optimal values
-    #====== backtrak ======#
-    # Initialize return variables given different types
-    p = list()
-    l = [[self.max_len_labels] * beam_width for _ in range(batch_size)]  # Placeholder for lengths of top-k sequences
-
-    # the last step output of the beams are not sorted
-    # thus they are sorted here
-    sorted_score, sorted_idx = stored_scores[-1].view(batch_size, beam_width).topk(beam_width)
-    # initialize the sequence scores with the sorted last step beam scores
-    s = sorted_score.clone()
-
-    batch_eos_found = [0] * batch_size  # the number of EOS found
-                                        # in the backward loop below for each batch
-    t = self.max_len_labels - 1
-    # initialize the back pointer with the sorted order of the last step beams.
-    # add pos_index for indexing variable with b*k as the first dimension.
-    t_predecessors = (sorted_idx + pos_index.expand_as(sorted_idx)).view(batch_size * beam_width)
-    while t >= 0:
-      # Re-order the variables with the back pointer
-      current_symbol = stored_emitted_symbols[t].index_select(0, t_predecessors)
-      t_predecessors = stored_predecessors[t].index_select(0, t_predecessors).squeeze()
-      eos_indices = stored_emitted_symbols[t].eq(eos).nonzero()
-      if eos_indices.dim() > 0:
-        for i in range(eos_indices.size(0)-1, -1, -1):
-          # Indices of the EOS symbol for both variables
-          # with b*k as the first dimension, and b, k for
-          # the first two dimensions
-          idx = eos_indices[i]
-          b_idx = int(idx[0] / beam_width)
-          # The indices of the replacing position
-          # according to the replacement strategy noted above
-          res_k_idx = beam_width - (batch_eos_found[b_idx] % beam_width) - 1
-          batch_eos_found[b_idx] += 1
-          res_idx = b_idx * beam_width + res_k_idx
-
-          # Replace the old information in return variables
-          # with the new ended sequence information
-          t_predecessors[res_idx] = stored_predecessors[t][idx[0]]
-          current_symbol[res_idx] = stored_emitted_symbols[t][idx[0]]
-          s[b_idx, res_k_idx] = stored_scores[t][idx[0], [0]]
-          l[b_idx][res_k_idx] = t + 1
-
-      # record the back tracked results
-      p.append(current_symbol)
-
-      t -= 1
-
-    # Sort and re-order again as the added ended sequences may change
-    # the order (very unlikely)
-    s, re_sorted_idx = s.topk(beam_width)
-    for b_idx in range(batch_size):
-      l[b_idx] = [l[b_idx][k_idx.item()] for k_idx in re_sorted_idx[b_idx,:]]
-
-    re_sorted_idx = (re_sorted_idx + pos_index.expand_as(re_sorted_idx)).view(batch_size*beam_width)
-
-    # Reverse the sequences and re-order at the same time
-    # It is reversed because the backtracking happens in reverse time order
-    p = [step.index_select(0, re_sorted_idx).view(batch_size, beam_width, -1) for step in reversed(p)]
-    p = torch.cat(p, -1)[:,0,:]
+
+      # keep the best beam that ends here, and stop expanding every ended beam
+      eos_mask = symbols.eq(eos)
+      ended_scores, ended_beams = scores.masked_fill(~eos_mask, -float('inf')).max(1)
+      better = ended_scores > best_scores
+      best_scores = torch.where(better, ended_scores, best_scores)
+      best_steps = torch.where(better, torch.full_like(best_steps, i), best_steps)
+      best_beams = torch.where(better, ended_beams, best_beams)
+      sequence_scores = scores.masked_fill(eos_mask, -float('inf'))
+
+      if bool((best_scores >= sequence_scores.max(1)[0]).all()):
+        break
+
+    # samples whose live beam still beats every finished one end at the last step without <EOS>
+    last_step = len(stored_symbols) - 1
+    live_scores, live_beams = sequence_scores.max(1)
+    use_live = live_scores > best_scores
+    end_steps = torch.where(use_live, torch.full_like(best_steps, last_step), best_steps)
+    beams = torch.where(use_live, live_beams, best_beams).view(-1, 1)
+
+    # backtrack every sample at once along the stored predecessors
+    p = torch.full((batch_size, self.max_len_labels), eos, dtype=torch.long, device=device)
+    for t in range(last_step, -1, -1):
+      active = end_steps >= t
+      p[:, t] = torch.where(active, stored_symbols[t].gather(1, beams).squeeze(1), p[:, t])
+      beams = torch.where(active.view(-1, 1), stored_predecessors[t].gather(1, beams), beams)
     return p, torch.ones_like(p)
 
 
@@ -207,15 +189,12 @@ class AttentionUnit(nn.Module):
     init.constant_(self.wEmbed.bias, 0)
 
   def forward(self, x, sPrev):
-    sPrev = sPrev.cuda()
     batch_size, T, _ = x.size()                      # [b x T x xDim]
     x = x.contiguous().view(-1, self.xDim)                        # [(b x T) x xDim]
     xProj = self.xEmbed(x)                           # [(b x T) x attDim]
     xProj = xProj.view(batch_size, T, -1)            # [b x T x attDim]
 
     sPrev = sPrev.squeeze(0)
-    from IPython import embed;
-    # embed()
     sProj = self.sEmbed(sPrev)                       # [b x attDim]
     sProj = torch.unsqueeze(sProj, 1)                # [b x 1 x attDim]
     sProj = sProj.expand(batch_size, T, self.attDim) # [b x T x attDim]
@@ -253,15 +232,16 @@ class DecoderUnit(nn.Module):
     init.constant_(self.fc.bias, 0)
 
   def forward(self, x, sPrev, yPrev):
-    sPrev = sPrev.cuda()
     # x: feature sequence from the image decoder.
     batch_size, T, _ = x.size()
     alpha = self.attention_unit(x, sPrev)
     context = torch.bmm(alpha.unsqueeze(1), x).squeeze(1)
-    yPrev = yPrev.cuda()
+    yPrev = yPrev.to(x.device)
     yProj = self.tgt_embedding(yPrev.long())
     self.gru.flatten_parameters()
-    output, state = self.gru(torch.cat([yProj, context], 1).unsqueeze(1), sPrev)
+    # fp32 under --precision bf16 / fp16
+    with torch.autocast(x.device.type, enabled=False):
+      output, state = self.gru(torch.cat([yProj, context], 1).unsqueeze(1).float(), sPrev.float())
     output = output.squeeze(1)
 
     output = self.fc(output)
@@ -28,7 +28,8 @@ class RecognizerBuilder(nn.Module):
     """
     This is the integrated model.
     """
-    def __init__(self, arch, rec_num_classes, sDim = 512, attDim = 512, max_len_labels = 100, eos = 'EOS', STN_ON = True):
+    def __init__(self, arch, rec_num_classes, sDim = 512, attDim = 512, max_len_labels = 100, eos = 'EOS', STN_ON = True,
+                 beam_width = beam_width, inference = False):
         super(RecognizerBuilder, self).__init__()
 
         self.arch = arch
@@ -38,6 +39,10 @@ class RecognizerBuilder(nn.Module):
         self.max_len_labels = max_len_labels
         self.eos = eos
         self.STN_ON = STN_ON
+        # 1 decodes greedily
+        self.beam_width = beam_width
+        # in eval mode only decode, without the teacher-forced pass for loss_rec
+        self.inference = inference
 
         self.tps_inputsize = tps_inputsize
 
@@ -90,10 +95,11 @@ class RecognizerBuilder(nn.Module):
             loss_rec = self.rec_crit(rec_pred, rec_targets, rec_lengths)
             return_dict['losses']['loss_rec'] = loss_rec
         else:
-            rec_pred, rec_pred_scores = self.decoder.beam_search(encoder_feats, beam_width, self.eos)
-            rec_pred_ = self.decoder([encoder_feats, rec_targets, rec_lengths])
-            loss_rec = self.rec_crit(rec_pred_, rec_targets, rec_lengths)
-            return_dict['losses']['loss_rec'] = loss_rec
+            rec_pred, rec_pred_scores = self.decoder.beam_search(encoder_feats, self.beam_width, self.eos)
+            if not self.inference:
+                rec_pred_ = self.decoder([encoder_feats, rec_targets, rec_lengths])
+                loss_rec = self.rec_crit(rec_pred_, rec_targets, rec_lengths)
+                return_dict['losses']['loss_rec'] = loss_rec
             return_dict['output']['pred_rec'] = rec_pred
             return_dict['output']['pred_rec_score'] = rec_pred_scores
 
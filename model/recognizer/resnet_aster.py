@@ -129,7 +129,9 @@ class ResNet_ASTER(nn.Module):
         self.rnn.flatten_parameters()
         setattr(self, '_flattened', True)
 
-      rnn_feat, _ = self.rnn(cnn_feat)
+      # fp32 under --precision bf16 / fp16
+      with torch.autocast(cnn_feat.device.type, enabled=False):
+        rnn_feat, _ = self.rnn(cnn_feat.float())
       return rnn_feat
     else:
       return cnn_feat
@@ -0,0 +1,41 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class TPGSRCascade(nn.Module):
+    """
+    The whole TPGSR inference graph in one module, as TextSR.infer_sr runs it:
+    every stage feeds the current SR image to its TPG, and the softmax text prior
+    of the TPG guides the SR model on the original LR image.
+
+    input:  images_lr [N, C, H, W]
+    output: images_sr [N, C, H * scale, W * scale] of the last stage
+    """
+    def __init__(self, model_list, tpg_list, stu_iter=1, sr_share=False, tpg_share=False, in_width=100):
+        super(TPGSRCascade, self).__init__()
+        self.model_list = nn.ModuleList(model_list)
+        self.tpg_list = nn.ModuleList(tpg_list)
+        self.stu_iter = stu_iter
+        self.sr_share = sr_share
+        self.tpg_share = tpg_share
+        # TPG input size, see parse_crnn_data
+        self.in_width = in_width
+
+    def tpg_input(self, images):
+        images = F.interpolate(images[:, :3, ...], (32, self.in_width), mode='bicubic')
+        R = images[:, 0:1, :, :]
+        G = images[:, 1:2, :, :]
+        B = images[:, 2:3, :, :]
+        return 0.299 * R + 0.587 * G + 0.114 * B
+
+    def forward(self, images_lr):
+        cascade_images = images_lr
+        for i in range(self.stu_iter):
+            tpg_pick = 0 if self.tpg_share else i
+            pick = 0 if self.sr_share else i
+            label_vecs = F.softmax(self.tpg_list[tpg_pick](self.tpg_input(cascade_images)), -1)
+            # [T, B, C] -> [B, C, 1, T]
+            label_vecs = label_vecs.permute(1, 0, 2).unsqueeze(1).permute(0, 3, 1, 2)
+            cascade_images = self.model_list[pick](images_lr, label_vecs)
+        return cascade_images
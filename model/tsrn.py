@@ -501,7 +501,9 @@ class GruBlock(nn.Module):
         b = x.size()
         x = x.view(b[0] * b[1], b[2], b[3])
         self.gru.flatten_parameters()
-        x, _ = self.gru(x)
+        # fp32 under --precision bf16 / fp16
+        with torch.autocast(x.device.type, enabled=False):
+            x, _ = self.gru(x.float())
         # x = self.gru(x)[0]
         x = x.view(b[0], b[1], b[2], b[3])
         x = x.permute(0, 3, 1, 2)
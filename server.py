@@ -0,0 +1,219 @@
+import io
+import sys
+import json
+import time
+import base64
+import threading
+import collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+from PIL import Image
+
+from main import get_parser, get_config, get_opt_TPG
+from interfaces.super_resolution import TextSR
+from dataset import resizeNormalize
+
+
+"""
+Local TPGSR inference server.
+
+The SR model(s), TPG(s) and recognizer are loaded once (same flags as main.py, e.g.
+--arch, --resume, --rec, --mask, --stu_iter). Concurrent requests are gathered into
+micro-batches of at most --max_batch crops, a batch is run as soon as it is full or
+--max_wait_ms after its first request arrived.
+
+    POST /infer?return=text|sr|both   body: an encoded image (png, jpg, ...)
+        -> {"text": "...", "sr": "<base64 png>", "latency_ms": ...}
+    GET  /stats
+        -> request / batch counters, mean batch size, latency percentiles, throughput
+"""
+
+
+class InferStats(object):
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_images = 0
+        self.batch_time = 0.
+        self.latencies = collections.deque(maxlen=window)
+
+    def add_batch(self, size, seconds):
+        with self.lock:
+            self.batches += 1
+            self.batch_images += size
+            self.batch_time += seconds
+
+    def add_request(self, seconds, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latencies.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            latencies = np.array(self.latencies) * 1000.
+            result = {
+                'uptime_s': round(elapsed, 1),
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': round(self.batch_images / max(self.batches, 1), 2),
+                'mean_batch_ms': round(self.batch_time * 1000. / max(self.batches, 1), 2),
+                'throughput_img_s': round(self.batch_images / max(elapsed, 1e-6), 2),
+            }
+            if len(latencies) > 0:
+                for q in [50, 90, 99]:
+                    result['latency_p%d_ms' % q] = round(float(np.percentile(latencies, q)), 2)
+            return result
+
+
+class MicroBatcher(object):
+    """
+    Collects single LR tensors from many threads and runs fn on them as one batch.
+    fn(images_lr [B, C, H, W]) returns a list of B results.
+    """
+    def __init__(self, fn, max_batch=32, max_wait_ms=5., stats=None):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.stats = stats
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, image_lr):
+        future = Future()
+        with self.cond:
+            self.queue.append((image_lr, future))
+            self.cond.notify()
+        return future
+
+    def next_batch(self):
+        with self.cond:
+            while len(self.queue) == 0:
+                self.cond.wait()
+            deadline = time.time() + self.max_wait
+            while len(self.queue) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            images, futures = zip(*batch)
+            begin = time.time()
+            try:
+                results = self.fn(torch.stack(images, 0))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            if self.stats is not None:
+                self.stats.add_batch(len(batch), time.time() - begin)
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+class TPGSRServer(object):
+    def __init__(self, config, args, opt_TPG):
+        self.mission = TextSR(config, args, opt_TPG)
+        self.model_list, self.tpg_list = self.mission.infer_models()
+        self.rec, self.aster_info = self.mission.infer_recognizer_init()
+
+        cfg = config.TRAIN
+        self.transform = resizeNormalize((cfg.width // cfg.down_sample_scale, cfg.height // cfg.down_sample_scale),
+                                         args.mask)
+        self.stats = InferStats()
+        self.batcher = MicroBatcher(self.run_batch, args.max_batch, args.max_wait_ms, self.stats)
+
+    def run_batch(self, images_lr):
+        with torch.no_grad():
+            images_lr = images_lr.to(self.mission.device)
+            images_sr = self.mission.infer_sr(self.model_list, self.tpg_list, images_lr)
+            preds = self.mission.infer_recognize(self.rec, images_sr, self.aster_info)
+            images_sr = (images_sr[:, :3, :, :].clamp(0, 1) * 255).round().byte().permute(0, 2, 3, 1).cpu().numpy()
+        return list(zip(preds, images_sr))
+
+    def infer(self, image_bytes, ret='text'):
+        img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        text, image_sr = self.batcher.submit(self.transform(img)).result()
+        result = {}
+        if ret in ['text', 'both']:
+            result['text'] = text
+        if ret in ['sr', 'both']:
+            buf = io.BytesIO()
+            Image.fromarray(image_sr).save(buf, format='PNG')
+            result['sr'] = base64.b64encode(buf.getvalue()).decode()
+        return result
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/stats':
+                self.send_json(200, server.stats.summary())
+            else:
+                self.send_json(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/infer':
+                self.send_json(404, {'error': 'unknown path'})
+                return
+            begin = time.time()
+            ret = parse_qs(url.query).get('return', ['text'])[0]
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                result = server.infer(self.rfile.read(length), ret)
+            except Exception as e:
+                server.stats.add_request(time.time() - begin, error=True)
+                self.send_json(400, {'error': str(e)})
+                return
+            latency = time.time() - begin
+            server.stats.add_request(latency)
+            result['latency_ms'] = round(latency * 1000., 2)
+            self.send_json(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch', type=int, default=32, help='largest micro-batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5., help='longest wait for a micro-batch to fill')
+    args = parser.parse_args()
+    config = get_config(args)
+
+    server = TPGSRServer(config, args, get_opt_TPG())
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print('Serving TPGSR on http://%s:%d (POST /infer, GET /stats)' % (args.host, args.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        httpd.server_close()
+        sys.exit(0)
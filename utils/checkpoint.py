@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import shutil
+import atexit
+import threading
+import queue
+import random
+import numpy as np
+import torch
+
+
+"""
+Checkpoints written off the training loop.
+
+save() copies the state dicts to the CPU, which is all the loop waits for, and a
+background thread writes them. Every save is one group of files (the generators and
+recognizers of an iteration), written to
+
+    ckpt_dir/history/<kind>_<iters>/<name>      kind: 'last' (saveInterval) or 'best'
+
+each file to a temporary name first and renamed, so a crash never leaves a truncated
+file behind. A group is complete once its meta.json exists. The newest complete 'last'
+group is then named by ckpt_dir/latest.json, replaced in one rename; --resume_train
+reads every file from that group (resume_group), never a mix of two saves.
+
+The files are also hard-linked to ckpt_dir/<name> (checkpoint.pth, model_best_0.pth,
+recognizer_best.pth, ...) one by one, for loading single models. After a crash between
+two links these may come from different saves. The last keep_last 'last' groups and
+the best keep_best 'best' groups are kept in history, older ones are removed.
+"""
+
+HISTORY_DIR = 'history'
+GROUP_META = 'meta.json'
+LATEST = 'latest.json'
+
+
+def to_cpu(obj):
+    """Copy of obj with every tensor copied to the CPU, detached from training."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copy = type(obj)((k, to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # the module versions of a state_dict
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """The state of every random generator of this process."""
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_atomic(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def resume_group(path):
+    """
+    Directory of the last complete periodic save of the checkpoint dir path: the group
+    named by latest.json, else the newest history/last_* group with a meta.json, else
+    path itself (a group dir given directly, or checkpoints without history).
+    """
+    ckpt_dir = path if os.path.isdir(path) else os.path.dirname(path)
+    latest_path = os.path.join(ckpt_dir, LATEST)
+    if os.path.isfile(latest_path):
+        with open(latest_path, 'r') as f:
+            group_dir = os.path.join(ckpt_dir, json.load(f)['group'])
+        if os.path.isfile(os.path.join(group_dir, GROUP_META)):
+            return group_dir
+    history_dir = os.path.join(ckpt_dir, HISTORY_DIR)
+    if os.path.isdir(history_dir):
+        groups = sorted(name for name in os.listdir(history_dir)
+                        if name.startswith('last_') and os.path.isfile(os.path.join(history_dir, name, GROUP_META)))
+        if groups:
+            # the steps are zero padded, the names sort by step
+            return os.path.join(history_dir, groups[-1])
+    return ckpt_dir
+
+
+def link_atomic(src, dst):
+    # dst becomes src (a hard link, a copy where links are not supported) in a single rename
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter(object):
+    def __init__(self, ckpt_dir, keep_last=3, keep_best=2, background=True):
+        """
+        ARGS:
+            ckpt_dir   : directory of the checkpoints
+            keep_last  : 'last' groups kept in history, at least 1
+            keep_best  : 'best' groups kept in history (highest score), at least 1
+            background : write in a thread, else in save()
+        """
+        self.ckpt_dir = ckpt_dir
+        self.history_dir = os.path.join(ckpt_dir, HISTORY_DIR)
+        if not os.path.isdir(self.history_dir):
+            os.makedirs(self.history_dir)
+        self.keep = {'last': max(1, keep_last), 'best': max(1, keep_best)}
+        self.background = background
+        self.write_times = []
+        self.error = None
+        self.thread = None
+        if background:
+            # one save pending at most, a second one waits for it instead of piling up CPU copies
+            self.jobs = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self.run, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def save(self, files, kind='last', step=0, score=None):
+        """
+        Write the group files {name: object}. Returns once the objects are copied to the CPU
+        (background) or written.
+        """
+        self.check()
+        begin = time.time()
+        job = (to_cpu(files), kind, step, score)
+        print('checkpoint %s_%d: copied to cpu in %.2fs' % (kind, step, time.time() - begin))
+        if self.background:
+            self.jobs.put(job)
+        else:
+            self.write(*job)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self.write(*job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def write(self, files, kind, step, score):
+        begin = time.time()
+        group_dir = os.path.join(self.history_dir, '%s_%08d' % (kind, step))
+        if not os.path.isdir(group_dir):
+            os.makedirs(group_dir)
+        for name, obj in files.items():
+            save_atomic(obj, os.path.join(group_dir, name))
+        # the group is complete once meta.json is there
+        write_json_atomic({'kind': kind, 'step': step, 'score': score, 'files': sorted(files)},
+                          os.path.join(group_dir, GROUP_META))
+        if kind == 'last':
+            # switches --resume_train to the new group in a single rename
+            write_json_atomic({'group': os.path.relpath(group_dir, self.ckpt_dir), 'step': step},
+                              os.path.join(self.ckpt_dir, LATEST))
+        for name in files:
+            link_atomic(os.path.join(group_dir, name), os.path.join(self.ckpt_dir, name))
+        self.retain(kind, group_dir)
+        self.write_times.append(time.time() - begin)
+        size = sum(os.path.getsize(os.path.join(group_dir, name)) for name in files)
+        print('checkpoint %s_%d: %d files, %.1f MB written in %.2fs'
+              % (kind, step, len(files), size / 2. ** 20, self.write_times[-1]))
+
+    def groups(self, kind):
+        groups = []
+        for name in os.listdir(self.history_dir):
+            meta_path = os.path.join(self.history_dir, name, GROUP_META)
+            if not name.startswith(kind + '_') or not os.path.isfile(meta_path):
+                continue
+            with open(meta_path, 'r') as f:
+                groups.append((os.path.join(self.history_dir, name), json.load(f)))
+        return groups
+
+    def retain(self, kind, current):
+        groups = self.groups(kind)
+        if kind == 'best':
+            groups.sort(key=lambda group: (group[1]['score'] or 0., group[1]['step']), reverse=True)
+        else:
+            groups.sort(key=lambda group: group[1]['step'], reverse=True)
+        for group_dir, _ in groups[self.keep[kind]:]:
+            # the linked files stay valid, the group just leaves the history
+            if group_dir != current:
+                shutil.rmtree(group_dir, ignore_errors=True)
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed: %r' % error)
+
+    def wait(self):
+        """Block until every pending save is on disk."""
+        if self.background:
+            self.jobs.join()
+        self.check()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self.thread = None
+        self.check()
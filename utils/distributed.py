@@ -0,0 +1,114 @@
+import os
+import builtins
+import datetime
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+"""
+Multi-process training with DistributedDataParallel (--distributed).
+
+One process per GPU (NCCL) or per group of CPU cores (gloo). Started with torchrun,
+
+    torchrun --nproc_per_node=4 main.py --distributed ...
+
+which sets RANK / WORLD_SIZE / LOCAL_RANK, or on a single node with --nproc=4, which
+spawns the processes itself. The generators and student TPGs are DDP-wrapped, every
+process trains on its share of the data, and rank 0 alone validates, writes the
+checkpoints and the tensorboard events and prints.
+"""
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def unwrap(model):
+    # the model of a DataParallel / DistributedDataParallel, checkpoints hold its state_dict
+    if isinstance(model, list):
+        return [unwrap(m) for m in model]
+    if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def setup_print(is_main):
+    # only rank 0 prints, print(..., force=True) prints from every rank
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def init_distributed(backend=None, timeout_min=60):
+    """
+    Join the process group described by the torchrun environment variables.
+    backend defaults to nccl with CUDA and gloo otherwise. Returns the device of this process.
+    """
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank())
+        device = torch.device('cuda', local_rank())
+    else:
+        device = torch.device('cpu')
+        # torchrun sets OMP_NUM_THREADS=1, the processes of a node share its cores instead
+        torch.set_num_threads(cpu_threads(int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE']))))
+    # rank 0 validates alone for a while, the others wait in their next all-reduce
+    dist.init_process_group(backend, init_method='env://', timeout=datetime.timedelta(minutes=timeout_min))
+    setup_print(is_main_process())
+    print('process group: %s, world size %d' % (backend, get_world_size()))
+    return device
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _spawned(rank, nproc, fn, args):
+    os.environ['RANK'] = os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = os.environ['LOCAL_WORLD_SIZE'] = str(nproc)
+    fn(*args)
+
+
+def launch(fn, nproc, args=()):
+    """Run fn(*args) in nproc processes of a single node process group."""
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(free_port()))
+    mp.spawn(_spawned, args=(nproc, fn, args), nprocs=nproc)
+
+
+def cpu_threads(nproc):
+    return max(1, (os.cpu_count() or 1) // nproc)
+
+
+class NullWriter(object):
+    """Stands in for the SummaryWriter on ranks > 0."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
@@ -4,12 +4,14 @@ import numpy as np
 import editdistance
 import string
 import math
+import functools
 from IPython import embed
 import torch
 import torch.nn.functional as F
 import sys
 sys.path.append('../')
 from utils import to_torch, to_numpy
+from utils.utils_crnn import ctc_greedy_collapse
 
 
 def _normalize_text(text):
@@ -68,24 +70,31 @@ def get_string_aster(output, target, dataset=None):
     return pred_list, targ_list
 
 
+@functools.lru_cache(maxsize=None)
+def _char_table(alphabet):
+    # character of each class index, built once per alphabet
+    table = np.array(list(alphabet))
+    table.flags.writeable = False
+    return table
+
+
+def ctc_greedy_decode(outputs_, alphabet='-0123456789abcdefghijklmnopqrstuvwxyz', return_conf=False):
+    """
+    Greedy CTC decoding of a whole batch of outputs [T, B, C] (index 0 of alphabet is the blank).
+    With return_conf, also returns the softmax probability of every decoded character.
+    """
+    T, B = outputs_.shape[:2]
+    max_index = outputs_.detach().max(2)[1]
+    conf = None
+    if return_conf:
+        conf = F.softmax(outputs_.detach().float(), 2).gather(2, max_index.unsqueeze(2)).squeeze(2)
+        conf = to_numpy(conf.permute(1, 0))
+    max_index = to_numpy(max_index.permute(1, 0))
+    return ctc_greedy_collapse(max_index, np.full(B, T), _char_table(alphabet), conf=conf)
+
+
 def get_string_crnn(outputs_, alphabet='-0123456789abcdefghijklmnopqrstuvwxyz'):
-    outputs = outputs_.permute(1, 0, 2).contiguous()
-    predict_result = []
-    for output in outputs:
-        max_index = torch.max(output, 1)[1]
-
-        out_str = ""
-        last = ""
-        for i in max_index:
-            if alphabet[i] != last:
-                if i != 0:
-                    out_str += alphabet[i]
-                    last = alphabet[i]
-                else:
-                    last = ""
-
-        predict_result.append(out_str)
-    return predict_result
+    return ctc_greedy_decode(outputs_, alphabet)
 
 
 def _lexicon_search(lexicon, word):
@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+
+
+"""
+Export of the TPGSR cascade (model/tpgsr_cascade.py) to ONNX and a CPU ONNX Runtime
+wrapper that can stand in for the PyTorch SR model + TPG(s) at inference time.
+
+onnx / onnxruntime are only needed here and are imported lazily:
+    pip install onnx onnxruntime
+"""
+
+ONNX_INPUT = 'images_lr'
+ONNX_OUTPUT = 'images_sr'
+
+
+def export_cascade(cascade, onnx_path, example, opset=17):
+    """
+    Trace cascade on example [N, C, H, W] and write it to onnx_path,
+    with dynamic batch and width axes.
+    """
+    cascade.eval()
+    with torch.no_grad():
+        torch.onnx.export(cascade, (example,), onnx_path,
+                          input_names=[ONNX_INPUT], output_names=[ONNX_OUTPUT],
+                          dynamic_axes={ONNX_INPUT: {0: 'batch', 3: 'width'},
+                                        ONNX_OUTPUT: {0: 'batch', 3: 'width_sr'}},
+                          opset_version=opset, do_constant_folding=True, dynamo=False)
+    import onnx
+    onnx.checker.check_model(onnx.load(onnx_path))
+
+
+class ORTCascade(object):
+    """
+    Runs an exported cascade with ONNX Runtime on the CPU.
+    Called like the cascade itself: images_lr tensor in, images_sr tensor out (on the input device).
+    """
+    def __init__(self, onnx_path, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        print('load onnx cascade from %s' % onnx_path)
+
+    def eval(self):
+        return self
+
+    def __call__(self, images_lr):
+        images = images_lr.detach().cpu().numpy().astype(np.float32)
+        images_sr = self.session.run([ONNX_OUTPUT], {ONNX_INPUT: images})[0]
+        return torch.from_numpy(images_sr).to(images_lr.device)
+
+
+def parity_check(cascade, ort_cascade, shapes, seed=0):
+    """
+    Max / mean absolute difference between the PyTorch cascade and ONNX Runtime
+    on random inputs of every shape in shapes.
+    """
+    cascade.eval()
+    device = next(cascade.parameters()).device
+    generator = torch.Generator().manual_seed(seed)
+    results = []
+    for shape in shapes:
+        images_lr = torch.rand(shape, generator=generator).to(device)
+        with torch.no_grad():
+            images_sr = cascade(images_lr).cpu()
+        images_sr_ort = ort_cascade(images_lr).cpu()
+        diff = (images_sr - images_sr_ort).abs()
+        results.append((tuple(shape), float(diff.max()), float(diff.mean())))
+    return results
@@ -0,0 +1,91 @@
+import threading
+import torch
+
+
+"""
+Mixed precision for --precision bf16 / fp16.
+
+autocast_module makes the forward of a model (SR model, TPG, recognizer or loss) run
+under torch.autocast and hands its floating outputs back in fp32, so the softmax over
+the TP logits, the losses, PSNR / SSIM and the string decoding outside the models stay
+in fp32. The LSTM / GRU layers disable autocast themselves and run in fp32 too.
+Parameters and checkpoints are unchanged, fp32 is a no-op.
+
+fp16 needs a loss scaler (grad_scaler), bf16 has the fp32 range and does not.
+"""
+
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def autocast_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision %s, one of %s' % (precision, ', '.join(PRECISIONS)))
+    return PRECISIONS[precision]
+
+
+def autocast(precision, device_type):
+    """Context running the enclosed ops under autocast, disabled for fp32."""
+    dtype = autocast_dtype(precision)
+    return torch.autocast(device_type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
+
+def to_fp32(output):
+    if torch.is_tensor(output):
+        return output.float() if output.dtype in (torch.float16, torch.bfloat16) else output
+    if isinstance(output, (list, tuple)):
+        return type(output)(to_fp32(o) for o in output)
+    if isinstance(output, dict):
+        return type(output)((k, to_fp32(v)) for k, v in output.items())
+    return output
+
+
+def autocast_module(module, precision, device_type):
+    """
+    Run module under autocast from now on, with fp32 outputs. module may be a DataParallel /
+    DistributedDataParallel (the hooks go to the wrapped model, DataParallel replicas run in
+    other threads), a list or a dict of modules. Returns module.
+    """
+    if isinstance(module, (list, tuple)):
+        for m in module:
+            autocast_module(m, precision, device_type)
+        return module
+    if isinstance(module, dict):
+        for m in module.values():
+            autocast_module(m, precision, device_type)
+        return module
+    dtype = autocast_dtype(precision)
+    if dtype is None or not isinstance(module, torch.nn.Module):
+        return module
+    parallel = (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+    target = module.module if isinstance(module, parallel) else module
+    if getattr(target, '_autocast_dtype', None) is not None:
+        return module
+
+    # per thread stack, the forward may be reentered (cascades) and replicas run in parallel
+    local = threading.local()
+
+    def enter(mod, args):
+        ctx = torch.autocast(device_type, dtype=dtype)
+        ctx.__enter__()
+        if not hasattr(local, 'stack'):
+            local.stack = []
+        local.stack.append(ctx)
+
+    def leave(mod, args, output):
+        local.stack.pop().__exit__(None, None, None)
+        return to_fp32(output)
+
+    target.register_forward_pre_hook(enter)
+    # always_call: autocast is left even if the forward raises
+    target.register_forward_hook(leave, always_call=True)
+    target._autocast_dtype = dtype
+    return module
+
+
+def grad_scaler(precision, device_type):
+    """GradScaler, only enabled for fp16. Disabled it passes losses and steps through."""
+    return torch.amp.GradScaler(device_type, enabled=autocast_dtype(precision) == torch.float16)
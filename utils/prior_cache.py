@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+
+"""
+On-disk cache of the teacher text priors softmax(teacher(HR)) of a training set.
+
+cache_dir/
+    prior.json     key of the cache: teacher hash, dataset roots, sample count, prior shape
+    prior.npy      float16 [num_samples, T, C], opened with np.load(mmap_mode='r+')
+    filled.npy     bool [num_samples], which rows have been written
+
+The HR images of a training sample and the frozen teacher never change, so the
+prior of sample i is computed once (first epoch or precompute pass) and then read
+back instead of running the teacher. A different teacher checkpoint, dataset list
+or image size gives a different key and the old cache is thrown away.
+"""
+
+PRIOR_META = 'prior.json'
+PRIOR_DATA = 'prior.npy'
+PRIOR_FILLED = 'filled.npy'
+
+
+def model_hash(model):
+    # hash of the weights themselves, so the same checkpoint loaded from another path keeps the cache
+    models = model if isinstance(model, list) else [model]
+    h = hashlib.sha1()
+    for model in models:
+        if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+            model = model.module
+        state_dict = model.state_dict()
+        for key in sorted(state_dict.keys()):
+            h.update(key.encode())
+            h.update(state_dict[key].detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+class TeacherPriorCache(object):
+    def __init__(self, cache_dir, teacher, roots, num_samples, extra=None):
+        """
+        ARGS:
+            cache_dir   : directory of the cache, created if missing
+            teacher     : the frozen TPG, its weights are hashed into the key
+            roots       : training dataset roots, in the order they are concatenated
+            num_samples : length of the (concatenated) training set
+            extra       : anything else the priors depend on, e.g. the HR size
+        """
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.key = {
+            'teacher': model_hash(teacher),
+            'roots': [os.path.abspath(root) for root in roots],
+            'num_samples': int(num_samples),
+            'extra': extra,
+        }
+        self.num_samples = int(num_samples)
+        self.prior = None
+        self.filled = None
+        self.hits = 0
+        self.misses = 0
+
+        meta_path = os.path.join(cache_dir, PRIOR_META)
+        if os.path.isfile(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get('key') == self.key:
+                self.open(meta['shape'])
+                print('Teacher prior cache: %d / %d samples cached in %s'
+                      % (int(self.filled.sum()), self.num_samples, cache_dir))
+            else:
+                print('Teacher prior cache in %s is stale (teacher or data changed), rebuilding' % cache_dir)
+                self.clear()
+
+    def open(self, shape):
+        self.prior = np.load(os.path.join(self.cache_dir, PRIOR_DATA), mmap_mode='r+')
+        self.filled = np.load(os.path.join(self.cache_dir, PRIOR_FILLED))
+        assert list(self.prior.shape[1:]) == list(shape)
+
+    def create(self, shape):
+        self.prior = np.lib.format.open_memmap(os.path.join(self.cache_dir, PRIOR_DATA), mode='w+',
+                                               dtype=np.float16, shape=(self.num_samples,) + tuple(shape))
+        self.filled = np.zeros(self.num_samples, dtype=bool)
+        self.flush()
+        # written after the data file, a cache without it is simply rebuilt
+        with open(os.path.join(self.cache_dir, PRIOR_META), 'w') as f:
+            json.dump({'key': self.key, 'shape': list(shape)}, f, indent=2)
+
+    def clear(self):
+        self.prior = None
+        self.filled = None
+        for name in [PRIOR_META, PRIOR_DATA, PRIOR_FILLED]:
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def complete(self):
+        return self.filled is not None and bool(self.filled.all())
+
+    def get(self, indices):
+        """
+        Priors of a batch as a float tensor [B, T, C], or None unless every sample is cached.
+        """
+        indices = np.asarray(indices)
+        if self.filled is None or not self.filled[indices].all():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return torch.from_numpy(self.prior[indices].astype(np.float32))
+
+    def put(self, indices, priors):
+        """
+        Store priors [B, T, C] of the samples indices.
+        """
+        priors = priors.detach().cpu().numpy().astype(np.float16)
+        if self.prior is None:
+            self.create(priors.shape[1:])
+        indices = np.asarray(indices)
+        self.prior[indices] = priors
+        self.filled[indices] = True
+
+    def flush(self):
+        if self.prior is None:
+            return
+        self.prior.flush()
+        np.save(os.path.join(self.cache_dir, PRIOR_FILLED), self.filled)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import resource
+import torch
+
+
+"""
+Step-level timing of the training loop (--step_timing).
+
+The loop calls lap(phase) where a phase ends, the time since the previous lap goes to
+that phase, so the phases of a step add up to its wall time:
+
+    data        waiting for the batch of the DataLoader
+    h2d         copying the batch to the device
+    teacher     teacher TPG prior of the HR images (or its cache lookup)
+    tpg         student TPG forward
+    sr          SR model forward
+    loss        image / TP / SSIM losses
+    backward    backward, with the gradient all-reduce of DDP
+    clip        unscaling and clip_grad_norm_
+    step        optimizer step and loss scaler update
+    other       logging
+    val         validation
+    checkpoint  periodic and best saves
+
+With CUDA every lap synchronizes the device, which costs some overlap of the host and
+the GPU. Disabled, lap() and step() return at once and nothing is synchronized.
+samples/s counts the training phases only, validation and checkpoints are left out.
+"""
+
+PHASES = ['data', 'h2d', 'teacher', 'tpg', 'sr', 'loss', 'backward', 'clip', 'step', 'other', 'val', 'checkpoint']
+NOT_TRAINING = ['val', 'checkpoint']
+
+
+class StepTimer(object):
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.device = device
+        self.cuda = enabled and device is not None and torch.device(device).type == 'cuda'
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(device)
+        self.total = self.new_record()
+        self.window = self.new_record()
+        self.last = time.perf_counter()
+
+    def new_record(self):
+        return {'time': dict.fromkeys(PHASES, 0.), 'calls': dict.fromkeys(PHASES, 0), 'steps': 0, 'samples': 0}
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        for record in [self.total, self.window]:
+            record['time'][phase] += now - self.last
+            record['calls'][phase] += 1
+        self.last = now
+
+    def step(self, batch_size):
+        # one optimizer step over batch_size samples (of this process)
+        if not self.enabled:
+            return
+        for record in [self.total, self.window]:
+            record['steps'] += 1
+            record['samples'] += batch_size
+
+    def peak_memory_mb(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device) / 2. ** 20
+        # peak resident set size of the process, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    def summary(self, record):
+        steps = max(record['steps'], 1)
+        timed = sum(record['time'].values())
+        train_time = timed - sum(record['time'][phase] for phase in NOT_TRAINING)
+        return {
+            'steps': record['steps'],
+            'samples': record['samples'],
+            'time_s': timed,
+            'samples_per_sec': record['samples'] / train_time if train_time > 0 else 0.,
+            'step_ms': 1000. * train_time / steps,
+            'peak_memory_mb': self.peak_memory_mb(),
+            'memory': 'cuda_allocated' if self.cuda else 'host_rss',
+            'phases': dict((phase, {'total_s': t,
+                                    'ms_per_step': 1000. * t / steps,
+                                    'share': t / timed if timed > 0 else 0.,
+                                    'calls': record['calls'][phase]})
+                           for phase, t in record['time'].items()),
+        }
+
+    def export(self, writer, step, json_path=None):
+        """The timings since the last export to tensorboard and stdout, the totals to json_path."""
+        if not self.enabled or self.window['steps'] == 0:
+            return
+        window = self.summary(self.window)
+        for phase, stats in window['phases'].items():
+            writer.add_scalar('time/' + phase + '_ms', stats['ms_per_step'], global_step=step)
+        writer.add_scalar('time/step_ms', window['step_ms'], global_step=step)
+        writer.add_scalar('time/samples_per_sec', window['samples_per_sec'], global_step=step)
+        writer.add_scalar('memory/peak_mb', window['peak_memory_mb'], global_step=step)
+        print('step timing: %.1f samples/s, %.1f ms/step (%s), peak memory %.0f MB'
+              % (window['samples_per_sec'], window['step_ms'],
+                 ', '.join('%s %.1f' % (phase, stats['ms_per_step'])
+                           for phase, stats in window['phases'].items() if stats['calls']),
+                 window['peak_memory_mb']))
+        if json_path is not None:
+            self.write_json(json_path)
+        self.window = self.new_record()
+        # the export is not part of the next phase
+        self.last = time.perf_counter()
+
+    def write_json(self, path):
+        if not self.enabled:
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.summary(self.total), f, indent=2)
+        os.replace(tmp_path, path)
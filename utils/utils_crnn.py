@@ -5,6 +5,42 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import collections
+import numpy as np
+
+
+def ctc_greedy_collapse(t, lengths, table, blank=0, raw=False, conf=None):
+    """Turn the greedy CTC paths of a whole batch into strings at once.
+
+    Args:
+        t (np.ndarray [sum(lengths)]): argmax class of every timestep, sequences concatenated.
+        lengths (np.ndarray [n]): number of timesteps of each sequence.
+        table (np.ndarray of str): character of each class index.
+        raw (bool): keep blanks and repeats.
+        conf (np.ndarray [sum(lengths)], optional): probability of every argmax class.
+
+    Returns:
+        list of str, plus the list of per-character confidences when conf is given.
+    """
+    t = np.asarray(t).reshape(-1)
+    lengths = np.asarray(lengths).reshape(-1)
+    ends = np.cumsum(lengths)
+
+    if raw:
+        keep = np.ones(t.shape, dtype=bool)
+    else:
+        # first step of every sequence, a repeat is only dropped inside a sequence
+        starts = np.zeros(t.shape, dtype=bool)
+        starts[(ends - lengths)[lengths > 0]] = True
+        keep = t != blank
+        keep[1:] &= (t[1:] != t[:-1]) | starts[1:]
+
+    chars = table[t][keep]
+    # number of kept characters before the end of every sequence
+    splits = np.concatenate([[0], np.cumsum(keep)])[ends][:-1]
+    texts = [''.join(c) for c in np.split(chars, splits)]
+    if conf is None:
+        return texts
+    return texts, np.split(np.asarray(conf).reshape(-1)[keep], splits)
 
 
 class strLabelConverter(object):
@@ -28,6 +64,8 @@ class strLabelConverter(object):
         for i, char in enumerate(alphabet):
             # NOTE: 0 is reserved for 'blank' required by wrap_ctc
             self.dict[char] = i + 1
+        # class index -> character, 0 is the blank ('-' at the end of self.alphabet)
+        self.table = np.array(list(self.alphabet[-1] + self.alphabet[:-1]))
 
     def encode(self, text):
         """Support batch or single str.
@@ -65,29 +103,14 @@ class strLabelConverter(object):
             text (str or list of str): texts to convert.
         """
         if length.numel() == 1:
-            length = length[0]
+            length = length.reshape(-1)[0]
             assert t.numel() == length, "text with length: {} does not match declared length: {}".format(t.numel(), length)
-            if raw:
-                return ''.join([self.alphabet[i - 1] for i in t])
-            else:
-                char_list = []
-                for i in range(length):
-                    if t[i] != 0 and (not (i > 0 and t[i - 1] == t[i])):
-                        char_list.append(self.alphabet[t[i] - 1])
-                return ''.join(char_list)
         else:
-            # batch mode
             assert t.numel() == length.sum(), "texts with length: {} does not match declared length: {}".format(t.numel(), length.sum())
-            texts = []
-            index = 0
-            for i in range(length.numel()):
-                l = length[i]
-                texts.append(
-                    self.decode(
-                        t[index:index + l], torch.IntTensor([l]), raw=raw))
-                index += l
-            return texts
-
+        texts = ctc_greedy_collapse(t.cpu().numpy(), length.cpu().numpy(), self.table, raw=raw)
+        if length.numel() == 1:
+            return texts[0]
+        return texts
 
 class averager(object):
     """Compute average for `torch.Variable` and `torch.Tensor`. """